@@ -5,60 +5,147 @@
 # as_info.py: a library to lookup AS number and AS owner information
 # for IP addresses.
 #
+# The prefix table is flattened into a sorted list of non-overlapping
+# address intervals, each mapped to the AS of the longest prefix that
+# covers it, so a lookup is a binary search instead of a scan of every
+# prefix.
+#
 
+from bisect import bisect_right
 from netaddr import IPNetwork, IPAddress
 
+import config
+from centinel.cache import LRUCache
+
+
+# lookups are cached per aggregate (/24 for IPv4, /48 for IPv6), as
+# long as no prefix in the table is more specific than that
+AGGREGATE_BITS = {4: 24, 6: 48}
+ADDRESS_BITS = {4: 32, 6: 128}
+
+
+def flatten_prefixes(prefixes):
+    """Turn a list of (first address, last address, AS number) prefixes
+    into sorted, non-overlapping intervals.
+
+    Returns three lists: the first address, last address and AS number
+    of each interval. Where prefixes overlap, the interval gets the AS
+    number of the most specific one. If the same prefix appears more
+    than once, the first occurrence wins.
+
+    """
+    starts, ends, asns = [], [], []
+
+    def emit(first, last, asn):
+        if first > last:
+            return
+        # merge with the previous interval if it is adjacent and has
+        # the same AS
+        if asns and asns[-1] == asn and ends[-1] + 1 == first:
+            ends[-1] = last
+        else:
+            starts.append(first)
+            ends.append(last)
+            asns.append(asn)
+
+    # sort by start address, then larger prefixes first, then file order
+    ordered = sorted((first, -last, index, asn) for index, (first, last, asn)
+                     in enumerate(prefixes))
+    # stack of the prefixes that contain the current position, the
+    # innermost one on top
+    stack = []
+    # first address that is not yet covered by an emitted interval
+    position = 0
+    previous = None
+    for first, neg_last, _, asn in ordered:
+        last = -neg_last
+        if (first, last) == previous:
+            continue
+        previous = (first, last)
+        # close the prefixes that end before this one starts
+        while stack and stack[-1][0] < first:
+            end, enclosing_asn = stack.pop()
+            emit(position, end, enclosing_asn)
+            position = max(position, end + 1)
+        # the gap up to this prefix belongs to the enclosing prefix
+        if stack:
+            emit(position, first - 1, stack[-1][1])
+        position = first
+        stack.append((last, asn))
+    while stack:
+        end, enclosing_asn = stack.pop()
+        emit(position, end, enclosing_asn)
+        position = max(position, end + 1)
+    return starts, ends, asns
+
+
 class ASInfo:
 
-    # using a cache is very useful since lookups are expensive
-    cache = {}
-    # array of prefix information
-    pref_to_as = []
-    # array AS number owner information
-    as_info = {}
-
-    def __init__(self, pref_to_as_file_address, as_info_file_address):
-        self.as_info_file = open(as_info_file_address)
-        self.pref_to_as_file = open(pref_to_as_file_address)
-        self.pref_to_as = []
-        for line in self.pref_to_as_file:
-            line = line.strip()
-            pref,asn  = line.split(None, 1)
-            bits = int(pref.split('/')[1])
-            self.pref_to_as.append({ 'net'  : IPNetwork(pref),
-                         'bits' : bits,
-                         'asn'  : int(asn)})
+    def __init__(self, pref_to_as_file_address, as_info_file_address,
+                 cache_size=None):
+        # using a cache is very useful since lookups are expensive
+        if cache_size is None:
+            cache_size = config.asinfo_cache_size
+        self.cache = LRUCache(cache_size)
+
+        prefixes = {4: [], 6: []}
+        # IP version -> length of the most specific prefix
+        max_bits = {4: 0, 6: 0}
+        with open(pref_to_as_file_address) as pref_to_as_file:
+            for line in pref_to_as_file:
+                line = line.strip()
+                if not line:
+                    continue
+                pref, asn = line.split(None, 1)
+                net = IPNetwork(pref)
+                prefixes[net.version].append((net.first, net.last, int(asn)))
+                max_bits[net.version] = max(max_bits[net.version],
+                                            net.prefixlen)
+
+        # IP version -> (interval starts, interval ends, AS numbers)
+        self.intervals = {}
+        # IP version -> number of low bits to drop from an address to
+        # get its cache key
+        self.cache_shift = {}
+        for version in prefixes:
+            self.intervals[version] = flatten_prefixes(prefixes[version])
+            if max_bits[version] <= AGGREGATE_BITS[version]:
+                self.cache_shift[version] = (ADDRESS_BITS[version] -
+                                             AGGREGATE_BITS[version])
+            else:
+                self.cache_shift[version] = 0
 
         self.as_info = {}
-        for line in self.as_info_file:
-            line = line.strip()
-            asn, owner = line.split(None, 1)
-            self.as_info[int(asn)] = owner
+        with open(as_info_file_address) as as_info_file:
+            for line in as_info_file:
+                line = line.strip()
+                asn, owner = line.split(None, 1)
+                self.as_info[int(asn)] = owner
 
     def ip_to_asn(self, ip_address):
+        ip = IPAddress(ip_address)
+        value = int(ip)
         # check if there's a cache hit
-        if ip_address in self.cache:
-            return self.cache[ip_address]
-
-        result = None
-        for row in self.pref_to_as:
-            if IPAddress(ip_address) in row['net']:
-                if result is None:
-                    result = row
-                    continue
-                # replace if it is a longer match
-                elif row['bits'] > result['bits']:
-                    result = row
+        key = (ip.version, value >> self.cache_shift[ip.version])
+        asn = self.cache.get(key)
+        if asn is not None:
+            return asn
 
-        if result is None:
-            self.cache[ip_address] = 0
-            return 0
+        starts, ends, asns = self.intervals[ip.version]
+        index = bisect_right(starts, value) - 1
+        asn = 0
+        if index >= 0 and value <= ends[index]:
+            asn = asns[index]
 
         # cache it for later before returning
-        self.cache[ip_address] = result['asn']
-        return result['asn']
+        self.cache.put(key, asn)
+        return asn
 
     def asn_to_owner(self, as_number):
         if int(as_number) < 1:
             raise Exception("Invalid AS number %s" % (as_number))
         return self.as_info[as_number]
+
+    def cache_stats(self):
+        """Return the hit/ miss/ eviction counters of the lookup cache"""
+        return self.cache.stats()
@@ -0,0 +1,210 @@
+#
+# blobstore.py: a content-addressed file store.
+#
+# Each distinct content is stored once, as <blob_dir>/<ab>/<sha256>
+# where <ab> are the first two characters of its SHA-256 digest. Every
+# file that should have that content is a hard link to the blob, so
+# handing the same file to thousands of clients writes the data once.
+# A blob that no file links to anymore (link count of 1) is garbage
+# and is removed by collect_garbage.
+#
+# A blob that is reused is marked with a lease, an empty
+# <blob_dir>/<ab>/.lease-<sha256> file whose modification time says
+# when the blob was last reused, so that collect_garbage doesn't remove
+# it before it is linked. The blob's own modification time is never
+# changed: it is the modification time of every file linked to it.
+#
+# Blobs are read-only: never modify a linked file in place, since that
+# would modify it for every client. Link a new blob instead.
+#
+# The functions work on config.blob_dir unless they are given another
+# store directory, e.g. config.result_blob_dir for the uploaded
+# results.
+#
+
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import time
+import uuid
+
+import config
+
+
+# read files in chunks of this size when hashing them
+CHUNK_SIZE = 64 * 1024
+LEASE_PREFIX = ".lease-"
+
+
+def blob_path(digest, store_dir=None):
+    if store_dir is None:
+        store_dir = config.blob_dir
+    return os.path.join(store_dir, digest[:2], digest)
+
+
+def _temp_path(directory):
+    return os.path.join(directory, ".tmp-%s" % (uuid.uuid4().hex))
+
+
+def _lease_path(path):
+    return os.path.join(os.path.dirname(path),
+                        LEASE_PREFIX + os.path.basename(path))
+
+
+def _lease(path):
+    """Mark an existing blob as just used, so that collect_garbage
+    leaves it alone until it has been linked. Returns False if there is
+    no such blob."""
+    if not os.path.exists(path):
+        return False
+    lease_path = _lease_path(path)
+    with open(lease_path, 'a'):
+        pass
+    os.utime(lease_path, None)
+    return True
+
+
+def _is_leased(path, cutoff):
+    try:
+        return os.path.getmtime(_lease_path(path)) > cutoff
+    except OSError:
+        return False
+
+
+def store_file(path):
+    """Add the content of the file to the store and return its digest
+    and the path of the blob"""
+    with open(path, 'rb') as file_p:
+        return store_stream(file_p)
+
+
+def store_stream(stream):
+    """Add the content read from the stream to the store and return its
+    digest and the path of the blob"""
+    if not os.path.exists(config.blob_dir):
+        os.makedirs(config.blob_dir)
+    sha256 = hashlib.sha256()
+    tmp_path = _temp_path(config.blob_dir)
+    try:
+        with open(tmp_path, 'wb') as file_p:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                file_p.write(chunk)
+        digest = sha256.hexdigest()
+        path = blob_path(digest)
+        if _lease(path):
+            # we already have this content
+            os.remove(tmp_path)
+            return digest, path
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.chmod(tmp_path, 0o444)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest, path
+
+
+def add_and_link(path, digest, dest, store_dir=None):
+    """Make dest a link to the blob of the given digest and return the
+    path of the blob. If the store doesn't have that blob yet, the file
+    at path becomes the blob, otherwise the file is removed once dest
+    is linked, and the files already linked to the blob keep their
+    modification time.
+
+    This is for files whose digest is already known, e.g. because it
+    was computed while they were received. The digest is not checked,
+    but it must be the SHA-256 digest of the bytes of the file, as
+    they are stored, so that a blob always holds the content its name
+    says.
+
+    Params:
+
+    path- the file to add. It must be on the same file system as the
+        store
+    digest- hex digest of the content
+    dest- the path to link to the blob
+    store_dir- the store, config.blob_dir by default
+
+    """
+    blob = blob_path(digest, store_dir)
+    if _lease(blob):
+        try:
+            link(blob, dest)
+        except OSError as exp:
+            # the blob was garbage collected before we could link it,
+            # our file takes its place
+            if exp.errno != errno.ENOENT:
+                raise
+        else:
+            os.remove(path)
+            return blob
+    if not os.path.exists(os.path.dirname(blob)):
+        try:
+            os.makedirs(os.path.dirname(blob))
+        except OSError as exp:
+            # created concurrently
+            if exp.errno != errno.EEXIST:
+                raise
+    os.chmod(path, 0o444)
+    os.rename(path, blob)
+    link(blob, dest)
+    return blob
+
+
+def link(path, dest):
+    """Make dest a hard link to the blob at path, replacing dest if it
+    exists. If the blob can't be linked (e.g. dest is on another file
+    system), the content is copied instead.
+
+    """
+    # renaming a link over another link to the same blob is a no-op
+    # that would leave the temporary link behind
+    if os.path.exists(dest) and os.path.samefile(path, dest):
+        return
+    tmp_path = _temp_path(os.path.dirname(dest))
+    try:
+        os.link(path, tmp_path)
+    except OSError as exp:
+        if exp.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        logging.warning("Can't link %s to %s, copying it instead: "
+                        "%s" % (path, dest, exp))
+        shutil.copyfile(path, tmp_path)
+    os.rename(tmp_path, dest)
+
+
+def collect_garbage(store_dir=None, min_age=0):
+    """Remove the blobs that no file links to anymore and return how
+    many were removed. Blobs added or reused less than min_age seconds
+    ago are kept, since they may be about to be linked. Leases older
+    than that are removed."""
+    cutoff = time.time() - min_age
+    if store_dir is None:
+        store_dir = config.blob_dir
+    removed = 0
+    if not os.path.exists(store_dir):
+        return removed
+    for directory, _, names in os.walk(store_dir):
+        for name in names:
+            # skip blobs that are still being written
+            if name.startswith(".tmp-"):
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+                if name.startswith(LEASE_PREFIX):
+                    if stat.st_mtime <= cutoff:
+                        os.remove(path)
+                elif (stat.st_nlink == 1 and stat.st_mtime <= cutoff and
+                        not _is_leased(path, cutoff)):
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                # removed concurrently
+                continue
+    return removed
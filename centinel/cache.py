@@ -0,0 +1,136 @@
+#
+# cache.py: small, thread-safe in-process caches used to keep hot
+# lookups (password checks, GeoIP, AS lookups, ...) off the database
+# and the disk.
+#
+
+from collections import OrderedDict
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+import config
+
+
+_missing = object()
+
+
+class LRUCache(object):
+    """A size-bounded least-recently-used cache with an optional
+    time-to-live for each entry.
+
+    Params:
+
+    max_size- the maximum number of entries to keep. A size of 0
+        disables the cache (every lookup is a miss)
+    ttl- number of seconds an entry stays valid, or None to keep
+        entries until they are evicted
+
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, _missing)
+            if entry is _missing:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            # re-insert so that the entry becomes the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, _missing)
+        if entry is _missing:
+            return default
+        return entry[0]
+
+    def discard_values(self, value):
+        """Remove every entry whose value equals the given value"""
+        with self._lock:
+            stale = [key for key, entry in self._entries.iteritems()
+                     if entry[0] == value]
+            for key in stale:
+                del self._entries[key]
+        return len(stale)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
+
+
+class CredentialCache(LRUCache):
+    """Cache of username/ password pairs that have recently been
+    verified successfully.
+
+    Entries are keyed on an HMAC of the username and password with a
+    per-process random key, so neither the plaintext password nor a
+    digest that could be attacked offline is kept in memory. The value
+    of each entry is the username so that all of a client's entries
+    can be dropped when their password or roles change.
+
+    Note: invalidation is per process. When running several
+    processes (e.g. mod_wsgi daemon processes), the TTL bounds how
+    long a stale entry can be used in the other processes.
+
+    """
+
+    def __init__(self, max_size, ttl=None):
+        super(CredentialCache, self).__init__(max_size, ttl)
+        self._secret = os.urandom(32)
+
+    def digest(self, username, password):
+        message = b"\0".join([_to_bytes(username), _to_bytes(password)])
+        return hmac.new(self._secret, message, hashlib.sha256).digest()
+
+    def invalidate_user(self, username):
+        return self.discard_values(username)
+
+
+def _to_bytes(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+credential_cache = CredentialCache(config.auth_cache_size,
+                                   config.auth_cache_ttl)
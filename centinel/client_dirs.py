@@ -0,0 +1,157 @@
+#
+# client_dirs.py: where each client's results, experiments and inputs
+# directories live.
+#
+# With config.client_dir_shard_depth set to 0, a client's directory is
+# <base>/<username>, next to the global and country directories. With
+# a depth of n, it is spread over n levels of two hex characters of
+# the MD5 digest of the username, e.g. <base>/ab/cd/<username> for a
+# depth of 2, which keeps every directory small even with tens of
+# thousands of clients. Shard directories are lowercase hex, so they
+# never clash with the (uppercase) country directories.
+#
+# The directories are created on the first write, not when the client
+# registers. Running this module moves the existing client directories
+# to the configured layout.
+#
+
+import argparse
+import errno
+import hashlib
+import logging
+import os
+
+import config
+
+
+# directories of the base directories that are not client directories
+SHARED_DIRS = ['global']
+# deepest layout the migration looks for client directories in
+MAX_SHARD_DEPTH = 4
+
+
+def shard_parts(username, depth=None):
+    """Return the shard directory names of the client's directory"""
+    if depth is None:
+        depth = config.client_dir_shard_depth
+    if isinstance(username, unicode):
+        username = username.encode('utf-8')
+    digest = hashlib.md5(username).hexdigest()
+    return [digest[2 * level:2 * level + 2] for level in range(depth)]
+
+
+def client_dir(base_dir, username, create=False, depth=None):
+    """Return the path of the client's directory in base_dir (one of
+    config.results_dir, config.experiments_dir or config.inputs_dir)
+
+    Params:
+
+    base_dir- the directory that contains the client directories
+    username- the username of the client
+    create- create the directory if it doesn't exist yet
+    depth- number of shard levels, config.client_dir_shard_depth by
+        default
+
+    """
+    path = os.path.join(base_dir, *(shard_parts(username, depth) +
+                                    [username]))
+    if create:
+        makedirs(path)
+    return path
+
+
+def existing_client_dirs(base_dir, username):
+    """Return the paths of the client's directories in base_dir in any
+    of the layouts, the one of the configured depth first. Tools that
+    look at the directories of all clients should use this rather than
+    list base_dir, since with a sharded layout (or halfway through a
+    migration) a client directory can be at any depth.
+
+    """
+    current = client_dir(base_dir, username)
+    paths = [current] if os.path.isdir(current) else []
+    for depth in range(MAX_SHARD_DEPTH + 1):
+        path = client_dir(base_dir, username, depth=depth)
+        if path != current and os.path.isdir(path):
+            paths.append(path)
+    return paths
+
+
+def makedirs(path):
+    """Create the directory and its parents, unless it exists"""
+    try:
+        os.makedirs(path)
+    except OSError as exp:
+        # created by a concurrent request
+        if exp.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def migrate_client(base_dir, username, depth=None):
+    """Move the client's directory to the layout with the given depth
+    from wherever it is in base_dir. If the client already has a
+    directory in the new layout, the files are moved into it, unless it
+    already has a file with the same name.
+
+    Returns True if anything was moved.
+
+    """
+    target = client_dir(base_dir, username, depth=depth)
+    moved = False
+    for source in existing_client_dirs(base_dir, username):
+        if source == target:
+            continue
+        if not os.path.exists(target):
+            makedirs(os.path.dirname(target))
+            os.rename(source, target)
+            moved = True
+            continue
+        for name in os.listdir(source):
+            if os.path.exists(os.path.join(target, name)):
+                logging.warning("Not moving %s, %s already has a file with "
+                                "that name" % (os.path.join(source, name),
+                                               target))
+                continue
+            os.rename(os.path.join(source, name), os.path.join(target, name))
+            moved = True
+        try:
+            os.rmdir(source)
+        except OSError:
+            # files left behind because of conflicts
+            pass
+    return moved
+
+
+def migrate(base_dirs, usernames, depth=None):
+    """Move the directories of the given clients to the layout with the
+    given depth in each of the base directories and return how many
+    were moved"""
+    moved = 0
+    for base_dir in base_dirs:
+        if not os.path.isdir(base_dir):
+            continue
+        for username in usernames:
+            if username in SHARED_DIRS:
+                continue
+            if migrate_client(base_dir, username, depth):
+                moved += 1
+    return moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Move the client directories to the layout set by "
+        "config.client_dir_shard_depth")
+    depth_help = ("Number of shard levels to move the directories to. "
+                  "Defaults to config.client_dir_shard_depth")
+    parser.add_argument('--depth', '-d', type=int, default=None,
+                        help=depth_help)
+    args = parser.parse_args()
+
+    from centinel.models import Client
+    usernames = [username for username, in
+                 Client.query.with_entities(Client.username)
+                 if username]
+    moved = migrate([config.results_dir, config.experiments_dir,
+                     config.inputs_dir], usernames, args.depth)
+    print "Moved %d client directories" % (moved)
@@ -0,0 +1,170 @@
+#
+# compression.py: transparent compression of the stored results.
+#
+# Results keep their names when they are compressed, the codec is
+# recognised from the first bytes of the file when it is read, so
+# compressed and uncompressed results can live side by side. Small
+# results are gzip compressed, which is fast; large ones are xz
+# compressed, which is slower but much smaller for the repetitive JSON
+# the clients send, if the lzma module is available. Uploads that are
+# already compressed are stored as they are.
+#
+# Running this module compresses the results that are stored
+# uncompressed, in parallel.
+#
+
+import argparse
+import bz2
+import gzip
+import logging
+from multiprocessing import Pool
+import os
+import uuid
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+import config
+
+
+# read files in chunks of this size when compressing them
+CHUNK_SIZE = 64 * 1024
+GZIP = 'gzip'
+BZIP2 = 'bzip2'
+XZ = 'xz'
+ZIP = 'zip'
+# codec -> magic bytes at the start of the file
+MAGIC = [(GZIP, b'\x1f\x8b'),
+         (BZIP2, b'BZh'),
+         (XZ, b'\xfd7zXZ\x00'),
+         (ZIP, b'PK\x03\x04')]
+MAGIC_LEN = max(len(magic) for _, magic in MAGIC)
+
+
+def detect_codec(path):
+    """Return the codec the file is compressed with, or None"""
+    with open(path, 'rb') as file_p:
+        header = file_p.read(MAGIC_LEN)
+    for codec, magic in MAGIC:
+        if header.startswith(magic):
+            return codec
+    return None
+
+
+def open_file(path):
+    """Open the file for reading, decompressing it on the fly if it is
+    compressed with a codec we can read"""
+    codec = detect_codec(path)
+    if codec == GZIP:
+        return gzip.open(path, 'rb')
+    if codec == BZIP2:
+        return bz2.BZ2File(path, 'rb')
+    if codec == XZ and lzma is not None:
+        return lzma.LZMAFile(path, 'rb')
+    return open(path, 'rb')
+
+
+def choose_codec(size):
+    """Return the codec to compress a file of the given size with"""
+    if size >= config.compress_lzma_min_size and lzma is not None:
+        return XZ
+    return GZIP
+
+
+def _open_output(path, codec):
+    if codec == XZ:
+        return lzma.LZMAFile(path, 'wb')
+    return gzip.open(path, 'wb', config.compress_gzip_level)
+
+
+def compress_file(path):
+    """Replace the file with a compressed copy, unless it is already
+    compressed or it is a hard link to a blob (see blobstore), which
+    must keep the bytes its digest was computed over. The copy is
+    written next to the file and renamed over it, keeping the file's
+    modification time.
+
+    Returns the codec used, or None if the file was left alone.
+
+    """
+    if detect_codec(path) is not None:
+        return None
+    stat = os.stat(path)
+    if stat.st_nlink > 1:
+        return None
+    codec = choose_codec(stat.st_size)
+    directory = os.path.dirname(path)
+    # the name starts with an underscore so that it's never listed as
+    # a result
+    tmp_path = os.path.join(directory, "_compress-%s.tmp" %
+                            (uuid.uuid4().hex))
+    try:
+        with open(path, 'rb') as source:
+            output = _open_output(tmp_path, codec)
+            try:
+                for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                    output.write(chunk)
+            finally:
+                output.close()
+        os.utime(tmp_path, (stat.st_atime, stat.st_mtime))
+        # don't replace a result that was uploaded again meanwhile
+        current = os.stat(path)
+        if (current.st_ino, current.st_mtime) != (stat.st_ino,
+                                                  stat.st_mtime):
+            return None
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return codec
+
+
+def _compress_result(path):
+    try:
+        return path, compress_file(path), None
+    except Exception as exp:
+        return path, None, str(exp)
+
+
+def compress_backlog(paths, workers=4):
+    """Compress the uncompressed files among the given paths using a
+    pool of worker processes. Returns the number of files compressed
+    and the number of errors."""
+    compressed = errors = 0
+    pool = Pool(max(workers, 1))
+    try:
+        for path, codec, error in pool.imap_unordered(_compress_result,
+                                                      paths, 16):
+            if error is not None:
+                logging.error("Error compressing %s: %s" % (path, error))
+                errors += 1
+            elif codec is not None:
+                compressed += 1
+    finally:
+        pool.close()
+        pool.join()
+    return compressed, errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compress the results that are stored uncompressed")
+    parser.add_argument('--workers', '-w', type=int, default=4,
+                        help='Number of results to compress in parallel')
+    args = parser.parse_args()
+
+    # result_files imports this module
+    from centinel import client_dirs, result_files
+    from centinel.models import Client
+    usernames = [username for username, in
+                 Client.query.with_entities(Client.username) if username]
+    paths = (path for username in usernames
+             for path in result_files.iter_result_paths(
+                 client_dirs.client_dir(config.results_dir, username)))
+    compressed, errors = compress_backlog(paths, args.workers)
+    print "Compressed %d results, %d errors" % (compressed, errors)
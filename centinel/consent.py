@@ -0,0 +1,87 @@
+#
+# consent.py: compiled consent page templates.
+#
+# A consent page is a static HTML file with a few placeholder strings
+# in it. Each page is read and split around its placeholders once per
+# process, and again only when the file's modification time or size
+# changes, so rendering a page is a single join of the precomputed
+# segments and the values for the placeholders.
+#
+
+import os
+import re
+import threading
+
+
+USERNAME_FIELD = 'replace-with-username-value'
+READABLE_USERNAME_FIELD = 'replace-with-human-readable-username-value'
+FREEDOM_HOUSE_FIELD = 'replace-this-with-freedom-house'
+PLACEHOLDERS = [USERNAME_FIELD, READABLE_USERNAME_FIELD, FREEDOM_HOUSE_FIELD]
+
+# longest placeholder first, in case one is a prefix of another
+_placeholder_reg = re.compile("(" + "|".join(
+    re.escape(field) for field in sorted(PLACEHOLDERS, key=len,
+                                         reverse=True)) + ")")
+
+
+class ConsentTemplate:
+    """A page split into static segments and placeholders.
+
+    The segments are UTF-8 encoded and alternate with the placeholders:
+    segments[0], placeholders[0], segments[1], ..., segments[-1].
+
+    """
+
+    def __init__(self, content):
+        parts = _placeholder_reg.split(content.decode('utf-8'))
+        self.segments = [part.encode('utf-8') for part in parts[0::2]]
+        self.placeholders = [str(part) for part in parts[1::2]]
+
+    def render(self, values):
+        """Return the page with each placeholder replaced by its value
+        in values. Placeholders without a value are left as they are.
+
+        Params:
+
+        values- dictionary of placeholder -> unicode or UTF-8 string
+
+        """
+        pieces = [self.segments[0]]
+        for placeholder, segment in zip(self.placeholders,
+                                        self.segments[1:]):
+            value = values.get(placeholder, placeholder)
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            pieces.append(value)
+            pieces.append(segment)
+        return "".join(pieces)
+
+
+# path -> ((modification time, size), ConsentTemplate)
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_template(path):
+    """Return the compiled template for the page at path, compiling it
+    if it hasn't been loaded yet or has changed on disk"""
+    stat = os.stat(path)
+    # the size catches rewrites within the mtime granularity
+    stamp = (stat.st_mtime, stat.st_size)
+    cached = _templates.get(path)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    with _templates_lock:
+        cached = _templates.get(path)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+        with open(path, 'r') as file_p:
+            template = ConsentTemplate(file_p.read())
+        _templates[path] = (stamp, template)
+    return template
+
+
+def render_page(path, values):
+    """Render the consent page at path with the given placeholder
+    values"""
+    return get_template(path).render(values)
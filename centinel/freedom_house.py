@@ -0,0 +1,198 @@
+#
+# freedom_house.py: local, sanitised copies of the Freedom House
+# country reports shown on the country specific consent page.
+#
+# Fetching a report and stripping everything that would make a
+# client's browser contact the original site is slow, so it is done
+# ahead of time for every country in constants.freedom_house_lookup,
+# either by a background thread of the server (with
+# config.prefetch_freedomhouse set) or by running this
+# module from cron. A report is fetched again once its copy is older
+# than config.freedom_house_ttl, and copies are replaced with atomic
+# renames, so the consent page only ever reads a complete file.
+#
+
+import argparse
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+import config
+from centinel import constants
+
+
+PAGE_PREFIX = "freedom_house_"
+# seconds between two checks for reports that need to be fetched again
+CHECK_INTERVAL = 60 * 60
+# seconds to wait for the Freedom House site
+FETCH_TIMEOUT = 30
+
+# external references, scripts and forms are removed in one pass over
+# the page. Whole script and form elements come first so that the
+# references inside them are removed along with them
+_bad_content_reg = re.compile(r'<\s*script.*?>.*?</\s*script\s*>|'
+                              r'<\s*form.*?>.*?</\s*form\s*>|'
+                              r'src\s*=\s*".*?"|'
+                              r'href\s*=\s*".*?"',
+                              re.MULTILINE | re.DOTALL | re.IGNORECASE)
+
+_prefetch_thread = None
+_prefetch_lock = threading.Lock()
+
+
+def page_name(country):
+    """Return the file name of the copy of the country's report"""
+    return "".join([PAGE_PREFIX, country, ".html"])
+
+
+def is_page_name(filename):
+    """Return True if filename is the name of a report copy"""
+    if not (filename.startswith(PAGE_PREFIX) and filename.endswith(".html")):
+        return False
+    country = filename[len(PAGE_PREFIX):-len(".html")]
+    return country in constants.freedom_house_lookup
+
+
+def static_dir():
+    return os.path.join(config.centinel_home, "static")
+
+
+def cached_page(country, directory=None):
+    """Return the name of the copy of the country's report, or None if
+    it hasn't been fetched yet"""
+    if directory is None:
+        directory = static_dir()
+    name = page_name(country)
+    if os.path.exists(os.path.join(directory, name)):
+        return name
+    return None
+
+
+def strip_bad_content(page):
+    """Strip out all requests back to the original domain (identified
+    via src and href attributes), scripts and forms from the page
+
+    Note: this will break stuff, but that is better than letting the
+    domain know where and who our clients are
+
+    """
+    # replace external links with a blank reference (sucks for the
+    # rendering engine to figure out, but hey, they get paid to work
+    # that out)
+    return _bad_content_reg.sub("", page)
+
+
+def fetch_page(url, path, session=requests):
+    """Get the page at url, strip out the bad content and write it to
+    path. The page is written to a temporary file first and renamed
+    over path."""
+    req = session.get(url, timeout=FETCH_TIMEOUT)
+    req.raise_for_status()
+    page = strip_bad_content(req.content)
+    directory, basename = os.path.split(path)
+    tmp_path = os.path.join(directory, ".%s.%s.tmp" %
+                            (basename, uuid.uuid4().hex))
+    try:
+        with open(tmp_path, 'w') as file_p:
+            file_p.write(page)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def refresh_pages(directory=None, ttl=None, workers=4, countries=None,
+                  url_base=constants.freedom_house_url_base):
+    """Fetch the reports whose copies are missing or older than ttl
+    seconds
+
+    Returns a dictionary of country code to True (fetched), False (the
+    copy is recent enough) or None (error).
+
+    Params:
+
+    directory- where the copies are kept, the static directory by
+        default
+    ttl- maximum age of a copy in seconds, config.freedom_house_ttl by
+        default. 0 fetches every report
+    workers- number of reports to fetch in parallel
+    countries- the country codes to fetch the reports of, all of the
+        countries in constants.freedom_house_lookup by default
+    url_base- the URL the report names are appended to
+
+    """
+    if directory is None:
+        directory = static_dir()
+    if ttl is None:
+        ttl = config.freedom_house_ttl
+    if countries is None:
+        countries = sorted(constants.freedom_house_lookup)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+
+    session = requests.Session()
+    cutoff = time.time() - ttl
+
+    def refresh(country):
+        path = os.path.join(directory, page_name(country))
+        try:
+            if os.path.exists(path) and os.path.getmtime(path) > cutoff:
+                return country, False
+            url = url_base + constants.freedom_house_lookup[country]
+            fetch_page(url, path, session)
+        except Exception as exp:
+            logging.error("Error fetching the Freedom House report for "
+                          "%s: %s" % (country, exp))
+            return country, None
+        return country, True
+
+    pool = ThreadPool(max(workers, 1))
+    try:
+        return dict(pool.map(refresh, countries))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def start_prefetch():
+    """Start the background thread that keeps the copies up to date,
+    unless it is already running"""
+    global _prefetch_thread
+    with _prefetch_lock:
+        if _prefetch_thread is not None:
+            return
+        _prefetch_thread = threading.Thread(target=_run_prefetch,
+                                            name="freedom-house-prefetch")
+        _prefetch_thread.daemon = True
+        _prefetch_thread.start()
+
+
+def _run_prefetch():
+    while True:
+        try:
+            refresh_pages(workers=config.freedom_house_workers)
+        except Exception as exp:
+            logging.error("Error refreshing the Freedom House reports: "
+                          "%s" % (exp))
+        time.sleep(CHECK_INTERVAL)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--force', '-f', action='store_true',
+                        help='Fetch every report, even recent ones')
+    parser.add_argument('--workers', '-w', type=int,
+                        default=config.freedom_house_workers,
+                        help='Number of reports to fetch in parallel')
+    args = parser.parse_args()
+    ttl = 0 if args.force else None
+    results = refresh_pages(ttl=ttl, workers=args.workers)
+    print ("Fetched %d of %d reports, %d failed." %
+           (results.values().count(True), len(results),
+            results.values().count(None)))
@@ -0,0 +1,73 @@
+#
+# handles.py: allocation of the typeable handles put in the consent
+# form URLs.
+#
+# Handles are unique in the database, so the only reliable collision
+# check is inserting the client: register retries with a new handle on
+# an integrity error. To keep that rare, handles can be taken from a
+# pool of random handles that were checked against the database in a
+# single query when the pool was filled.
+#
+
+from collections import deque
+import random
+import string
+import threading
+
+import config
+from centinel.models import Client
+
+
+HANDLE_LENGTH = 8
+HANDLE_CHARS = string.digits + string.ascii_lowercase
+
+_random = random.SystemRandom()
+
+
+def generate_typeable_handle(length=HANDLE_LENGTH):
+    """Generate a random typeable (a-z, 0-9) string for consent URL."""
+    return "".join([_random.choice(HANDLE_CHARS) for _ in range(length)])
+
+
+class HandlePool(object):
+    """Pool of random handles that were not in use when the pool was
+    filled.
+
+    Params:
+
+    size- number of handles to generate at a time. A size of 0
+        disables the pool, handles are then generated on demand and
+        only checked when the client is inserted
+
+    Note: the pool is per process and handles may be taken by another
+    process or a client inserted after the pool was filled, so the
+    insert still has to be checked
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._handles = deque()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """Return a handle that is most likely not in use"""
+        if self.size <= 0:
+            return generate_typeable_handle()
+        with self._lock:
+            if not self._handles:
+                self._fill()
+            return self._handles.popleft()
+
+    def _fill(self):
+        candidates = set(generate_typeable_handle()
+                         for _ in range(self.size))
+        used = Client.query.with_entities(Client.typeable_handle).\
+            filter(Client.typeable_handle.in_(candidates))
+        candidates.difference_update(handle for handle, in used)
+        if not candidates:
+            candidates.add(generate_typeable_handle())
+        self._handles.extend(candidates)
+
+
+handle_pool = HandlePool(config.typeable_handle_pool_size)
@@ -0,0 +1,127 @@
+#
+# hash_index.py: an index of content hashes for the experiment and
+# input files, kept in memory and persisted to disk, so that listing
+# a client's files only re-hashes the files that changed.
+#
+
+from base64 import urlsafe_b64encode
+import atexit
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import config
+
+
+# read files in chunks of this size when hashing them
+CHUNK_SIZE = 64 * 1024
+
+
+def hash_file(path):
+    """Return the urlsafe base64 encoded MD5 digest of the file"""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file_p:
+        for chunk in iter(lambda: file_p.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return urlsafe_b64encode(md5.digest())
+
+
+class HashIndex(object):
+    """Map of file path to the file's digest.
+
+    An entry is only used if the size, modification time and inode of
+    the file are the same as when it was hashed. Otherwise, the file
+    is hashed again.
+
+    Params:
+
+    index_file- where the index is persisted, or None to only keep it
+        in memory
+    save_interval- minimum number of seconds between two writes of the
+        index file
+
+    """
+
+    def __init__(self, index_file, save_interval):
+        self.index_file = index_file
+        self.save_interval = save_interval
+        self._entries = None
+        self._dirty = False
+        self._last_save = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def digest(self, path):
+        stat = os.stat(path)
+        key = [stat.st_size, stat.st_mtime, stat.st_ino]
+        with self._lock:
+            if self._entries is None:
+                self._load()
+            entry = self._entries.get(path)
+        if entry is not None and entry[:3] == key:
+            return entry[3]
+
+        digest = hash_file(path)
+        with self._lock:
+            self._entries[path] = key + [digest]
+            self._dirty = True
+        return digest
+
+    def sync(self):
+        """Write the index to disk if it changed and it has not been
+        written in the last save_interval seconds"""
+        if time.time() - self._last_save >= self.save_interval:
+            self.save()
+
+    def save(self):
+        # saves are serialized so that an older snapshot of the index
+        # is never renamed over a newer one, without holding up the
+        # lookups while the file is written
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty or self.index_file is None:
+                    return
+                # forget about the files that no longer exist
+                entries = dict((path, entry) for path, entry
+                               in self._entries.iteritems()
+                               if os.path.exists(path))
+                self._entries = entries
+                self._dirty = False
+                self._last_save = time.time()
+            # write to a temporary file of our own and rename it so that
+            # other processes never see a partially written index
+            tmp_file = None
+            try:
+                tmp_fd, tmp_file = tempfile.mkstemp(
+                    prefix=os.path.basename(self.index_file) + ".",
+                    suffix=".tmp",
+                    dir=os.path.dirname(self.index_file) or ".")
+                with os.fdopen(tmp_fd, 'w') as file_p:
+                    json.dump(entries, file_p)
+                os.rename(tmp_file, self.index_file)
+            except (IOError, OSError) as exp:
+                logging.error("Error saving hash index %s: "
+                              "%s" % (self.index_file, exp))
+            finally:
+                if tmp_file is not None and os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+
+    def _load(self):
+        self._entries = {}
+        if self.index_file is None or not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, 'r') as file_p:
+                self._entries = json.load(file_p)
+        except (IOError, ValueError) as exp:
+            logging.warning("Ignoring unreadable hash index %s: "
+                            "%s" % (self.index_file, exp))
+
+
+hash_index = HashIndex(config.hash_index_file,
+                       config.hash_index_save_interval)
+atexit.register(hash_index.save)
@@ -0,0 +1,368 @@
+#
+# ingest.py: post-processing of uploaded results, off the request path.
+#
+# When a result has been stored, the upload handler adds a job for it
+# to a queue kept in a local SQLite database (config.ingest_queue_file)
+# and returns. A pool of worker processes, started by running this
+# module, takes the jobs from the queue and runs each of them through
+# the PROCESSORS: the result is decompressed and parsed, its experiment
+# and timestamps are extracted, the experiment is recorded in the
+# results table, the result is compressed and it is copied to cold
+# storage.
+#
+# A job that fails is retried with an exponential backoff, up to
+# config.ingest_max_attempts times. After that, or if the result is
+# invalid, it is kept in the queue as a dead letter that can be looked
+# at and retried from the command line.
+#
+# A worker claims a job by leasing it for config.ingest_lease seconds,
+# so the jobs of a worker that died are picked up again by another one.
+#
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+
+import config
+from centinel import client_dirs
+from centinel import compression
+from centinel import result_files
+from centinel import result_index
+
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+DEAD = 'dead'
+STATES = (PENDING, RUNNING, DONE, DEAD)
+
+# seconds a worker waits before looking for new jobs when the queue
+# is empty
+POLL_INTERVAL = 1
+
+_schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    username TEXT NOT NULL,
+    file_name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at REAL NOT NULL,
+    created REAL NOT NULL,
+    meta TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_jobs_state_available_at
+    ON jobs (state, available_at);
+"""
+
+
+class InvalidResult(Exception):
+    """The result can't be processed, no matter how often we retry"""
+    pass
+
+
+class IngestQueue(object):
+    """Queue of result processing jobs in a SQLite database.
+
+    Params:
+
+    path- the database file. It is created if it doesn't exist
+    max_attempts- number of times a job is tried before it becomes a
+        dead letter
+    retry_delay- seconds to wait before the first retry of a job. The
+        delay doubles with every attempt
+    lease- seconds a worker has to finish a job before it is given to
+        another worker
+
+    Note: each thread gets its own connection to the database
+
+    """
+
+    def __init__(self, path, max_attempts=5, retry_delay=60, lease=600):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lease = lease
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            # isolation_level=None: transactions are started explicitly
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            # a commit only has to append to the write-ahead log, which
+            # keeps enqueueing cheap for the upload handler
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(_schema)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def enqueue(self, username, file_name, path):
+        """Add a job for the result stored at path and return its id"""
+        now = time.time()
+        cursor = self._connection().execute(
+            "INSERT INTO jobs (username, file_name, path, state, "
+            "available_at, created) VALUES (?, ?, ?, ?, ?, ?)",
+            (username, file_name, path, PENDING, now, now))
+        return cursor.lastrowid
+
+    def claim(self):
+        """Lease the oldest job that is ready to run and return it as a
+        dictionary, or None if there is no such job. A job whose lease
+        ran out on its last attempt (e.g. because the result crashes or
+        hangs the worker every time) becomes a dead letter instead."""
+        conn = self._connection()
+        now = time.time()
+        # take the write lock before looking for a job so that two
+        # workers never claim the same one
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            while True:
+                row = conn.execute(
+                    "SELECT * FROM jobs WHERE state IN (?, ?) AND "
+                    "available_at <= ? ORDER BY available_at, id LIMIT 1",
+                    (PENDING, RUNNING, now)).fetchone()
+                if row is None:
+                    conn.execute("COMMIT")
+                    return None
+                if (row['state'] != RUNNING or
+                        row['attempts'] < self.max_attempts):
+                    break
+                conn.execute("UPDATE jobs SET state = ?, error = ? "
+                             "WHERE id = ?",
+                             (DEAD, "Lease expired on attempt %d" %
+                              (row['attempts']), row['id']))
+            conn.execute("UPDATE jobs SET state = ?, attempts = attempts + 1, "
+                         "available_at = ? WHERE id = ?",
+                         (RUNNING, now + self.lease, row['id']))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        job = dict(row)
+        job['attempts'] += 1
+        job['meta'] = json.loads(job['meta']) if job['meta'] else {}
+        return job
+
+    def complete(self, job):
+        self._connection().execute(
+            "UPDATE jobs SET state = ?, meta = ?, error = NULL WHERE id = ?",
+            (DONE, json.dumps(job['meta']), job['id']))
+
+    def fail(self, job, error, permanent=False):
+        """Schedule the job to be retried, or make it a dead letter if it
+        can't be retried"""
+        if permanent or job['attempts'] >= self.max_attempts:
+            state, available_at = DEAD, time.time()
+        else:
+            delay = self.retry_delay * 2 ** (job['attempts'] - 1)
+            state, available_at = PENDING, time.time() + delay
+        self._connection().execute(
+            "UPDATE jobs SET state = ?, available_at = ?, error = ? "
+            "WHERE id = ?", (state, available_at, str(error), job['id']))
+
+    def depth(self):
+        """Return the number of jobs in each state"""
+        counts = dict((state, 0) for state in STATES)
+        rows = self._connection().execute(
+            "SELECT state, COUNT(*) FROM jobs GROUP BY state")
+        for state, count in rows:
+            counts[state] = count
+        return counts
+
+    def dead_letters(self, limit=100):
+        rows = self._connection().execute(
+            "SELECT id, username, file_name, attempts, error FROM jobs "
+            "WHERE state = ? ORDER BY id LIMIT ?", (DEAD, limit))
+        return [dict(row) for row in rows]
+
+    def retry_dead(self):
+        """Put the dead letters back in the queue and return how many
+        there were"""
+        cursor = self._connection().execute(
+            "UPDATE jobs SET state = ?, attempts = 0, available_at = ? "
+            "WHERE state = ?", (PENDING, time.time(), DEAD))
+        return cursor.rowcount
+
+    def purge_done(self, older_than):
+        """Remove the finished jobs created more than older_than
+        seconds ago"""
+        cursor = self._connection().execute(
+            "DELETE FROM jobs WHERE state = ? AND created < ?",
+            (DONE, time.time() - older_than))
+        return cursor.rowcount
+
+
+def validate_result(job):
+    """Parse the result and extract its experiment and timestamps"""
+    try:
+        with result_files.open_result(job['path']) as result_file:
+            content = json.load(result_file)
+    except (IOError, OSError):
+        # e.g. the file system is not available, worth a retry
+        raise
+    except Exception as exp:
+        raise InvalidResult("Invalid result: %s" % (exp))
+    if not isinstance(content, dict):
+        raise InvalidResult("Invalid result: not a JSON object")
+    job['meta'].update(result_files.result_metadata(content))
+
+
+def index_result(job):
+    """Record the result's experiment in the results table"""
+    result_index.set_experiment(job['username'], job['file_name'],
+                                job['meta'].get('experiment'))
+
+
+def compress_result(job):
+    """Compress the result in place, if config.compress_results is
+    set"""
+    if config.compress_results:
+        compression.compress_file(job['path'])
+
+
+def archive_result(job):
+    """Copy the result to config.ingest_archive_dir, if it is set"""
+    if config.ingest_archive_dir is None:
+        return
+    directory = client_dirs.client_dir(config.ingest_archive_dir,
+                                       job['username'], create=True)
+    path = os.path.join(directory, job['file_name'])
+    tmp_path = os.path.join(directory, ".%s.tmp" % (uuid.uuid4().hex))
+    try:
+        shutil.copyfile(job['path'], tmp_path)
+        os.rename(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    job['meta']['archive_path'] = path
+
+
+# the steps each job goes through, in order
+PROCESSORS = [validate_result, index_result, compress_result,
+              archive_result]
+
+
+def process_job(queue, job):
+    """Run the job through the processors and record the outcome.
+    Returns True if the job succeeded."""
+    try:
+        if not os.path.exists(job['path']):
+            raise InvalidResult("Result %s no longer exists" % (job['path']))
+        for processor in PROCESSORS:
+            processor(job)
+    except InvalidResult as exp:
+        logging.warning("Giving up on result %s: %s" % (job['path'], exp))
+        queue.fail(job, exp, permanent=True)
+        return False
+    except Exception as exp:
+        logging.error("Error processing result %s (attempt %d): "
+                      "%s" % (job['path'], job['attempts'], exp))
+        queue.fail(job, exp)
+        return False
+    queue.complete(job)
+    return True
+
+
+def work(queue, stop=None, max_jobs=None):
+    """Process jobs until stop is set, or until max_jobs jobs have been
+    processed. Returns the number of jobs processed.
+
+    Params:
+
+    queue- the IngestQueue to take the jobs from
+    stop- a threading or multiprocessing Event, or None to run until
+        max_jobs jobs have been processed (or forever)
+    max_jobs- stop after this many jobs. With max_jobs set, the worker
+        also stops as soon as the queue is empty
+
+    """
+    processed = 0
+    while stop is None or not stop.is_set():
+        if max_jobs is not None and processed >= max_jobs:
+            break
+        job = queue.claim()
+        if job is None:
+            if max_jobs is not None:
+                break
+            time.sleep(POLL_INTERVAL)
+            continue
+        process_job(queue, job)
+        processed += 1
+    return processed
+
+
+def _worker(queue, stop):
+    # the parent stops the workers when it is interrupted, once they
+    # are done with their current job
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    work(queue, stop)
+
+
+def run_workers(queue, processes):
+    """Run a pool of worker processes until interrupted"""
+    stop = multiprocessing.Event()
+    workers = [multiprocessing.Process(target=_worker, args=(queue, stop),
+                                       name="ingest-%d" % (number))
+               for number in range(processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        stop.set()
+        for worker in workers:
+            worker.join()
+
+
+ingest_queue = IngestQueue(config.ingest_queue_file,
+                           config.ingest_max_attempts,
+                           config.ingest_retry_delay,
+                           config.ingest_lease)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+    work_parser = commands.add_parser('work', help='Run the workers')
+    work_parser.add_argument('--processes', '-p', type=int,
+                             default=config.ingest_workers,
+                             help='Number of worker processes')
+    commands.add_parser('status', help='Show the number of jobs in each '
+                        'state')
+    commands.add_parser('dead', help='List the dead letters')
+    commands.add_parser('retry', help='Put the dead letters back in the '
+                        'queue')
+    purge_parser = commands.add_parser('purge', help='Remove finished jobs')
+    purge_parser.add_argument('--days', type=int, default=7,
+                              help='Only remove jobs older than this')
+    args = parser.parse_args()
+
+    if args.command == 'work':
+        run_workers(ingest_queue, max(args.processes, 1))
+    elif args.command == 'status':
+        for state, count in sorted(ingest_queue.depth().iteritems()):
+            print "%-8s %d" % (state, count)
+    elif args.command == 'dead':
+        for job in ingest_queue.dead_letters():
+            print "%(id)d %(username)s/%(file_name)s: %(error)s" % job
+    elif args.command == 'retry':
+        print "Retrying %d jobs" % (ingest_queue.retry_dead())
+    elif args.command == 'purge':
+        removed = ingest_queue.purge_done(args.days * 24 * 60 * 60)
+        print "Removed %d jobs" % (removed)
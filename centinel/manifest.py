@@ -0,0 +1,143 @@
+#
+# manifest.py: versioned, merged views of the global, country and
+# client specific experiment and input files.
+#
+# The version of a manifest is derived from the names, sizes,
+# modification times and inodes of all the files that make it up (and
+# from the client's schedule for experiments), so it changes whenever
+# one of them is added, removed or modified. The merged file listing
+# and the file hashes are cached per version.
+#
+
+from base64 import urlsafe_b64encode
+import hashlib
+import json
+import logging
+import os
+
+import config
+from centinel.cache import LRUCache
+from centinel.client_dirs import client_dir
+from centinel.hash_index import hash_index
+from centinel.models import get_client_schedule
+
+
+SCHEDULER_FILE = "scheduler.info"
+
+# directory path -> (directory mtime, names of the files in it)
+_listing_cache = LRUCache(config.manifest_cache_size)
+# manifest version -> Manifest
+_manifest_cache = LRUCache(config.manifest_cache_size)
+
+
+class Manifest(object):
+    """The merged content of the global, country and client specific
+    directories.
+
+    Params:
+
+    version- a string that changes whenever the content changes
+    files- dictionary of file name to path. Client specific files take
+        precedence over country specific files, which take precedence
+        over global files
+    schedule- the client's scheduler.info as a JSON string, or None if
+        the manifest has no schedule
+
+    """
+
+    def __init__(self, version, files, schedule=None):
+        self.version = version
+        self.files = files
+        self.schedule = schedule
+        self._hashes = None
+
+    def hashes(self):
+        """Return a dictionary of file name to file hash"""
+        if self._hashes is None:
+            hashes = {}
+            for name, path in self.files.iteritems():
+                hashes[name] = hash_index.digest(path)
+            hash_index.sync()
+            if self.schedule is not None:
+                digest = hashlib.md5(self.schedule).digest()
+                hashes[SCHEDULER_FILE] = urlsafe_b64encode(digest)
+            self._hashes = hashes
+        return self._hashes
+
+
+def list_directory(directory):
+    """Return the names of the files in the directory, or None if it
+    doesn't exist. Listings are cached until the directory's
+    modification time changes.
+
+    """
+    try:
+        mtime = os.stat(directory).st_mtime
+    except OSError:
+        return None
+    cached = _listing_cache.get(directory)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    # hidden files (e.g. lock or temporary files) are not served, just
+    # like with glob
+    names = sorted(name for name in os.listdir(directory)
+                   if not name.startswith('.'))
+    _listing_cache.put(directory, (mtime, names))
+    return names
+
+
+def get_manifest(folder, country, username, with_schedule=False):
+    """Return the manifest for the given client
+
+    Params:
+
+    folder- the directory that contains the global, country and
+        client specific directories
+    country- the country code of the client
+    username- the username of the client
+    with_schedule- include the client's scheduler.info, merged from the
+        schedules table
+
+    """
+    files = {}
+    schedule = None
+    stamp = [folder]
+    if with_schedule:
+        freqs = get_client_schedule(country, username)
+        if freqs:
+            schedule = json.dumps(freqs, sort_keys=True)
+        stamp.append(schedule)
+    directories = [("global", os.path.join(folder, "global"))]
+    if country is not None:
+        directories.append(("country", os.path.join(folder, country)))
+    directories.append(("client", client_dir(folder, username)))
+    for scope, directory in directories:
+        names = list_directory(directory)
+        if names is None:
+            if scope == "global":
+                logging.warning("Global baseline folder \"%s\" "
+                                "doesn't exist!" % (directory))
+            elif scope == "country":
+                logging.warning("Country baseline folder %s "
+                                "doesn't exist!" % (directory))
+            continue
+        for name in names:
+            # the schedule lives in the database, leftover
+            # scheduler.info files are ignored
+            if with_schedule and name == SCHEDULER_FILE:
+                continue
+            path = os.path.join(directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                # removed since the directory was listed
+                continue
+            stamp.append((path, stat.st_size, stat.st_mtime, stat.st_ino))
+            files[name] = path
+
+    version = hashlib.sha1(repr(stamp)).hexdigest()
+    manifest = _manifest_cache.get(version)
+    if manifest is None:
+        manifest = Manifest(version, files, schedule)
+        _manifest_cache.put(version, manifest)
+    return manifest
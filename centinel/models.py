@@ -1,7 +1,9 @@
 from datetime import datetime
 from passlib.apps import custom_app_context as pwd_context
+from sqlalchemy import event
 
 import centinel
+from centinel.cache import credential_cache
 db = centinel.db
 app = centinel.app
 
@@ -9,6 +11,7 @@ app = centinel.app
 # 15 chars for ip + 4 for netmask
 IP_ADDR_LEN = 19
 COUNTRY_CODE_LEN = 2
+EXPERIMENT_NAME_LEN = 64
 
 
 roles_tab = db.Table('roles_tab',
@@ -20,6 +23,9 @@ roles_tab = db.Table('roles_tab',
 
 class Client(db.Model):
     __tablename__ = 'clients'
+    # used to find the active clients in a country
+    __table_args__ = (db.Index('ix_clients_country_last_seen',
+                               'country', 'last_seen'),)
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(36), index=True)  # uuid length=36
     password_hash = db.Column(db.String(130))
@@ -28,7 +34,7 @@ class Client(db.Model):
     registered_date = db.Column(db.DateTime)
     has_given_consent = db.Column(db.Boolean)
     date_given_consent = db.Column(db.DateTime)
-    typeable_handle = db.Column(db.String(8))
+    typeable_handle = db.Column(db.String(8), index=True, unique=True)
     is_vpn = db.Column(db.Boolean)
     dont_display = db.Column(db.Boolean)
     country = db.Column(db.String(COUNTRY_CODE_LEN))
@@ -86,6 +92,96 @@ class Client(db.Model):
         return pwd_context.verify(password, self.password_hash)
 
 
+def invalidate_cached_credentials(target, *args):
+    """Drop any cached password verifications for the client whenever
+    their password or roles are changed"""
+    if target.username is not None:
+        credential_cache.invalidate_user(target.username)
+
+event.listen(Client.password_hash, 'set', invalidate_cached_credentials)
+for roles_event in ('append', 'remove', 'set'):
+    event.listen(Client.roles, roles_event, invalidate_cached_credentials)
+
+
+class Schedule(db.Model):
+    """How often an experiment runs, for all clients (scope 'global'),
+    the clients of a country (scope 'country', the scope key is the
+    country code) or a single client (scope 'client', the scope key is
+    the username)"""
+    __tablename__ = 'schedules'
+    __table_args__ = (db.UniqueConstraint('scope', 'scope_key',
+                                          'experiment'),)
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(8), nullable=False)
+    scope_key = db.Column(db.String(36), nullable=False, default='')
+    experiment = db.Column(db.String(64), nullable=False)
+    frequency = db.Column(db.Integer)  # seconds
+    last_run = db.Column(db.Integer, default=0)
+
+    def __init__(self, scope, scope_key, experiment, frequency,
+                 last_run=0):
+        self.scope = scope
+        self.scope_key = scope_key
+        self.experiment = experiment
+        self.frequency = frequency
+        self.last_run = last_run
+
+
+# scopes in increasing order of precedence
+SCHEDULE_SCOPES = ['global', 'country', 'client']
+
+
+def get_client_schedule(country, username):
+    """Return the merged schedule of a client, i.e. the content of the
+    scheduler.info sent to the client. Country schedules take
+    precedence over global ones and client schedules take precedence
+    over both.
+
+    """
+    rows = Schedule.query.filter(db.or_(
+        db.and_(Schedule.scope == 'global', Schedule.scope_key == ''),
+        db.and_(Schedule.scope == 'country', Schedule.scope_key == country),
+        db.and_(Schedule.scope == 'client', Schedule.scope_key == username)))
+    freqs = {}
+    for row in sorted(rows, key=lambda row: SCHEDULE_SCOPES.index(row.scope)):
+        freqs[row.experiment] = {'last_run': row.last_run,
+                                 'frequency': row.frequency}
+    return freqs
+
+
+class Result(db.Model):
+    """A result uploaded by a client. The row is written when the
+    result is stored, the experiment is filled in when the result is
+    ingested (see ingest.py) or backfilled (see result_index.py)"""
+    __tablename__ = 'results'
+    __table_args__ = (db.UniqueConstraint('username', 'file_name'),
+                      db.Index('ix_results_experiment_country_uploaded',
+                               'experiment', 'country', 'uploaded'),
+                      db.Index('ix_results_country_uploaded',
+                               'country', 'uploaded'))
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(36), nullable=False)
+    file_name = db.Column(db.String(255), nullable=False)
+    experiment = db.Column(db.String(EXPERIMENT_NAME_LEN))
+    # the client's country when the result was uploaded
+    country = db.Column(db.String(COUNTRY_CODE_LEN))
+    uploaded = db.Column(db.DateTime, nullable=False)
+    size = db.Column(db.BigInteger)
+    sha256 = db.Column(db.String(64))
+    path = db.Column(db.String(1024))
+
+    def __init__(self, username, file_name, uploaded, size=None,
+                 sha256=None, path=None, country=None, experiment=None):
+        self.username = username
+        self.file_name = file_name
+        self.uploaded = uploaded
+        self.size = size
+        self.sha256 = sha256
+        self.path = path
+        self.country = country
+        self.experiment = experiment
+
+
 class Role(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(20))
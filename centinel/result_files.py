@@ -0,0 +1,126 @@
+#
+# result_files.py: helpers to list and read the result files stored in the
+# clients' results directories.
+#
+
+import glob
+import heapq
+import json
+import logging
+import os
+
+from centinel import compression
+
+
+# result files that start with an underscore are temporary or
+# internal files and are never returned to clients
+RESULT_PATTERN = '[!_]*.json'
+SORT_KEYS = ('name', 'mtime')
+
+
+def result_name(path):
+    """Return the name a result is returned under (its file name without
+    the extension)"""
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def iter_result_paths(user_dir):
+    return glob.iglob(os.path.join(user_dir, RESULT_PATTERN))
+
+
+def open_result(path):
+    """Open the result file for reading, decompressing it on the fly if
+    it is stored compressed"""
+    return compression.open_file(path)
+
+
+def load_result(path):
+    """Return the parsed content of the result file, or None if it
+    can't be read"""
+    try:
+        with open_result(path) as result_file:
+            return json.load(result_file)
+    except Exception, e:
+        logging.error("Results: Couldn't open results file - %s - %s"
+                      % (path, str(e)))
+    return None
+
+
+def result_metadata(content):
+    """Return the experiment, start and end time of the parsed result.
+    The experiment is the exp_name of the result's meta section, or else
+    the first of its top level keys."""
+    meta = content.get('meta')
+    if not isinstance(meta, dict):
+        meta = {}
+    experiments = sorted(key for key in content if key != 'meta')
+    return {'experiment': meta.get('exp_name') or (
+                experiments[0] if experiments else None),
+            'start_time': meta.get('start_time'),
+            'end_time': meta.get('end_time')}
+
+
+def _sort_key(path, sort):
+    name = result_name(path)
+    if sort == 'mtime':
+        try:
+            return (os.path.getmtime(path), name)
+        except OSError:
+            # removed since it was listed
+            return None
+    return (name,)
+
+
+def format_cursor(key):
+    if len(key) == 2:
+        return "%r:%s" % key
+    return key[0]
+
+
+def parse_cursor(cursor, sort):
+    """Turn a cursor returned by select_page back into a sort key.
+    Raises ValueError if the cursor is malformed."""
+    if sort == 'mtime':
+        mtime, name = cursor.split(':', 1)
+        return (float(mtime), name)
+    return (cursor,)
+
+
+def select_page(user_dir, sort='name', cursor=None, limit=None):
+    """Return the paths of the results that come after the cursor in the
+    given sort order, and the cursor for the next page (None if this is
+    the last page).
+
+    Only the sort keys of at most limit + 1 results are kept in memory
+    while the directory is scanned, no result is read.
+
+    Params:
+
+    user_dir- the client's results directory
+    sort- 'name' or 'mtime'
+    cursor- the cursor returned with the previous page, or None to
+        start from the beginning
+    limit- maximum number of results in the page, or None for all
+
+    """
+    after = None
+    if cursor is not None:
+        after = parse_cursor(cursor, sort)
+
+    def keyed_paths():
+        for path in iter_result_paths(user_dir):
+            key = _sort_key(path, sort)
+            if key is None or (after is not None and key <= after):
+                continue
+            yield key, path
+
+    if limit is None:
+        page = sorted(keyed_paths())
+    else:
+        page = heapq.nsmallest(limit + 1, keyed_paths())
+
+    next_cursor = None
+    if limit is not None and len(page) > limit:
+        page = page[:limit]
+        next_cursor = format_cursor(page[-1][0])
+    return [path for _, path in page], next_cursor
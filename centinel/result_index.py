@@ -0,0 +1,246 @@
+#
+# result_index.py: the results table, an index of the results stored in
+# the clients' results directories.
+#
+# A row is added in the same transaction as the upload that stores the
+# result, so questions like "all http_request results from IR in the
+# last week" are answered by an indexed query instead of a walk over
+# every client's directory. The experiment of a result is only known
+# once its content is parsed, which is done by the ingestion workers
+# (see ingest.py) or when backfilling.
+#
+# Running this module backfills the table from the results that were
+# uploaded before it existed, queries it, or removes the deduplicated
+# results (see config.dedup_results) that are no longer linked.
+#
+
+import argparse
+from datetime import datetime, timedelta
+import hashlib
+import json
+import logging
+import os
+
+from sqlalchemy.exc import IntegrityError
+
+import config
+from centinel import blobstore
+from centinel import client_dirs
+from centinel import db
+from centinel import result_files
+from centinel.models import EXPERIMENT_NAME_LEN, Client, Result
+
+
+# read files in chunks of this size when hashing them
+CHUNK_SIZE = 64 * 1024
+# number of rows to insert per transaction when backfilling
+BATCH_SIZE = 1000
+# result blobs that were added less than this many seconds ago are not
+# garbage collected, the upload that added them may not have linked
+# them yet
+BLOB_MIN_AGE = 60 * 60
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file_p:
+        for chunk in iter(lambda: file_p.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def record_result(username, file_name, path, size, sha256, country,
+                  uploaded=None):
+    """Add the row of a result to the session, or update it if the
+    client already uploaded a result with the same name. The row is
+    flushed but not committed, the caller commits it once the result
+    is in place.
+
+    """
+    if uploaded is None:
+        uploaded = datetime.now()
+    for attempt in range(2):
+        row = Result.query.filter_by(username=username,
+                                     file_name=file_name).first()
+        if row is None:
+            row = Result(username, file_name, uploaded)
+            db.session.add(row)
+        row.uploaded = uploaded
+        row.size = size
+        row.sha256 = sha256
+        row.path = path
+        row.country = country
+        # the new content has not been parsed yet
+        row.experiment = None
+        try:
+            db.session.flush()
+            return row
+        except IntegrityError:
+            # the same result was uploaded concurrently, update the row
+            # that was inserted by the other request
+            db.session.rollback()
+            if attempt:
+                raise
+
+
+def find_existing(username, digests):
+    """Return the names of the results the client already uploaded with
+    the given content
+
+    Params:
+
+    username- the client
+    digests- dictionary of file name to the hex SHA-256 digest of the
+        content
+
+    """
+    if not digests:
+        return set()
+    rows = db.session.query(Result.file_name, Result.sha256, Result.path).\
+        filter(Result.username == username).\
+        filter(Result.file_name.in_(list(digests)))
+    return set(name for name, sha256, path in rows
+               if sha256 is not None and sha256 == digests[name].lower() and
+               path is not None and os.path.exists(path))
+
+
+def set_experiment(username, file_name, experiment):
+    """Record the experiment of a result that has been parsed"""
+    if experiment is not None:
+        experiment = experiment[:EXPERIMENT_NAME_LEN]
+    results = Result.__table__
+    with db.engine.begin() as conn:
+        conn.execute(results.update().
+                     where(results.c.username == username).
+                     where(results.c.file_name == file_name).
+                     values(experiment=experiment))
+
+
+def find_results(experiment=None, country=None, since=None, until=None,
+                 username=None):
+    """Return a query for the results matching all of the given
+    criteria, oldest first
+
+    Params:
+
+    experiment- name of the experiment
+    country- country code of the client when the result was uploaded
+    since, until- range of upload times (datetime)
+    username- the client who uploaded the results
+
+    """
+    query = Result.query
+    if experiment is not None:
+        query = query.filter(Result.experiment == experiment)
+    if country is not None:
+        query = query.filter(Result.country == country)
+    if since is not None:
+        query = query.filter(Result.uploaded >= since)
+    if until is not None:
+        query = query.filter(Result.uploaded < until)
+    if username is not None:
+        query = query.filter(Result.username == username)
+    return query.order_by(Result.uploaded, Result.id)
+
+
+def parse_experiment(path):
+    """Return the experiment of the result file, or None if it can't be
+    parsed"""
+    try:
+        with result_files.open_result(path) as result_file:
+            content = json.load(result_file)
+    except Exception as exp:
+        logging.warning("Can't parse result %s: %s" % (path, exp))
+        return None
+    if not isinstance(content, dict):
+        return None
+    experiment = result_files.result_metadata(content)['experiment']
+    if experiment is not None:
+        experiment = experiment[:EXPERIMENT_NAME_LEN]
+    return experiment
+
+
+def backfill(results_dir, parse=True):
+    """Add the rows of the results that are not in the table yet and
+    return how many were added. The upload time of a result is the
+    modification time of its file and its country is the current
+    country of the client.
+
+    Params:
+
+    results_dir- the directory that contains the clients' results
+        directories
+    parse- parse the results to find their experiment
+
+    """
+    added = 0
+    pending = 0
+    clients = db.session.query(Client.username, Client.country).all()
+    for username, country in clients:
+        if not username:
+            continue
+        user_dir = client_dirs.client_dir(results_dir, username)
+        indexed = set(name for name, in
+                      db.session.query(Result.file_name).
+                      filter(Result.username == username))
+        for path in result_files.iter_result_paths(user_dir):
+            file_name = os.path.basename(path)
+            if file_name in indexed:
+                continue
+            try:
+                stat = os.stat(path)
+                sha256 = file_sha256(path)
+            except (IOError, OSError) as exp:
+                logging.warning("Skipping result %s: %s" % (path, exp))
+                continue
+            row = Result(username, file_name,
+                         datetime.fromtimestamp(stat.st_mtime),
+                         stat.st_size, sha256, path, country)
+            if parse:
+                row.experiment = parse_experiment(path)
+            db.session.add(row)
+            added += 1
+            pending += 1
+            if pending >= BATCH_SIZE:
+                db.session.commit()
+                pending = 0
+    db.session.commit()
+    return added
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+    backfill_parser = commands.add_parser(
+        'backfill', help='Index the results that are not in the table yet')
+    backfill_parser.add_argument('--no-parse', action='store_true',
+                                 help="Don't parse the results to find "
+                                 "their experiment")
+    query_parser = commands.add_parser(
+        'query', help='Print the paths of the matching results')
+    query_parser.add_argument('--experiment', '-e', default=None)
+    query_parser.add_argument('--country', '-c', default=None)
+    query_parser.add_argument('--days', '-d', type=int, default=None,
+                              help='Only results uploaded in the last '
+                              'DAYS days')
+    query_parser.add_argument('--client', default=None,
+                              help='Only results of this client')
+    commands.add_parser('collect-blobs', help='Remove the deduplicated '
+                        'results no client links to anymore')
+    args = parser.parse_args()
+
+    if args.command == 'collect-blobs':
+        removed = blobstore.collect_garbage(config.result_blob_dir,
+                                            BLOB_MIN_AGE)
+        print "Removed %d results" % (removed)
+    elif args.command == 'backfill':
+        added = backfill(config.results_dir, parse=not args.no_parse)
+        print "Indexed %d results" % (added)
+    elif args.command == 'query':
+        since = None
+        if args.days is not None:
+            since = datetime.now() - timedelta(days=args.days)
+        query = find_results(args.experiment, args.country, since,
+                             username=args.client)
+        for row in query.yield_per(BATCH_SIZE):
+            print row.path
@@ -0,0 +1,220 @@
+#
+# uploads.py: chunked, resumable result uploads.
+#
+# An upload is made of two files in the client's results directory:
+# "_upload-<id>.part" holds the bytes received so far and
+# "_upload-<id>.meta" holds the name the result will be stored
+# under. Both start with an underscore so that they are never picked
+# up as results. Chunks are appended at the current offset and hashed
+# as they are written, and once the client has sent everything and the
+# checksum matches, the part file is renamed into place.
+#
+
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+import config
+from centinel.cache import LRUCache
+
+
+UPLOAD_PREFIX = "_upload-"
+# read request bodies in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+# hashing state of the uploads in progress in this process, so that
+# each chunk is only hashed once: part file path -> (offset, hasher)
+_hashers = LRUCache(1024)
+_upload_id_reg = re.compile("^[0-9a-f]{32}$")
+
+
+class UploadError(Exception):
+    """Error with a chunked upload. The status is the HTTP status code
+    to answer the request with"""
+
+    def __init__(self, message, status=400, offset=None):
+        super(UploadError, self).__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def part_path(user_dir, upload_id):
+    if not _upload_id_reg.match(upload_id):
+        raise UploadError("Invalid upload id", 404)
+    path = os.path.join(user_dir, UPLOAD_PREFIX + upload_id + ".part")
+    if not os.path.exists(path):
+        raise UploadError("Unknown upload", 404)
+    return path
+
+
+def start_upload(user_dir, file_name, size=None):
+    """Create a new upload for a result named file_name and return its
+    id
+
+    Params:
+
+    user_dir- the client's results directory
+    file_name- the (already sanitized) name to store the result under
+    size- the total size the client intends to send, if known
+
+    """
+    if size is not None and size > config.max_result_size:
+        raise UploadError("Result is too large", 413)
+    expire_uploads(user_dir)
+
+    upload_id = uuid.uuid4().hex
+    base = os.path.join(user_dir, UPLOAD_PREFIX + upload_id)
+    with open(base + ".meta", 'w') as file_p:
+        json.dump({'file_name': file_name, 'size': size}, file_p)
+    open(base + ".part", 'wb').close()
+    return upload_id
+
+
+def temp_path(user_dir):
+    """Return a path for a temporary file in the client's results
+    directory that is never picked up as a result"""
+    return os.path.join(user_dir, UPLOAD_PREFIX + uuid.uuid4().hex + ".tmp")
+
+
+def save_stream(stream, path):
+    """Write the content of the stream to path and return its size and
+    SHA-256 digest"""
+    hasher = hashlib.sha256()
+    size = 0
+    with open(path, 'wb') as file_p:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            size += len(chunk)
+            file_p.write(chunk)
+            hasher.update(chunk)
+    return size, hasher.hexdigest()
+
+
+def upload_offset(user_dir, upload_id):
+    """Return the number of bytes received so far"""
+    return os.path.getsize(part_path(user_dir, upload_id))
+
+
+def append_chunk(user_dir, upload_id, offset, stream):
+    """Append the content of stream to the upload and return the new
+    offset.
+
+    The offset must be the number of bytes received so far, so that a
+    client that lost a response can find out where to resume from
+    instead of corrupting the upload.
+
+    """
+    path = part_path(user_dir, upload_id)
+    with open(path, 'ab') as file_p:
+        # only one request may append to an upload at a time
+        fcntl.flock(file_p, fcntl.LOCK_EX)
+        _check_not_finished(path, file_p)
+        current = os.fstat(file_p.fileno()).st_size
+        if offset != current:
+            raise UploadError("Offset mismatch", 409, current)
+
+        hasher = _get_hasher(path, current)
+        written = current
+        try:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                written += len(chunk)
+                if written > config.max_result_size:
+                    raise UploadError("Result is too large", 413, current)
+                file_p.write(chunk)
+                hasher.update(chunk)
+            file_p.flush()
+        except Exception:
+            # throw away the partial chunk so the client can resend it
+            file_p.truncate(current)
+            _hashers.pop(path)
+            raise
+        _hashers.put(path, (written, hasher))
+    return written
+
+
+def finish_upload(user_dir, upload_id, checksum):
+    """Check that the upload is complete and return the path of the
+    received file, the file name to store it under and its SHA-256
+    digest. The caller is responsible for moving the file into place.
+
+    """
+    path = part_path(user_dir, upload_id)
+    meta_path = path[:-len(".part")] + ".meta"
+    with open(path, 'rb') as part_file:
+        # take the lock append_chunk holds, so that no chunk is
+        # appended while the upload is checked and moved away
+        fcntl.flock(part_file, fcntl.LOCK_EX)
+        _check_not_finished(path, part_file)
+        with open(meta_path, 'r') as file_p:
+            meta = json.load(file_p)
+
+        size = os.fstat(part_file.fileno()).st_size
+        if meta['size'] is not None and size != meta['size']:
+            raise UploadError("Upload is incomplete", 409, size)
+        digest = _get_hasher(path, size).hexdigest()
+        if checksum is None or checksum.lower() != digest:
+            raise UploadError("Checksum mismatch", 422, size)
+
+        # requests for this upload that are waiting for the lock find
+        # that it is gone
+        tmp_path = temp_path(user_dir)
+        os.rename(path, tmp_path)
+        _hashers.pop(path)
+        os.remove(meta_path)
+    return tmp_path, meta['file_name'], digest
+
+
+def expire_uploads(user_dir):
+    """Remove the uploads that have not been touched in
+    config.upload_expiry seconds. An upload is touched when a chunk is
+    appended to its part file, so the meta file of an upload goes with
+    its part file, whatever its own age."""
+    cutoff = time.time() - config.upload_expiry
+    for path in glob.glob(os.path.join(user_dir, UPLOAD_PREFIX + "*")):
+        age_path = path
+        if path.endswith(".meta"):
+            part = path[:-len(".meta")] + ".part"
+            if os.path.exists(part):
+                age_path = part
+        try:
+            if os.path.getmtime(age_path) < cutoff:
+                os.remove(path)
+        except OSError:
+            # removed by a concurrent request
+            pass
+
+
+def _check_not_finished(path, file_p):
+    """Raise an UploadError if the upload file_p was opened for has
+    been finished (or expired) while we were waiting for its lock"""
+    try:
+        current = os.stat(path)
+    except OSError:
+        raise UploadError("Unknown upload", 404)
+    if current.st_ino != os.fstat(file_p.fileno()).st_ino:
+        raise UploadError("Unknown upload", 404)
+
+
+def _get_hasher(path, offset):
+    """Return a hasher that has consumed the first offset bytes of the
+    part file. If the previous chunks were received by another process,
+    they are hashed again from disk.
+
+    """
+    cached = _hashers.get(path)
+    if cached is not None and cached[0] == offset:
+        return cached[1].copy()
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as file_p:
+        remaining = offset
+        while remaining > 0:
+            chunk = file_p.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            hasher.update(chunk)
+            remaining -= len(chunk)
+    return hasher
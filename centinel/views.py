@@ -1,26 +1,40 @@
 from base64 import urlsafe_b64decode, urlsafe_b64encode
 import config
+import csv
+from cStringIO import StringIO
 from datetime import datetime
 import flask
 import GeoIP
 import geoip2.errors
 import geoip2.database
-import glob
-import hashlib
 import json
 import logging
-from netaddr import IPNetwork
+from netaddr import AddrFormatError, IPAddress, IPNetwork
 import os
 import random
 import re
-import requests
-import string
+from sqlalchemy.exc import IntegrityError
+import threading
 from werkzeug import secure_filename
+from werkzeug.http import http_date
 
 
 # local imports
+from centinel import blobstore
+from centinel import client_dirs
+from centinel import compression
+from centinel import consent
 from centinel import constants
+from centinel import freedom_house
+from centinel import ingest
+from centinel import result_files
+from centinel import result_index
+from centinel import uploads
+from centinel.cache import LRUCache, credential_cache
+from centinel.handles import handle_pool
+from centinel.manifest import get_manifest
 from centinel.models import Client, Role
+from centinel.write_behind import client_info_buffer
 
 import centinel
 app = centinel.app
@@ -46,48 +60,109 @@ except Exception as exp:
                      "of each ASN database file to enable this feature."))
     as_lookup = None
 
+if config.compress_results and config.dedup_results:
+    logging.warning("compress_results and dedup_results are both set. "
+                    "Deduplicated results are stored as they were "
+                    "uploaded, so results will not be compressed.")
 
-def normalize_ip(ip):
-    """Take in an IP as a string in CIDR format or without subnet
-    and normalize to a single IP for lookups
+# (country, ASN, AS owner) for each /24 or /48 that has been looked up
+ip_info_cache = LRUCache(config.ip_info_cache_size)
+
+
+_dotted_quad_reg = re.compile("^([0-9]{1,3})\.([0-9]{1,3})\.([0-9]{1,3})"
+                              "\.([0-9]{1,3})(?:/([0-9]{1,2}))?$")
+
+
+def aggregate_ip(ip):
+    """Return the address of the /24 (/48 for IPv6) that contains the
+    given IP, which is given as a string in CIDR format or without
+    subnet. Raises ValueError if it is not a valid IP.
 
     """
-    net = IPNetwork(ip)
-    ip = str(net[0])
-    return ip
+    # skip building an IPNetwork for the common case
+    match = _dotted_quad_reg.match(ip)
+    if match is not None:
+        octets = [int(octet) for octet in match.groups()[:4]]
+        prefix_len = match.group(5)
+        if (all(octet <= 255 for octet in octets) and
+                (prefix_len is None or int(prefix_len) <= 32)):
+            return "%d.%d.%d.0" % tuple(octets[:3])
+    try:
+        net = IPNetwork(ip)
+    except (AddrFormatError, TypeError, ValueError):
+        raise ValueError("Invalid IP address: %r" % (ip,))
+    if net.version == 4 or net.ip.is_ipv4_mapped():
+        return str(IPAddress(net.first >> 8 << 8 & 0xffffffff, 4))
+    return str(IPAddress(net.first >> 80 << 80, 6))
 
 
-def get_country_from_ip(ip):
-    """Return the country for the given ip"""
-    ip = normalize_ip(ip)
+def lookup_ip_info(ip):
+    """Return the country, ASN and AS owner for the given IP.
+
+    Since we only keep track of clients' IP addresses at the /24
+    level, lookups are done for the /24 (/48 for IPv6) that contains
+    the IP and cached per /24. That is, the databases are queried with
+    the first address of the /24, not with the client's own address,
+    and every address in a /24 gets the same answer.
+
+    An invalid IP gets the same answer as an address that is not in
+    the databases.
+
+    """
+    try:
+        aggregate = aggregate_ip(ip)
+    except ValueError as exp:
+        logging.warning("Can't look up %s" % (exp))
+        return ('--', None, None)
+    info = ip_info_cache.get(aggregate)
+    if info is None:
+        info = (lookup_country(aggregate),) + lookup_asn(aggregate)
+        ip_info_cache.put(aggregate, info)
+    return info
+
+
+def lookup_country(ip):
     try:
         return reader.country(ip).country.iso_code
     # if we have disabled geoip support, reader should be None, so the
     # exception should be triggered
     except (geoip2.errors.AddressNotFoundError,
-            geoip2.errors.GeoIP2Error, AttributeError):
+            geoip2.errors.GeoIP2Error, AttributeError, ValueError):
         return '--'
 
 
-def get_asn_from_ip(ip, asn_reg=re.compile("AS(?P<asn>[0-9]+)")):
-    """Get the owner and ASN for the IP"""
-    ip = normalize_ip(ip)
+def lookup_asn(ip, asn_reg=re.compile("AS(?P<asn>[0-9]+)")):
     if as_lookup is None:
         return None, None
     owner = as_lookup.org_by_addr(ip)
     asn = None
     if owner is not None:
-        asn = asn_reg.match(owner).group('asn')
+        match = asn_reg.match(owner)
+        if match is not None:
+            asn = match.group('asn')
     return asn, owner
 
 
-def generate_typeable_handle(length=8):
-    """Generate a random typeable (a-z, 1-9) string for consent URL."""
-    return "".join([random.choice(string.digits +
-                    string.ascii_lowercase) for _ in range(length)])
+def get_country_from_ip(ip):
+    """Return the country for the given ip"""
+    return lookup_ip_info(ip)[0]
+
 
+def get_asn_from_ip(ip):
+    """Get the owner and ASN for the IP"""
+    return lookup_ip_info(ip)[1:]
 
-def update_client_info(username, ip, country=None):
+
+def is_admin(username):
+    """Return True if the client with the given username has the admin
+    role"""
+    admin = db.session.query(Client.id).join(Client.roles).\
+        filter(Client.username == username).\
+        filter(Role.name == 'admin').first()
+    return admin is not None
+
+
+def update_client_info(username, ip, country=None, synchronous=False):
     """Update client's information upon contact.
     This information includes their IP address,
     time when last seen, and country.
@@ -96,14 +171,31 @@ def update_client_info(username, ip, country=None):
 
     username-   username of the client who contaced.
     ip-         IP address of the client
+    country-    country explicitly set by the client, or None to
+                geolocate the client's IP address
+    synchronous- write the change to the database before returning
+                even if the write-behind buffer is enabled
+
+    Note: if config.client_info_write_behind is set, the update is
+    buffered and written later in bulk, unless the client explicitly
+    sets their country or synchronous is set.
 
     """
+    # aggregate the ip to /24
+    last_ip = ".".join(ip.split(".")[:3]) + ".0/24"
+    if (config.client_info_write_behind and country is None and
+            not synchronous):
+        client_info_buffer.record(username, last_ip, datetime.now(),
+                                  get_country_from_ip(ip))
+        return
+
     client = Client.query.filter_by(username=username).first()
     if client is None:
         # this should never happen
         return
-    # aggregate the ip to /24
-    client.last_ip = ".".join(ip.split(".")[:3]) + ".0/24"
+    # a buffered update for this client is older than this one
+    client_info_buffer.discard(username)
+    client.last_ip = last_ip
     client.last_seen = datetime.now()
     # if the client explicitely sets their country,
     # update the value based on that (used by VPN).
@@ -161,43 +253,297 @@ def submit_result():
     if not client.has_given_consent:
         flask.abort(418)
 
-    # TODO: overwrite file if exists?
+    # a result that was uploaded before is only stored again if its
+    # content changed (see store_result)
     result_file = flask.request.files['result']
-    client_dir = username
 
-    # we assume that the directory was created when the user
-    # registered
+    # the client's directory is created with their first result
     file_name = secure_filename(result_file.filename)
-    file_path = os.path.join(config.results_dir, client_dir, file_name)
+    user_dir = client_dirs.client_dir(config.results_dir, username,
+                                      create=True)
 
-    result_file.save(file_path)
+    # write to a temporary file first so that a partially received
+    # result is never visible under its final name
+    tmp_path = uploads.temp_path(user_dir)
+    size, digest = uploads.save_stream(result_file.stream, tmp_path)
+    store_result(client, file_name, tmp_path, size, digest)
 
     return flask.jsonify({"status": "success"}), 201
 
 
+def store_result(client, file_name, tmp_path, size, digest):
+    """Move a fully received result file into the client's results
+    directory under the given name, record it in the results table and
+    return its path
+
+    Params:
+
+    client- the Client who uploaded the result
+    file_name- the (already sanitized) name to store the result under
+    tmp_path- where the result was received
+    size- the size of the result in bytes, as uploaded
+    digest- the hex SHA-256 digest of the result, as uploaded
+
+    Note: the result is stored as it was uploaded. With
+    config.compress_results set, it is compressed later by the
+    ingestion workers, or right away if config.ingest_results isn't
+    set. With config.dedup_results set, results with the same content
+    are stored once, as uploaded, and linked into the clients'
+    directories
+
+    """
+    username = client.username
+    file_path = os.path.join(client_dirs.client_dir(config.results_dir,
+                                                    username), file_name)
+    # the client sent a result we already have, e.g. because it lost our
+    # response to the previous upload
+    if result_index.find_existing(username, {file_name: digest}):
+        os.remove(tmp_path)
+        return file_path
+
+    # the row is only committed once the result is in place
+    try:
+        result_index.record_result(username, file_name, file_path, size,
+                                   digest, client.country)
+        if config.dedup_results:
+            blobstore.add_and_link(tmp_path, digest, file_path,
+                                   config.result_blob_dir)
+        else:
+            os.rename(tmp_path, file_path)
+    except Exception:
+        db.session.rollback()
+        raise
+    db.session.commit()
+    # the result is processed later by the ingestion workers
+    if config.ingest_results:
+        try:
+            ingest.ingest_queue.enqueue(username, file_name, file_path)
+        except Exception as exp:
+            logging.error("Error queueing result %s for ingestion: "
+                          "%s" % (file_path, exp))
+    elif config.compress_results:
+        # there are no workers to compress it later. The result is
+        # stored either way, it is left uncompressed on error
+        try:
+            compression.compress_file(file_path)
+        except Exception as exp:
+            logging.error("Error compressing result %s: %s" %
+                          (file_path, exp))
+    return file_path
+
+
+@app.route("/results/exists", methods=['POST'])
+@auth.login_required
+def check_results():
+    """Tell the client which results the server already has, so that
+    it can skip uploading them. The request body is a JSON object with
+    the name and the hex SHA-256 digest of each result:
+
+    {"results": [{"filename": ..., "sha256": ...}, ...]}
+
+    The response maps each filename to true if the client already
+    uploaded a result with that name and content, false otherwise.
+
+    """
+    username = flask.request.authorization.username
+    update_client_info(username, flask.request.remote_addr)
+    require_consent(username)
+
+    check_json = flask.request.get_json(silent=True) or {}
+    results = check_json.get('results')
+    if (not isinstance(results, list) or
+            len(results) > config.results_page_max):
+        flask.abort(400)
+    # name sent by the client -> (stored name, digest)
+    names = {}
+    for result in results:
+        if not isinstance(result, dict):
+            flask.abort(400)
+        name = result.get('filename')
+        digest = result.get('sha256')
+        if (not isinstance(name, basestring) or
+                not isinstance(digest, basestring)):
+            flask.abort(400)
+        file_name = secure_filename(name)
+        if not file_name:
+            flask.abort(400)
+        names[name] = (file_name, digest.lower())
+
+    existing = result_index.find_existing(
+        username, dict(names.itervalues()))
+    return flask.jsonify({"results": dict(
+        (name, file_name in existing)
+        for name, (file_name, _) in names.iteritems())})
+
+
+def require_consent(username):
+    """Abort the request if the client hasn't given informed consent"""
+    client = Client.query.filter_by(username=username).first()
+    if not client.has_given_consent:
+        flask.abort(418)
+    return client
+
+
+def upload_error(exp):
+    json_resp = {"error": str(exp)}
+    if exp.offset is not None:
+        json_resp["offset"] = exp.offset
+    return flask.make_response(flask.jsonify(json_resp), exp.status)
+
+
+@app.route("/results/uploads", methods=['POST'])
+@auth.login_required
+def start_result_upload():
+    """Start a chunked, resumable result upload. The request body is a
+    JSON object with the result's filename and optionally its total
+    size in bytes.
+
+    """
+    username = flask.request.authorization.username
+    update_client_info(username, flask.request.remote_addr)
+    require_consent(username)
+
+    upload_json = flask.request.get_json(silent=True) or {}
+    file_name = secure_filename(upload_json.get('filename') or '')
+    size = upload_json.get('size')
+    if size is not None and (isinstance(size, bool) or
+                             not isinstance(size, (int, long)) or size < 0):
+        flask.abort(400)
+    if not file_name:
+        flask.abort(400)
+
+    user_dir = client_dirs.client_dir(config.results_dir, username,
+                                      create=True)
+    try:
+        upload_id = uploads.start_upload(user_dir, file_name, size)
+    except uploads.UploadError as exp:
+        return upload_error(exp)
+    return flask.jsonify({"upload_id": upload_id, "offset": 0}), 201
+
+
+@app.route("/results/uploads/<upload_id>")
+@auth.login_required
+def get_result_upload(upload_id):
+    """Return how many bytes of the upload have been received, i.e. the
+    offset to resume the upload from"""
+    username = flask.request.authorization.username
+    user_dir = client_dirs.client_dir(config.results_dir, username)
+    try:
+        offset = uploads.upload_offset(user_dir, upload_id)
+    except uploads.UploadError as exp:
+        return upload_error(exp)
+    return flask.jsonify({"offset": offset})
+
+
+@app.route("/results/uploads/<upload_id>", methods=['PUT'])
+@auth.login_required
+def append_result_upload(upload_id):
+    """Append the request body to the upload. The offset query
+    parameter must be the number of bytes received so far."""
+    username = flask.request.authorization.username
+    require_consent(username)
+    try:
+        offset = int(flask.request.args.get('offset', ''))
+    except ValueError:
+        flask.abort(400)
+
+    user_dir = client_dirs.client_dir(config.results_dir, username)
+    try:
+        offset = uploads.append_chunk(user_dir, upload_id, offset,
+                                      flask.request.stream)
+    except uploads.UploadError as exp:
+        return upload_error(exp)
+    return flask.jsonify({"offset": offset})
+
+
+@app.route("/results/uploads/<upload_id>/finalize", methods=['POST'])
+@auth.login_required
+def finish_result_upload(upload_id):
+    """Store the uploaded result once its SHA-256 checksum (sent as
+    "sha256" in a JSON body) has been verified"""
+    username = flask.request.authorization.username
+    update_client_info(username, flask.request.remote_addr)
+    client = require_consent(username)
+
+    upload_json = flask.request.get_json(silent=True) or {}
+    user_dir = client_dirs.client_dir(config.results_dir, username)
+    try:
+        tmp_path, file_name, digest = uploads.finish_upload(
+            user_dir, upload_id, upload_json.get('sha256'))
+    except uploads.UploadError as exp:
+        return upload_error(exp)
+    store_result(client, file_name, tmp_path, os.path.getsize(tmp_path),
+                 digest)
+    return flask.jsonify({"status": "success", "sha256": digest}), 201
+
+
 @app.route("/results")
 @auth.login_required
 def get_results():
+    """Return the client's results.
+
+    Without any query parameters, all of the results are returned at
+    once. The following parameters select a page of results instead:
+
+    limit- maximum number of results to return. The response contains
+        a next_cursor to fetch the following page with
+    cursor- the next_cursor returned with the previous page
+    sort- order the results by 'name' (default) or 'mtime'
+    format- 'ndjson' to stream the results as one JSON object per line
+        instead of a single JSON document. The cursor for the next page
+        is then returned in the X-Next-Cursor header
+
+    """
     update_client_info(flask.request.authorization.username,
                        flask.request.remote_addr)
-    results = {}
 
-    # TODO: cache the list of results?
     # TODO: let the admin query any results file here?
-    # look in results directory for the user's results (we assume this
-    # directory was created when the user registered)
+    # look in results directory for the user's results (the directory
+    # doesn't exist until the first result is uploaded)
     username = flask.request.authorization.username
-    user_dir = os.path.join(config.results_dir, username, '[!_]*.json')
-    for path in glob.glob(user_dir):
-        file_name, ext = os.path.splitext(os.path.basename(path))
-        with open(path) as result_file:
-            try:
-                results[file_name] = json.load(result_file)
-            except Exception, e:
-                logging.error("Results: Couldn't open results file - %s - %s"
-                              % (path, str(e)))
+    user_dir = client_dirs.client_dir(config.results_dir, username)
+
+    args = flask.request.args
+    sort = args.get('sort', 'name')
+    cursor = args.get('cursor')
+    response_format = args.get('format', 'json')
+    limit = args.get('limit')
+    if (sort not in result_files.SORT_KEYS or
+            response_format not in ('json', 'ndjson')):
+        flask.abort(400)
+    try:
+        if limit is not None:
+            limit = min(int(limit), config.results_page_max)
+            if limit < 1:
+                raise ValueError("limit must be positive")
+        paths, next_cursor = result_files.select_page(user_dir, sort,
+                                                      cursor, limit)
+    except ValueError:
+        flask.abort(400)
+
+    if response_format == 'ndjson':
+        def generate():
+            for path in paths:
+                content = result_files.load_result(path)
+                if content is not None:
+                    name = result_files.result_name(path)
+                    yield json.dumps({"name": name,
+                                      "result": content}) + "\n"
+        response = flask.Response(generate(),
+                                  mimetype='application/x-ndjson')
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
 
-    return flask.jsonify({"results": results})
+    page = {}
+    for path in paths:
+        content = result_files.load_result(path)
+        if content is not None:
+            page[result_files.result_name(path)] = content
+    json_resp = {"results": page}
+    if limit is not None or cursor is not None:
+        json_resp["next_cursor"] = next_cursor
+    return flask.jsonify(json_resp)
 
 
 def get_user_specific_content(folder, filename=None, json_var=None):
@@ -211,6 +557,10 @@ def get_user_specific_content(folder, filename=None, json_var=None):
     json_var- the name of the json variable to return containing the
     list of hashes
 
+    Note: the file listing and scheduler.info are sent with the
+    version of the client's manifest as ETag, and a request with a
+    matching If-None-Match header gets an empty 304 response
+
     """
     username = flask.request.authorization.username
 
@@ -219,88 +569,55 @@ def get_user_specific_content(folder, filename=None, json_var=None):
     if not client.has_given_consent:
         flask.abort(418)
 
-    # all of the scheduler files are combined together here.
-    # this is run every time the experiment list or "scheduler.info"
-    # is requested.
-    if (json_var == "experiments" and
-       (filename is None or filename == "scheduler.info")):
-        global_scheduler_filename = os.path.join(config.experiments_dir,
-                                                 "global", "scheduler.info")
-        country_scheduler_filename = os.path.join(config.experiments_dir,
-                                                  client.country,
-                                                  "scheduler.info")
-        client_scheduler_filename = os.path.join(config.experiments_dir,
-                                                 username, "scheduler.info")
-
-        freqs = {}
-        if os.path.exists(global_scheduler_filename):
-            with open(global_scheduler_filename, 'r') as file_p:
-                freqs.update(json.load(file_p))
-        if os.path.exists(country_scheduler_filename):
-            with open(country_scheduler_filename, 'r') as file_p:
-                freqs.update(json.load(file_p))
-        if os.path.exists(client_scheduler_filename):
-            with open(client_scheduler_filename, 'r') as file_p:
-                freqs.update(json.load(file_p))
-
-    files = {}
-
-    # include global baseline content
-    global_dir = os.path.join(folder, "global")
-    if os.path.exists(global_dir):
-        for path in glob.glob(os.path.join(global_dir, "*")):
-            file_name = os.path.basename(path)
-            files[file_name] = path
-    else:
-        logging.warning("Global baseline folder \"%s\" "
-                        "doesn't exist!" % (global_dir))
-
-    # include country-specific baseline content
-    country_specific_dir = os.path.join(folder, client.country)
-    if os.path.exists(country_specific_dir):
-        # if baseline experiments exist for this country (==folder exists),
-        # sync up all of the files in that dir.
-        for path in glob.glob(os.path.join(country_specific_dir, "*")):
-            file_name = os.path.basename(path)
-            files[file_name] = path
-    else:
-        logging.warning("Country baseline folder %s "
-                        "doesn't exist!" % (country_specific_dir))
-
-    user_dir = os.path.join(folder, username, '*')
-    for path in glob.glob(user_dir):
-        file_name = os.path.basename(path)
-        files[file_name] = path
+    # the global, country-specific and user-specific content is
+    # merged here. Files in the user's directory take precedence over
+    # country-specific ones, which take precedence over global ones.
+    manifest = get_manifest(folder, client.country, username,
+                            with_schedule=(json_var == "experiments"))
 
     if filename is None:
-        for filename in files:
-            with open(files[filename], 'r') as file_p:
-                hash_val = hashlib.md5(file_p.read()).digest()
-                files[filename] = urlsafe_b64encode(hash_val)
-
-        return flask.jsonify({json_var: files})
+        return versioned_response(manifest.version, lambda:
+                                  flask.jsonify({json_var:
+                                                 manifest.hashes()}))
 
     # this should never happen, but better be safe
     if '..' in filename or filename.startswith('/'):
         flask.abort(404)
 
-    # we have to make a special case for scheduler.info
-    # and send the composition of all 3 files as one file
-    if filename == "scheduler.info":
-        scheduler = json.dumps(freqs)
-        response = flask.make_response(scheduler)
-        response.headers["Content-Disposition"] = ("attachment; "
-                                                   "filename=scheduler.info")
-        return response
-
-    if filename in files:
+    # we have to make a special case for scheduler.info and send the
+    # client's schedule, merged from the global, country and client
+    # schedules
+    if json_var == "experiments" and filename == "scheduler.info":
+        def make_schedule_response():
+            response = flask.make_response(manifest.schedule or "{}")
+            response.headers["Content-Disposition"] = ("attachment; "
+                                                       "filename="
+                                                       "scheduler.info")
+            return response
+        return versioned_response(manifest.version, make_schedule_response)
+
+    if filename in manifest.files:
         # send requested experiment file
-        return flask.send_file(files[filename])
+        return flask.send_file(manifest.files[filename])
     else:
         # not found
         flask.abort(404)
 
 
+def versioned_response(version, make_response):
+    """Return an empty 304 response if the client already has the given
+    version of the content, otherwise the response built by
+    make_response, tagged with the version
+
+    """
+    if flask.request.if_none_match.contains(version):
+        response = flask.Response(status=304)
+    else:
+        response = make_response()
+    response.set_etag(version)
+    return response
+
+
 # in case the client wants to specify the country explicitly (VPN).
 @app.route("/set_country/<country>")
 @auth.login_required
@@ -327,7 +644,7 @@ def set_ip(ip_address):
 
     try:
         update_client_info(flask.request.authorization.username,
-                           ip=ip_address)
+                           ip=ip_address, synchronous=True)
     except Exception as exp:
         logging.error("Error setting IP address"
                       " %s: %s" % (ip_address, exp))
@@ -365,35 +682,174 @@ def get_system_status():
     Note: we don't display clients who have the dont_display column
     set to 1/True
 
+    Note: the list is served from a snapshot that is rebuilt in the
+    background every config.client_snapshot_interval seconds and when
+    a client registers or gives consent
+
     """
-    clients = Client.query.all()
+    snapshot = get_client_snapshot()
+    clients = list(snapshot)
     random.shuffle(clients)
     results = []
-    number = 0
-    for client in clients:
-        # dont add clients who have asked not to be displayed
-        if client.dont_display:
-            continue
-        info = {}
+    for number, info in enumerate(clients):
+        info = dict(info)
         info['num'] = number
-        info['country'] = client.country
-        if client.last_seen is not None:
-            info['last_seen'] = str(client.last_seen.date())
-        else:
-            continue
-        info['is_vpn'] = client.is_vpn
+        results.append(info)
+    return flask.jsonify({"clients": results})
+
+
+# public information about the displayed clients, with the AS
+# information already resolved
+_client_snapshot = None
+_client_snapshot_lock = threading.Lock()
+_client_snapshot_stale = threading.Event()
+_client_snapshot_thread = None
+
+
+def build_client_snapshot():
+    """Build the list of clients served by /clients"""
+    rows = db.session.query(Client.country, Client.last_seen,
+                            Client.is_vpn, Client.last_ip).\
+        filter(Client.last_seen != None).\
+        filter(db.or_(Client.dont_display == None,
+                      Client.dont_display == False))
+    snapshot = []
+    for country, last_seen, is_vpn, last_ip in rows:
+        info = {}
+        info['country'] = country
+        info['last_seen'] = str(last_seen.date())
+        info['is_vpn'] = is_vpn
         info['as_number'] = 0
         info['as_owner'] = ""
         try:
-            asn, owner = get_asn_from_ip(client.last_ip)
+            asn, owner = get_asn_from_ip(last_ip)
             info['as_number'] = asn
             info['as_owner'] = owner.decode('utf-8', 'ignore')
         except Exception as exp:
             logging.error("Error looking up AS info for "
-                          "%s: %s" % (client.last_ip, exp))
-        results.append(info)
-        number += 1
-    return flask.jsonify({"clients": results})
+                          "%s: %s" % (last_ip, exp))
+        snapshot.append(info)
+    return snapshot
+
+
+def get_client_snapshot():
+    """Return the current snapshot of the client list. The first call
+    builds it and starts the background thread that refreshes it."""
+    global _client_snapshot, _client_snapshot_thread
+    with _client_snapshot_lock:
+        if _client_snapshot is None:
+            _client_snapshot = build_client_snapshot()
+        if _client_snapshot_thread is None:
+            _client_snapshot_thread = threading.Thread(
+                target=refresh_client_snapshot, name="client-snapshot")
+            _client_snapshot_thread.daemon = True
+            _client_snapshot_thread.start()
+        return _client_snapshot
+
+
+def refresh_client_snapshot():
+    global _client_snapshot
+    while True:
+        _client_snapshot_stale.wait(config.client_snapshot_interval)
+        _client_snapshot_stale.clear()
+        with app.app_context():
+            try:
+                snapshot = build_client_snapshot()
+            except Exception as exp:
+                logging.error("Error refreshing the client list: "
+                              "%s" % (exp))
+                continue
+            finally:
+                db.session.remove()
+        _client_snapshot = snapshot
+
+
+def invalidate_client_snapshot():
+    """Ask for the client list to be rebuilt, e.g. because a client
+    registered"""
+    _client_snapshot_stale.set()
+
+
+# field name in /client_details -> column
+CLIENT_DETAIL_FIELDS = [('username', Client.username),
+                        ('handle', Client.typeable_handle),
+                        ('country', Client.country),
+                        ('registered_date', Client.registered_date),
+                        ('last_seen', Client.last_seen),
+                        ('last_ip', Client.last_ip),
+                        ('is_vpn', Client.is_vpn),
+                        ('has_given_consent', Client.has_given_consent),
+                        ('date_given_consent', Client.date_given_consent)]
+# formats of the dates accepted by the last_seen filters
+DATE_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']
+# number of rows fetched from the database at a time when streaming
+CLIENT_DETAILS_BATCH_SIZE = 500
+
+
+def parse_bool(value):
+    """Parse a boolean query parameter. Raises ValueError if it is
+    neither true nor false."""
+    if value.lower() in ('true', '1', 'yes'):
+        return True
+    if value.lower() in ('false', '0', 'no'):
+        return False
+    raise ValueError("Not a boolean: %s" % (value))
+
+
+def parse_date(value):
+    """Parse a date query parameter. Raises ValueError if it is not in
+    one of the DATE_FORMATS."""
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    raise ValueError("Not a date: %s" % (value))
+
+
+def filter_clients(query, args):
+    """Apply the filters of a /client_details request to the query.
+    Raises ValueError if one of them is malformed."""
+    if args.get('country'):
+        query = query.filter(Client.country == args['country'].upper())
+    for name, column in (('is_vpn', Client.is_vpn),
+                         ('consent', Client.has_given_consent)):
+        if args.get(name) is None:
+            continue
+        if parse_bool(args[name]):
+            query = query.filter(column == True)
+        else:
+            # never set counts as false
+            query = query.filter(db.or_(column == None, column == False))
+    if args.get('seen_since') is not None:
+        query = query.filter(Client.last_seen >= parse_date(
+            args['seen_since']))
+    if args.get('seen_until') is not None:
+        query = query.filter(Client.last_seen < parse_date(
+            args['seen_until']))
+    return query
+
+
+def format_csv_row(values):
+    """Return the values as a line of CSV, ending with a line break.
+
+    None is written as an empty field, dates as HTTP dates, like
+    flask.json writes them in the JSON and NDJSON formats, and unicode
+    as UTF-8.
+
+    """
+    line = StringIO()
+    row = []
+    for value in values:
+        if value is None:
+            value = ''
+        elif isinstance(value, datetime):
+            value = http_date(value.timetuple())
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+        row.append(value)
+    csv.writer(line).writerow(row)
+    return line.getvalue()
 
 
 @app.route("/client_details")
@@ -402,31 +858,114 @@ def get_clients():
     """This is a list of clients that is fully detailed.
     This requires both authentication and admin-level access.
 
+    Without any query parameters, all of the clients are returned at
+    once. The following parameters are optional:
+
+    fields- comma separated names of the fields to return, all of them
+        by default
+    country- only clients in this country
+    is_vpn, consent- 'true' or 'false', only clients that are (not)
+        VPNs or have (not) given their consent
+    seen_since, seen_until- only clients last seen in this range, as
+        YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS
+    limit- maximum number of clients to return. The response contains
+        a next_cursor to fetch the following page with
+    cursor- the next_cursor returned with the previous page
+    format- 'ndjson' or 'csv' to stream the clients, one per line,
+        instead of returning a single JSON document. The cursor for the
+        next page is then returned in the X-Next-Cursor header
+
     """
     update_client_info(flask.request.authorization.username,
                        flask.request.remote_addr)
     # ensure that the client has the admin role
     username = flask.request.authorization.username
-    user = Client.query.filter_by(username=username).first()
-    admin = Role.query.filter_by(name='admin').first()
-    if user not in admin.users:
+    if not is_admin(username):
         return unauthorized()
 
-    results = []
-    clients = Client.query.all()
-    for client in clients:
-        info = {}
-        info['username'] = client.username
-        info['handle'] = client.typeable_handle
-        info['country'] = client.country
-        info['registered_date'] = client.registered_date
-        info['last_seen'] = client.last_seen
-        info['last_ip'] = client.last_ip
-        info['is_vpn'] = client.is_vpn
-        info['has_given_consent'] = client.has_given_consent
-        info['date_given_consent'] = client.date_given_consent
-        results.append(info)
-    return flask.jsonify({"clients": results})
+    args = flask.request.args
+    response_format = args.get('format', 'json')
+    cursor = args.get('cursor')
+    limit = args.get('limit')
+    fields = CLIENT_DETAIL_FIELDS
+    if args.get('fields'):
+        columns = dict(CLIENT_DETAIL_FIELDS)
+        names = args['fields'].split(',')
+        if not all(name in columns for name in names):
+            flask.abort(400)
+        fields = [(name, columns[name]) for name in names]
+    if response_format not in ('json', 'ndjson', 'csv'):
+        flask.abort(400)
+
+    # only the requested columns are fetched. The clients are in id
+    # order, so a page starts right after the last id of the previous
+    # page instead of skipping over all of the previous pages
+    query = db.session.query(Client.id, *[column for _, column in fields])
+    try:
+        query = filter_clients(query, args)
+        if cursor is not None:
+            query = query.filter(Client.id > int(cursor))
+        if limit is not None:
+            limit = min(int(limit), config.client_details_page_max)
+            if limit < 1:
+                raise ValueError("limit must be positive")
+    except ValueError:
+        flask.abort(400)
+    query = query.order_by(Client.id)
+
+    next_cursor = None
+    if limit is not None:
+        # one more row tells us whether there is a next page
+        rows = query.limit(limit + 1).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = str(rows[-1][0])
+    else:
+        rows = query.yield_per(CLIENT_DETAILS_BATCH_SIZE)
+
+    names = [name for name, _ in fields]
+    if response_format != 'json':
+        def generate():
+            if response_format == 'csv':
+                yield format_csv_row(names)
+            for row in rows:
+                if response_format == 'csv':
+                    yield format_csv_row(row[1:])
+                else:
+                    info = dict(zip(names, row[1:]))
+                    yield flask.json.dumps(info) + "\n"
+        mimetype = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+        # the rows are read from the database as they are sent
+        response = flask.Response(flask.stream_with_context(generate()),
+                                  mimetype=mimetype[response_format])
+        if next_cursor is not None:
+            response.headers['X-Next-Cursor'] = next_cursor
+        return response
+
+    results = [dict(zip(names, row[1:])) for row in rows]
+    json_resp = {"clients": results}
+    if limit is not None or cursor is not None:
+        json_resp["next_cursor"] = next_cursor
+    return flask.jsonify(json_resp)
+
+
+@app.route("/cache_stats")
+@auth.login_required
+def get_cache_stats():
+    """Hit/ miss counters of the in-process caches. This requires both
+    authentication and admin-level access.
+
+    Note: the counters are per process
+
+    """
+    if not is_admin(flask.request.authorization.username):
+        return unauthorized()
+    return flask.jsonify({"credentials": credential_cache.stats(),
+                          "ip_info": ip_info_cache.stats()})
+
+
+# number of typeable handles to try before giving up on a registration
+HANDLE_ATTEMPTS = 10
 
 
 @app.route("/register", methods=["POST"])
@@ -468,22 +1007,26 @@ def register():
     if client is not None:
         flask.abort(400)
 
-    # create a typeable handle to put in the consent form URL
-    typeable_handle = generate_typeable_handle(length=8)
-    client = Client.query.filter_by(typeable_handle=typeable_handle).first()
-    # if there is a collision, generate another one
-    while client is not None:
-        type_hand = generate_typeable_handle(length=8)
-        client = Client.query.filter_by(typeable_handle=type_hand).first()
-    client_json['typeable_handle'] = typeable_handle
-
+    # create a typeable handle to put in the consent form URL. The
+    # handles are unique in the database, so if there is a collision,
+    # the insert fails and we try another one
     user = Client(**client_json)
-    db.session.add(user)
-    db.session.commit()
-
-    os.makedirs(os.path.join(config.results_dir, username))
-    os.makedirs(os.path.join(config.experiments_dir, username))
-    os.makedirs(os.path.join(config.inputs_dir, username))
+    for _ in range(HANDLE_ATTEMPTS):
+        typeable_handle = handle_pool.take()
+        user.typeable_handle = typeable_handle
+        db.session.add(user)
+        try:
+            db.session.commit()
+            break
+        except IntegrityError:
+            db.session.rollback()
+    else:
+        logging.error("Couldn't find a free typeable handle for "
+                      "%s" % (username))
+        flask.abort(500)
+    invalidate_client_snapshot()
+    # the client's results, experiments and inputs directories are
+    # created when the first file is written to them
 
     ret_json = {"status": "success", "typeable_handle": typeable_handle}
     return flask.jsonify(ret_json), 201
@@ -532,24 +1075,20 @@ def geolocate(custom_ip=None):
 
 def display_consent_page(username, path, freedom_url=''):
     # insert a hidden field into the form with the user's username
-    with open(path, 'r') as file_p:
-        initial_page = file_p.read()
-    initial_page = initial_page.decode('utf-8')
-    replace_field = u'replace-with-username-value'
-    initial_page = initial_page.replace(replace_field,
-                                        urlsafe_b64encode(username))
-    replace_field = u'replace-with-human-readable-username-value'
-    initial_page = initial_page.replace(replace_field, (username))
+    values = {consent.USERNAME_FIELD: urlsafe_b64encode(username),
+              consent.READABLE_USERNAME_FIELD: username}
     if freedom_url != '':
-        freedom_replacement = u'replace-this-with-freedom-house'
-        initial_page = initial_page.replace(freedom_replacement,
-                                            u'static/' + freedom_url)
-    return initial_page
+        values[consent.FREEDOM_HOUSE_FIELD] = 'static/' + freedom_url
+    else:
+        values[consent.FREEDOM_HOUSE_FIELD] = 'about:blank'
+    return consent.render_page(path, values)
 
 @app.route("/static/<filename>")
 def static_resource(filename):
     file_path = os.path.join(config.centinel_home, 'static', filename)
-    if os.path.isfile(os.path.join(file_path)) and (filename in config.static_files_allowed):
+    allowed = (filename in config.static_files_allowed or
+               freedom_house.is_page_name(filename))
+    if os.path.isfile(os.path.join(file_path)) and allowed:
         return flask.send_from_directory(os.path.join(config.centinel_home, 'static'), filename)
     else:
         flask.abort(404)
@@ -570,6 +1109,10 @@ def get_initial_informed_consent_with_handle(typeable_handle):
     else:
         page_path = os.path.join(config.centinel_home,'static','no_prefetch_informed_consent.html')
 
+    # make sure the reports are there by the time the client picks
+    # their country
+    if config.prefetch_freedomhouse:
+        freedom_house.start_prefetch()
     return display_consent_page(username,
                                 page_path)
 
@@ -585,6 +1128,8 @@ def get_initial_informed_consent():
         flask.abort(404)
     if client.has_given_consent:
         return "Consent already given."
+    if config.prefetch_freedomhouse:
+        freedom_house.start_prefetch()
     return display_consent_page(username,
                                 os.path.join(config.centinel_home,'static','initial_informed_consent.html'))
 
@@ -605,55 +1150,22 @@ def get_country_specific_consent():
     if country not in constants.freedom_house_lookup:
         flask.abort(404)
 
-    # if we don't already have the content from freedom house, fetch
-    # it, then host it locally and insert it into the report
-    freedom_url = "".join(["freedom_house_", country, ".html"])
-    filename = os.path.join(config.centinel_home, "static", freedom_url)
-    # get the content from freedom house if we don't already have it
-    get_page_and_strip_bad_content(constants.freedom_house_url(country),
-                                   filename)
+    # the Freedom House report is fetched and sanitised ahead of time
+    # (see freedom_house.py), we only link to the local copy. Until it
+    # has been fetched, the page is shown without the report
+    if config.prefetch_freedomhouse:
+        freedom_house.start_prefetch()
+    freedom_url = freedom_house.cached_page(country) or ''
 
-    page_path = os.path.join(centinel_home,'static','informed_consent.html')
+    page_path = os.path.join(config.centinel_home,'static','informed_consent.html')
     page_content = display_consent_page(username, page_path, freedom_url)
 
-    flask.url_for('static', filename=freedom_url)
     flask.url_for('static', filename='economistDemocracyIndex.pdf')
     flask.url_for('static', filename='consent.js')
 
     return page_content
 
 
-def get_page_and_strip_bad_content(url, filename):
-    """Get the given page, strip out all requests back to the original
-    domain (identified via src tags), and write out the page
-
-    Note: this will break stuff, but that is better than letting the
-    domain know where and who our clients are
-
-    Note: we expect the content to be fairly static, so we don't
-    refetch it if we already have it
-
-    """
-    # if os.path.exists(filename):
-    #     return
-    req = requests.get(url)
-    # replace external links with a blank reference (sucks for the
-    # rendering engine to figure out, but hey, they get paid to work
-    # that out)
-    # also remove form tags and scripts
-    sub_flags = re.MULTILINE | re.DOTALL
-    replace_src = r'src\s*=\s*".*?"'
-    page = re.sub(replace_src, "", req.content, flags=sub_flags)
-    replace_href = r'href\s*=\s*".*?"'
-    page = re.sub(replace_href, "", page, flags=sub_flags)
-    replace_script = r'<\s*script.*?>.*?</\s*script\s*>'
-    page = re.sub(replace_script, "", page, flags=sub_flags)
-    replace_form = r'<\s*form.*?>.*?</\s*form\s*>'
-    page = re.sub(replace_form, "", page, flags=sub_flags)
-    with open(filename, 'w') as file_p:
-        file_p.write(page)
-
-
 @app.route("/submit_consent")
 def update_informed_consent():
     username = flask.request.args.get('username')
@@ -668,6 +1180,7 @@ def update_informed_consent():
     client.has_given_consent = True
     client.date_given_consent = datetime.now().date()
     db.session.commit()
+    invalidate_client_snapshot()
     response = ("Success! Thanks for registering; you are ready to start "
                 "sending us censorship measurement results.")
     return response
@@ -681,5 +1194,13 @@ def verify_password(username, password):
                          "authentication?\n"
                          "Add WSGIPassAuthorization On to your WSGI config "
                          "file under enabled-sites in Apache"))
+    # a full password hash is expensive, so skip it if this exact
+    # username and password were verified recently
+    cache_key = credential_cache.digest(username, password)
+    if credential_cache.get(cache_key) is not None:
+        return True
     user = Client.query.filter_by(username=username).first()
-    return user and user.verify_password(password)
+    if user and user.verify_password(password):
+        credential_cache.put(cache_key, username)
+        return True
+    return False
@@ -0,0 +1,115 @@
+#
+# write_behind.py: coalesce the per-request client bookkeeping updates
+# (last IP, last seen, country) in memory and write them out in bulk.
+#
+
+import atexit
+import logging
+import threading
+
+from sqlalchemy import bindparam, case, or_
+
+import centinel
+import config
+from centinel.models import Client
+
+db = centinel.db
+
+
+class ClientInfoBuffer(object):
+    """Buffer of pending client info updates, keyed on username.
+
+    Only the most recent update for each client is kept. Pending updates
+    are written in a single bulk UPDATE when flush_size clients are
+    pending, every flush_interval seconds from a background thread and
+    when the process exits.
+
+    Params:
+
+    flush_interval- seconds between background flushes
+    flush_size- number of pending clients that triggers a flush
+
+    """
+
+    def __init__(self, flush_interval, flush_size):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record(self, username, last_ip, last_seen, country):
+        """Queue an update for the given client. The country is only
+        applied to clients that are not VPN clients, just like the
+        synchronous update does.
+
+        """
+        with self._lock:
+            self._pending[username] = {'b_username': username,
+                                       'b_last_ip': last_ip,
+                                       'b_last_seen': last_seen,
+                                       'b_country': country}
+            num_pending = len(self._pending)
+            if self._thread is None:
+                self._start()
+        if num_pending >= self.flush_size:
+            self.flush()
+
+    def discard(self, username):
+        """Drop a pending update, e.g. because a newer one was just
+        written synchronously"""
+        with self._lock:
+            self._pending.pop(username, None)
+
+    def flush(self):
+        """Write the pending updates. If that fails, they are queued
+        again, unless a newer update for the same client was queued
+        meanwhile."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+
+        clients = Client.__table__
+        # the country of VPN clients is only changed when they set it
+        # explicitly, which never goes through this buffer
+        country = case([(clients.c.is_vpn == True, clients.c.country)],
+                       else_=bindparam('b_country'))
+        # a synchronous update may have been written since the update
+        # was queued, don't overwrite it with older information
+        stmt = clients.update().\
+            where(clients.c.username == bindparam('b_username')).\
+            where(or_(clients.c.last_seen == None,
+                      clients.c.last_seen < bindparam('b_last_seen'))).\
+            values(last_ip=bindparam('b_last_ip'),
+                   last_seen=bindparam('b_last_seen'),
+                   country=country)
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(stmt, pending.values())
+        except Exception as exp:
+            logging.error("Error flushing info for %d clients: "
+                          "%s" % (len(pending), exp))
+            with self._lock:
+                for username, update in pending.iteritems():
+                    self._pending.setdefault(username, update)
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name="client-info-flush")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+
+client_info_buffer = ClientInfoBuffer(config.client_info_flush_interval,
+                                      config.client_info_flush_size)
@@ -15,8 +15,72 @@ centinel_home = "/opt/centinel-server/"
 results_dir     = os.path.join(centinel_home, 'results')
 experiments_dir = os.path.join(centinel_home, 'experiments')
 inputs_dir = os.path.join(centinel_home, 'inputs')
+# number of levels of hash prefix directories the clients' directories
+# are spread over in results_dir, experiments_dir and inputs_dir, e.g.
+# results/ab/cd/<username> with 2. 0 keeps them directly in the base
+# directories. Run "python -m centinel.client_dirs" after changing it.
+client_dir_shard_depth = 0
+# content-addressed store for the experiment and data files handed out
+# to clients. It must be on the same file system as experiments_dir and
+# inputs_dir so that clients' files can be hard links to it
+blob_dir = os.path.join(centinel_home, 'blobs')
+# where scheduler.py keeps track of its round-robin client selection
+scheduler_state_file = os.path.join(centinel_home, 'scheduler-state.json')
 static_files_allowed = ['economistDemocracyIndex.pdf', 'consent.js']
 
+# result uploads
+max_result_size = 100 * 1024 * 1024  # bytes, for chunked uploads
+# unfinished chunked uploads are removed after this many seconds
+upload_expiry   = 7 * 24 * 60 * 60
+# maximum number of results returned in one page by GET /results
+results_page_max = 1000
+# with compress_results set, the ingestion workers (see ingest_results)
+# gzip compress the stored results, or xz compress them if they are at
+# least compress_lzma_min_size bytes and the lzma module
+# (backports.lzma on Python 2) is installed. Uploads are stored as they
+# are received and compressed afterwards, so that compression never
+# slows down an upload. Without ingest_results, the results are
+# compressed by the upload handler once they are stored. Results that
+# are uploaded compressed, or deduplicated (see dedup_results), are
+# left as they are. Compressed results are decompressed when they are read,
+# whatever the setting. Run "python -m centinel.compression" to
+# compress the results that are stored uncompressed.
+compress_results       = False
+compress_lzma_min_size = 1024 * 1024  # bytes
+compress_gzip_level    = 6
+# with dedup_results set, byte-identical results are stored once in
+# result_blob_dir, and the clients' result files are hard links to
+# them. result_blob_dir must be on the same file system as results_dir.
+# Blobs hold the results as they were uploaded, so deduplicated results
+# are not compressed, whatever compress_results says.
+dedup_results   = False
+result_blob_dir = os.path.join(centinel_home, 'result-blobs')
+
+# result ingestion
+# with ingest_results set, every stored result is added to a queue in
+# ingest_queue_file and post-processed (validated, experiment and
+# timestamps extracted, copied to ingest_archive_dir if it is set) by
+# the workers started with "python -m centinel.ingest work". Failed
+# jobs are retried ingest_max_attempts times, waiting
+# ingest_retry_delay seconds before the first retry and twice as long
+# before every following one. A job is given to another worker if it
+# isn't done after ingest_lease seconds.
+ingest_results      = False
+ingest_queue_file   = os.path.join(centinel_home, 'ingest-queue.sqlite')
+ingest_archive_dir  = None
+ingest_workers      = 4
+ingest_max_attempts = 5
+ingest_retry_delay  = 60   # seconds
+ingest_lease        = 600  # seconds
+
+# content hashes of the experiment and input files, persisted so that
+# files are only re-hashed when they change
+hash_index_file          = os.path.join(centinel_home, 'hash-index.json')
+hash_index_save_interval = 60  # seconds
+# number of merged experiment/ input file manifests (and directory
+# listings) to cache
+manifest_cache_size = 4096
+
 
 # details for how to access the database
 def load_uri_from_file(filename):
@@ -32,13 +96,51 @@ else:
     DATABASE_URI = load_uri_from_file(database_uri_file)
 
 maxmind_db = os.path.join(centinel_home, 'maxmind.mmdb')
+# number of /24s (/48s for IPv6) to keep the country and AS of in memory
+ip_info_cache_size = 65536
 
 # AS information lookup
 net_to_asn_file   = os.path.join(centinel_home, 'data-raw-table')
 asn_to_owner_file = os.path.join(centinel_home, 'data-used-autnums')
+# number of /24 (/48 for IPv6) lookups to keep cached
+asinfo_cache_size = 65536
+
+# authentication
+# successful password checks are cached so that probes polling several
+# endpoints per sync don't pay for a full password hash every time.
+# Set auth_cache_size to 0 to disable the cache.
+auth_cache_size = 10000
+auth_cache_ttl  = 300  # seconds
+
+# client bookkeeping
+# when enabled, the last seen time, IP and country updates done on every
+# request are buffered in memory and written in one bulk UPDATE every
+# client_info_flush_interval seconds, or as soon as
+# client_info_flush_size clients have pending updates.
+client_info_write_behind   = False
+client_info_flush_interval = 30  # seconds
+client_info_flush_size     = 500
+
+# number of consent URL handles to generate and check against the
+# database at a time, so that registering doesn't have to look for
+# collisions. Set typeable_handle_pool_size to 0 to disable the pool.
+typeable_handle_pool_size = 100
+
+# seconds between two rebuilds of the public client list (/clients)
+client_snapshot_interval = 300
+# maximum number of clients returned in one page by /client_details
+client_details_page_max = 1000
 
 # consent form
+# sanitised copies of the Freedom House reports linked from the consent
+# form are kept in the static directory and fetched again once they are
+# older than freedom_house_ttl seconds. With prefetch_freedomhouse set,
+# the consent form lists the reports and the server keeps the copies
+# up to date from a background thread. Otherwise, run
+# "python -m centinel.freedom_house" periodically to fetch them.
 prefetch_freedomhouse = False
+freedom_house_ttl      = 7 * 24 * 60 * 60
+freedom_house_workers  = 4
 
 # web server
 ssl_cert  = "server.iclab.org.crt"
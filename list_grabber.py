@@ -16,16 +16,28 @@
 
 
 import argparse
+import hashlib
+import json
 import os
 import re
 import requests
+import threading
 
 
+from multiprocessing.pool import ThreadPool
 from os import path
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPDigestAuth
 from urlparse import urljoin
 
 
+# ETag and Last-Modified of each list we downloaded, kept in the output
+# directory so that unchanged lists are not downloaded again
+STATE_FILE = ".list_grabber_state.json"
+# download lists in chunks of this size
+CHUNK_SIZE = 64 * 1024
+
+
 def parse_args():
     parser = argparse.ArgumentParser()
 
@@ -46,17 +58,182 @@ def parse_args():
     parser.add_argument('--digest', '-d', help=digest_help, dest='digest', action='store_true')
     parser.set_defaults(digest=False)
 
+    workers_help = ('Number of lists to download in parallel.')
+    parser.add_argument('--workers', '-w', help=workers_help, default=4,
+                        type=int)
+
     args = parser.parse_args()
 
     if not os.path.exists(args.output):
         parser.error("The output directory \"%s\" does not exist!" % args.output)
 
-    if args.user is None and args.digest is False:
+    if args.user is None and args.digest is True:
         parser.error('Digest authentication has been enabled but no username and password '
                      'given.')
     return args
 
 
+def make_session(auth, workers):
+    """Create a session that keeps up to workers connections to the
+    repository open"""
+    session = requests.Session()
+    session.auth = auth
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(workers, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def load_state(output):
+    state_path = os.path.join(output, STATE_FILE)
+    if not os.path.exists(state_path):
+        return {}
+    try:
+        with open(state_path, 'r') as state_file:
+            return json.load(state_file)
+    except ValueError:
+        print "Ignoring corrupt state file \"%s\"." % state_path
+        return {}
+
+
+def save_state(output, state):
+    state_path = os.path.join(output, STATE_FILE)
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.rename(tmp_path, state_path)
+
+
+def list_destination(output, csvfile):
+    """Return where to save the given list, creating the country
+    directory if needed"""
+    # find out if it is a country-specific list
+    base = os.path.splitext(csvfile)[0].upper()
+    if len(base) == 2:
+        directory = os.path.join(output, base)
+        if not os.path.exists(directory):
+            print "Creating directory for country %s at %s." % (base, directory)
+            os.makedirs(directory)
+        return os.path.join(directory, "country_list.csv")
+    return os.path.join(output, "global", csvfile)
+
+
+def file_digest(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file_p:
+        for chunk in iter(lambda: file_p.read(CHUNK_SIZE), b''):
+            md5.update(chunk)
+    return md5.digest()
+
+
+def download_list(session, url, path, state):
+    """Download the list at url to path, unless the server says it
+    hasn't changed since we last downloaded it.
+
+    The list is streamed to a hidden temporary file next to path while
+    it is hashed, and only renamed over path if its content changed, so
+    readers never see a partially written list and unchanged lists keep
+    their modification time.
+
+    Returns the number of bytes fetched and whether path was changed.
+
+    """
+    headers = {}
+    cached = state.get(url, {})
+    # only ask for a conditional download if we still have the file
+    if os.path.exists(path):
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+
+    req = session.get(url, headers=headers, stream=True)
+    try:
+        if req.status_code == 304:
+            return 0, False
+        req.raise_for_status()
+
+        fetched = 0
+        md5 = hashlib.md5()
+        directory, basename = os.path.split(path)
+        tmp_path = os.path.join(directory, ".%s.%d.%d.tmp" %
+                                (basename, os.getpid(),
+                                 threading.current_thread().ident))
+        try:
+            with open(tmp_path, 'wb') as output:
+                for chunk in req.iter_content(CHUNK_SIZE):
+                    fetched += len(chunk)
+                    md5.update(chunk)
+                    output.write(chunk)
+            changed = (not os.path.exists(path) or
+                       file_digest(path) != md5.digest())
+            if changed:
+                os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    finally:
+        req.close()
+
+    state[url] = {'etag': req.headers.get('ETag'),
+                  'last_modified': req.headers.get('Last-Modified')}
+    return fetched, changed
+
+
+def grab_lists(url, output, auth=None, workers=4):
+    """Download all of the lists linked from the index page at url into
+    the output directory
+
+    Returns a dictionary of list URL to True (the list changed), False
+    (unchanged) or None (error), and the number of bytes fetched.
+
+    """
+    session = make_session(auth, workers)
+    req = session.get(url)
+    print "Downloading list index."
+    req.raise_for_status()
+    csvs = re.findall('href=\"([^\'\.\"]+\.csv)\"', req.text)
+
+    directory = os.path.join(output, "global")
+    if not os.path.exists(directory):
+        print "Creating \"global\" directory at %s." % directory
+        os.makedirs(directory)
+
+    state = load_state(output)
+    jobs = [(urljoin(url, csvfile), list_destination(output, csvfile))
+            for csvfile in csvs]
+
+    def download(job):
+        list_url, list_path = job
+        try:
+            fetched, changed = download_list(session, list_url, list_path,
+                                             state)
+        except Exception as exp:
+            print "Error downloading file \"%s\": %s" % (list_url, exp)
+            return list_url, None, 0
+        if changed:
+            print "Updated list \"%s\"." % list_url
+        else:
+            print "List \"%s\" has not changed." % list_url
+        return list_url, changed, fetched
+
+    pool = ThreadPool(max(workers, 1))
+    try:
+        downloads = pool.map(download, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    save_state(output, state)
+
+    results = dict((list_url, changed)
+                   for list_url, changed, _ in downloads)
+    fetched = sum(list_fetched for _, _, list_fetched in downloads)
+    print ("Fetched %d bytes, %d of %d lists changed, %d failed." %
+           (fetched, results.values().count(True), len(results),
+            results.values().count(None)))
+    return results, fetched
+
+
 if __name__ == "__main__":
 
     args = parse_args()
@@ -70,37 +247,4 @@ if __name__ == "__main__":
     else:
         auth = None
 
-    directory = os.path.join(args.output, "global")
-    req = requests.get(url, auth=auth)
-    print "Downloading list index."
-    req.raise_for_status()
-    csvs = re.findall('href=\"([^\'\.\"]+\.csv)\"', req.text)
-
-    if not os.path.exists(directory):
-        print "Creating \"global\" directory at %s." % directory
-        os.makedirs(directory)
-
-    for csvfile in csvs:
-        path = urljoin(url, csvfile)
-        print "Downloading  list \"%s\"." % path
-        try:
-            req = requests.get(path, auth=auth)
-            req.raise_for_status()
-        except Exception as exp:
-            print "Error downloading file \"%s\": %s" % (path, exp)
-            continue
-
-        path = os.path.join(args.output, "global", csvfile)
-
-        # find out if it is a country-specific list
-        base = os.path.splitext(csvfile)[0].upper()
-        if len(base) == 2:
-            directory = os.path.join(args.output, base)
-            if not os.path.exists(directory):
-                print "Creating directory for country %s at %s." % (base, directory)
-                os.makedirs(directory)
-            path = os.path.join(directory, "country_list.csv")
-
-        output = open(path, 'w')
-        output.write(req.text.encode('utf-8'))
-        output.close()
+    grab_lists(url, args.output, auth, args.workers)
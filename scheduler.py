@@ -6,37 +6,67 @@
 # appropriate clients, copying files into those directories, and
 # potentially modifying the scheduling frequency information
 #
-# Note: you *MUST NOT* start more than 1 instance of this program at
-# the same time. Doing so could cause race conditions in our scheduler
-# and could result in your experiments not being run at the expected
-# frequency
+# Note: the schedules are stored in the database and updated in
+# transactions, and files are put in place with atomic renames, so
+# several instances of this program can run at the same time.
 
 
 import argparse
 from datetime import datetime, timedelta
+import fcntl
 import json
+from multiprocessing.pool import ThreadPool
 import os
 import os.path
+import re
 import sys
+import tempfile
 
 
 import config
-from centinel.models import Client
+from centinel import blobstore, client_dirs, db
+from centinel.models import Client, Schedule
 
 
 # constants
 DAYS_SINCE_ACTIVE = 30
+SAMPLE_MODES = ['random', 'round-robin']
+SCOPES = ['client', 'country', 'global']
+# number of rows to update per statement
+BATCH_SIZE = 1000
+SCHEDULER_FILE = "scheduler.info"
+# country directories are named after the (uppercase) country code,
+# unlike the lowercase hex shard directories
+_country_reg = re.compile("^[A-Z]{2}$")
+# blobs that were stored or reused less than this many seconds ago are
+# not garbage collected, a concurrent run may not have linked them yet
+BLOB_MIN_AGE = 60 * 60
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     country_help = ('Two letter country code of the country to run the'
                     'experiment in')
-    parser.add_argument('--country', '-c', help=country_help, required=True)
+    parser.add_argument('--country', '-c', help=country_help, default=None)
+    scope_help = ("Where to put the experiment, data and frequency: "
+                  "'client' (default) for the selected clients of the "
+                  "country, 'country' for the baseline of the country, "
+                  "which all of its clients get, and 'global' for the "
+                  "global baseline, which all clients get")
+    parser.add_argument('--scope', help=scope_help, default='client',
+                        choices=SCOPES)
     client_help = ("Number of clients in the country to run the measurement "
                    "on. If this is not specified, the experiment will be "
                    "scheduled on all clients in the country")
-    parser.add_argument('--num-clients', '-n', help=client_help, default=None)
+    parser.add_argument('--num-clients', '-n', help=client_help, default=None,
+                        type=int)
+    sample_help = ("How to pick the clients when --num-clients is smaller "
+                   "than the number of active clients: 'random' picks them "
+                   "at random and 'round-robin' picks the clients after "
+                   "the ones picked by the previous round-robin run in the "
+                   "same country. By default, the database's order is used")
+    parser.add_argument('--sample', '-s', help=sample_help, default=None,
+                        choices=SAMPLE_MODES)
     data_help = ("Data file for the clients to use. Note that this must be "
                  "paired with an experiment file that has the same name "
                  "(specified at the top of the class in the experiment file)")
@@ -56,8 +86,20 @@ def parse_args():
                    "and -e options are specified")
     parser.add_argument('--remove', '-r', help=remove_help, default=False,
                         action='store_true')
+    workers_help = ("Number of client directories to update in parallel")
+    parser.add_argument('--workers', '-w', help=workers_help, default=1,
+                        type=int)
+    migrate_help = ("Import the existing scheduler.info files into the "
+                    "database and exit")
+    parser.add_argument('--migrate-schedules', help=migrate_help,
+                        default=False, action='store_true')
     args = parser.parse_args()
 
+    if args.migrate_schedules:
+        return args
+    if args.country is None and args.scope != 'global':
+        parser.error("argument --country/-c is required")
+
     if args.frequency is not None and args.experiment is None:
         parser.error("Specifying the frequency is only a valid option if you "
                      "are specifying an experiment to run. You must specify "
@@ -65,171 +107,329 @@ def parse_args():
     return args
 
 
-def find_clients(country, num_clients):
+def find_clients(country, num_clients, sample=None):
     """Find num_clients active clients in the target country
 
     Params:
     country- two letter country code of target country
     num_clients- number of clients to get. If this is None, then we
         get all the active clients for that country
+    sample- None, 'random' or 'round-robin' (see parse_args)
 
     Note: we define active here as having seen the client in the past
     month
 
     """
-    clients = []
-    potential_clients = Client.query.filter_by(country=country).all()
     month_diff = timedelta(days=DAYS_SINCE_ACTIVE)
-    for client in potential_clients:
-        if client.last_seen < datetime.now() - month_diff:
-            continue
-        if num_clients is not None and len(clients) >= num_clients:
-            break
-        clients.append(client.username)
-    return clients
+    query = db.session.query(Client.id, Client.username).\
+        filter(Client.country == country).\
+        filter(Client.last_seen >= datetime.now() - month_diff)
+
+    if sample != 'round-robin':
+        if sample == 'random':
+            query = query.order_by(db.func.random())
+        if num_clients is not None:
+            query = query.limit(num_clients)
+        return [row.username for row in query]
+
+    # the state is read and written back under a lock, so that
+    # concurrent round-robin runs pick the clients after each other's
+    with open(config.scheduler_state_file + ".lock", 'a') as lock_p:
+        fcntl.flock(lock_p, fcntl.LOCK_EX)
+        state = load_round_robin_state()
+        # start after the last client picked in this country and wrap
+        # around to the lowest ids
+        last_id = state.get(country, 0)
+        query = query.order_by((Client.id > last_id).desc(), Client.id)
+        if num_clients is not None:
+            query = query.limit(num_clients)
+        rows = query.all()
+        if rows:
+            state[country] = rows[-1].id
+            save_round_robin_state(state)
+    return [row.username for row in rows]
+
+
+def load_round_robin_state():
+    """Return the id of the last client picked by round-robin for each
+    country"""
+    if not os.path.exists(config.scheduler_state_file):
+        return {}
+    with open(config.scheduler_state_file, 'r') as file_p:
+        return json.load(file_p)
+
+
+def save_round_robin_state(state):
+    """Write the state to a temporary file and rename it into place, so
+    that it is never read partially written"""
+    fd, tmp_file = tempfile.mkstemp(
+        prefix=".scheduler-state-", suffix=".tmp",
+        dir=os.path.dirname(config.scheduler_state_file))
+    try:
+        with os.fdopen(fd, 'w') as file_p:
+            json.dump(state, file_p)
+        os.rename(tmp_file, config.scheduler_state_file)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+
+def scope_dir(base_dir, target, scope='client'):
+    """Return the directory of a client, or of the country or global
+    baseline for the other scopes"""
+    if scope == 'client':
+        return client_dirs.client_dir(base_dir, target)
+    return os.path.join(base_dir, target)
+
+
+def target_dir(base_dir, target, scope='client'):
+    """Return the directory of a client, or of the country or global
+    baseline for the other scopes, creating it if needed"""
+    directory = scope_dir(base_dir, target, scope)
+    client_dirs.makedirs(directory)
+    return directory
+
+
+def for_each_client(func, clients, workers=1):
+    """Call func for each client, using a pool of worker threads if
+    workers is more than 1"""
+    if workers <= 1:
+        for client in clients:
+            func(client)
+        return
+    pool = ThreadPool(workers)
+    try:
+        pool.map(func, clients)
+    finally:
+        pool.close()
+        pool.join()
 
 
-def copy_data(clients, data):
+def copy_data(clients, data, workers=1, scope='client'):
     """Copy the given data file so that it gets used by the clients
 
     Params:
     clients- the clients to copy the data file to
     data- the data file to copy into each user's directory
+    workers- number of clients to update in parallel
+    scope- 'client', 'country' or 'global'
+
+    Note: the content is stored once in the blob store and each
+    client's file is a link to it
 
     """
     if not os.path.exists(data):
         print "Error: invalid data file to copy from"
         return
-    with open(data, 'r') as file_p:
-        content = file_p.read()
+    _, blob = blobstore.store_file(data)
     basename = os.path.basename(data)
-    for client in clients:
-        client_data_dir = os.path.join(config.inputs_dir, client)
-        if not os.path.exists(client_data_dir):
-            print ("Error: client data directory does not exist! "
-                         "%s" % (client_data_dir))
-            continue
 
+    def copy_to_client(client):
+        client_data_dir = target_dir(config.inputs_dir, client, scope)
         filename = os.path.join(client_data_dir, basename)
-        with open(filename, 'w') as file_p:
-            file_p.write(content)
+        blobstore.link(blob, filename)
 
+    for_each_client(copy_to_client, clients, workers)
 
-def remove_data(clients, data):
+
+def remove_data(clients, data, workers=1, scope='client'):
     """Remove the given data file so that it does not get used by the clients
 
     Params:
     clients- the clients to copy the data file to
     data- the data file basename to remove
+    workers- number of clients to update in parallel
+    scope- 'client', 'country' or 'global'
 
     """
     data = os.path.basename(data)
-    for client in clients:
-        filename = os.path.join(config.inputs_dir, client, data)
+
+    def remove_from_client(client):
+        filename = os.path.join(scope_dir(config.inputs_dir, client, scope),
+                                data)
         if os.path.exists(filename):
             os.remove(filename)
 
+    for_each_client(remove_from_client, clients, workers)
+    blobstore.collect_garbage(min_age=BLOB_MIN_AGE)
 
-def copy_exps(clients, exp):
+
+def copy_exps(clients, exp, workers=1, scope='client'):
     """Copy the given experiment so that it gets used by the clients
 
     Params:
     clients- the clients to copy the data file to
     exp- the experiment to copy into each user's directory
+    workers- number of clients to update in parallel
+    scope- 'client', 'country' or 'global'
+
+    Note: the content is stored once in the blob store and each
+    client's file is a link to it
 
     """
     if not os.path.exists(exp):
         print "Error: invalid experiment to copy from"
         return
-    with open(exp, 'r') as file_p:
-        content = file_p.read()
+    _, blob = blobstore.store_file(exp)
     basename = os.path.basename(exp)
-    for client in clients:
-        client_experiments_dir = os.path.join(config.experiments_dir, client)
-        if not os.path.exists(client_experiments_dir):
-            print ("Error: client experiments directory does not exist! "
-                         "%s" % (client_data_dir))
-            continue
 
+    def copy_to_client(client):
+        client_experiments_dir = target_dir(config.experiments_dir, client,
+                                            scope)
         filename = os.path.join(client_experiments_dir, basename)
-        with open(filename, 'w') as file_p:
-            file_p.write(content)
+        blobstore.link(blob, filename)
+
+    for_each_client(copy_to_client, clients, workers)
 
 
-def remove_exps(clients, exp):
+def remove_exps(clients, exp, workers=1, scope='client'):
     """Remove the given experiment so that it does not get used by the clients
 
     Params:
     clients- the clients to copy the data file to
     exp- the experiment file basename to remove
+    workers- number of clients to update in parallel
+    scope- 'client', 'country' or 'global'
 
     """
     basename = os.path.basename(exp)
-    for client in clients:
-        filename = os.path.join(config.experiments_dir, client, basename)
+
+    def remove_from_client(client):
+        filename = os.path.join(scope_dir(config.experiments_dir, client,
+                                          scope), basename)
         if os.path.exists(filename):
             os.remove(filename)
 
+    for_each_client(remove_from_client, clients, workers)
+    blobstore.collect_garbage(min_age=BLOB_MIN_AGE)
+
+
+def scope_keys(targets, scope):
+    """Return the schedule scope keys for the target directories"""
+    if scope == 'global':
+        return ['']
+    return list(targets)
+
 
-def copy_frequency(clients, freq, exp):
+def copy_frequency(targets, freq, exp, scope='client'):
     """Schedule the given experiment to run at the frequency specified
 
     Params:
-    clients- the clients to update the frequencies for
+    targets- the clients (or the country, or "global") to update the
+        frequencies for
     freq- how many minutes should elapse between runs, i.e. enter 60 to
         run every hour
     exp- the experiment to adjust the frequency for
+    scope- 'client', 'country' or 'global'
+
+    Note: the schedules of all of the targets are updated in a single
+    transaction
 
     """
     exp_name, _ = os.path.splitext(os.path.basename(exp))
-    for client in clients:
-        # if the experiment doesn't exist for that user, then don't
-        # adjust the frequency
-        exp_file = os.path.join(config.experiments_dir, client, exp)
-        if not os.path.exists(exp_file):
-            continue
-        filename = os.path.join(config.experiments_dir, client,
-                                "scheduler.info")
-        freqs = {}
-        if os.path.exists(filename):
-            with open(filename, 'r') as file_p:
-                freqs = json.load(file_p)
-        freqs[exp_name] = {'last_run': 0, 'frequency': int(freq) * 60}
-        # Note: as mentioned in the first few introductory lines, this
-        # section presents a race condition if another instance of the
-        # scheduler is running at the same time and your experiment
-        # may not be scheduled
-        with open(filename, 'w') as file_p:
-            json.dump(freqs, file_p)
-
-
-def remove_frequency(clients, exp):
+    # if the experiment doesn't exist for that user, then don't
+    # adjust the frequency
+    targets = [target for target in targets
+               if os.path.exists(os.path.join(scope_dir(config.experiments_dir,
+                                                        target, scope),
+                                              os.path.basename(exp)))]
+    if not targets:
+        return
+    keys = scope_keys(targets, scope)
+
+    table = Schedule.__table__
+    for start in range(0, len(keys), BATCH_SIZE):
+        batch = keys[start:start + BATCH_SIZE]
+        db.session.execute(table.delete().
+                           where(table.c.scope == scope).
+                           where(table.c.scope_key.in_(batch)).
+                           where(table.c.experiment == exp_name))
+        db.session.execute(table.insert(),
+                           [{'scope': scope, 'scope_key': key,
+                             'experiment': exp_name,
+                             'frequency': int(freq) * 60,
+                             'last_run': 0} for key in batch])
+    db.session.commit()
+
+
+def remove_frequency(targets, exp, scope='client'):
     """Remove the given experiment from the scheduler
 
     Params:
-    clients- the clients to update the frequencies for
+    targets- the clients (or the country, or "global") to update the
+        frequencies for
     exp- the experiment to adjust the frequency for
+    scope- 'client', 'country' or 'global'
 
     """
-    exp = os.path.basename(exp)
-    for client in clients:
-        filename = os.path.join(config.experiments_dir, client,
-                                "scheduler.info")
-        freqs = {}
-        if os.path.exists(filename):
-            with open(filename, 'r') as file_p:
-                freqs = json.load(file_p)
-        if freqs.get(exp) is not None:
-            del freqs[exp]
-        if freqs == {}:
-            os.remove(filename)
-            return
-        # Note: as mentioned in the first few introductory lines, this
-        # section presents a race condition if another instance of the
-        # scheduler is running at the same time and your experiment
-        # may not be scheduled
-        with open(filename, 'w') as file_p:
-            json.dump(freqs, file_p)
+    # the schedule is keyed on the experiment name, without extension
+    exp_name, _ = os.path.splitext(os.path.basename(exp))
+    keys = scope_keys(targets, scope)
+    table = Schedule.__table__
+    for start in range(0, len(keys), BATCH_SIZE):
+        batch = keys[start:start + BATCH_SIZE]
+        db.session.execute(table.delete().
+                           where(table.c.scope == scope).
+                           where(table.c.scope_key.in_(batch)).
+                           where(table.c.experiment == exp_name))
+    db.session.commit()
+
+
+def find_schedule_files():
+    """Return the scope, scope key and path of each scheduler.info file
+    in the experiment directories. Client directories are looked for in
+    every shard layout (see client_dirs.existing_client_dirs)."""
+    usernames = set(username for username, in
+                    db.session.query(Client.username) if username)
+    files = []
+    for name in sorted(os.listdir(config.experiments_dir)):
+        filename = os.path.join(config.experiments_dir, name, SCHEDULER_FILE)
+        if name in usernames or not os.path.isfile(filename):
+            continue
+        if name == 'global':
+            files.append(('global', '', filename))
+        elif _country_reg.match(name):
+            files.append(('country', name, filename))
+        else:
+            print "Skipping schedule of unknown client %s" % (name)
+    for username in sorted(usernames):
+        for directory in client_dirs.existing_client_dirs(
+                config.experiments_dir, username):
+            filename = os.path.join(directory, SCHEDULER_FILE)
+            if os.path.isfile(filename):
+                files.append(('client', username, filename))
+    return files
+
+
+def migrate_schedules():
+    """Import the scheduler.info files of the experiment directories
+    into the schedules table.
+
+    The global, country and client schedules are imported in one
+    transaction. Existing rows are left alone. Once imported, each file
+    is renamed to .scheduler.info.migrated, so the server no longer
+    sees it.
+
+    """
+    migrated = []
+    for scope, key, filename in find_schedule_files():
+        with open(filename, 'r') as file_p:
+            freqs = json.load(file_p)
+        for exp_name, info in freqs.iteritems():
+            exists = Schedule.query.filter_by(scope=scope, scope_key=key,
+                                              experiment=exp_name).first()
+            if exists is not None:
+                continue
+            db.session.add(Schedule(scope, key, exp_name,
+                                    info.get('frequency'),
+                                    info.get('last_run', 0)))
+        migrated.append(filename)
+    db.session.commit()
+
+    for filename in migrated:
+        os.rename(filename, os.path.join(os.path.dirname(filename),
+                                         ".scheduler.info.migrated"))
+    print "Migrated %d scheduler.info files" % (len(migrated))
 
 
 if __name__ == "__main__":
@@ -237,8 +437,17 @@ if __name__ == "__main__":
     # so we don't need to specify default values
     args = parse_args()
 
-    # lookup the clients/ probes to use
-    clients = find_clients(args.country, args.num_clients)
+    if args.migrate_schedules:
+        migrate_schedules()
+        sys.exit(0)
+
+    # lookup the clients/ probes to use, or the baseline directory
+    if args.scope == 'global':
+        clients = ['global']
+    elif args.scope == 'country':
+        clients = [args.country]
+    else:
+        clients = find_clients(args.country, args.num_clients, args.sample)
 
     # print the clients and return if we are not copying any files over
     if args.experiment is None and args.data is None:
@@ -252,18 +461,18 @@ if __name__ == "__main__":
     # copy the data files if necessary
     if args.data is not None:
         if args.remove:
-            remove_data(clients, args.data)
+            remove_data(clients, args.data, args.workers, args.scope)
         else:
-            copy_data(clients, args.data)
+            copy_data(clients, args.data, args.workers, args.scope)
 
     # copy the experiment files if necessary
     if args.experiment is not None:
         if args.remove:
-            remove_exps(clients, args.experiment)
-            remove_frequency(clients, args.experiment)
+            remove_exps(clients, args.experiment, args.workers, args.scope)
+            remove_frequency(clients, args.experiment, args.scope)
         else:
-            copy_exps(clients, args.experiment)
+            copy_exps(clients, args.experiment, args.workers, args.scope)
 
     # add the frequency info as appropriate
     if not args.remove and args.frequency is not None:
-        copy_frequency(clients, args.frequency, args.experiment)
+        copy_frequency(clients, args.frequency, args.experiment, args.scope)
@@ -2,15 +2,45 @@ import flask
 from flask import Flask
 from flask.ext.testing import TestCase
 
-from server import app, db, Client
+from centinel import app, db
+from centinel.models import Client
+import centinel.views
 import config
+import list_grabber
+import scheduler
+from centinel import blobstore
+from centinel import client_dirs
+from centinel import compression
+from centinel import consent
+from centinel import freedom_house
+from centinel import hash_index
+from centinel import ingest
+from centinel import result_files
+from centinel import result_index
+from centinel import uploads
+from centinel import write_behind
+from centinel.as_info import ASInfo
+from centinel.cache import CredentialCache, credential_cache
+from centinel.handles import handle_pool
+from centinel.models import Role, Schedule, get_client_schedule
 #for tests
+import BaseHTTPServer
 import os
+import random
+import shutil
+import tempfile
+import threading
+import time
 from cStringIO import StringIO
 import unittest
 import uuid
 import base64
+import gzip
+import hashlib
+from datetime import datetime
+import json
 import io
+from netaddr import IPAddress, IPNetwork
 from passlib.apps import custom_app_context as pwd_context
 
 class MyTest(TestCase):
@@ -25,6 +55,10 @@ class MyTest(TestCase):
 
     def setUp(self):
         db.create_all()
+        # the roles run.py creates
+        db.session.add(Role('admin'))
+        db.session.add(Role('client'))
+        db.session.commit()
         user = Client(username=self.testUsername,password=self.testPassword)
         db.session.add(user)
         db.session.commit()
@@ -63,6 +97,9 @@ class MyTest(TestCase):
 
     def test_results_POST(self):
         url = '/results'
+        user = Client.query.filter_by(username=self.testUsername).first()
+        user.has_given_consent = True
+        db.session.commit()
         with open('testfile','wb') as test_file:
             test_file.write('Hello Centinels')
         with open('testfile','r') as test_file:
@@ -73,29 +110,294 @@ class MyTest(TestCase):
             files = {'result' : test_file}
             response = self.client.post(url, data=files, headers=headers)
         self.assert_status(response, 201)
-        self.assertTrue(os.path.isfile(os.path.join(config.centinel_home, 'results/testfile')))
-        os.remove(os.path.join(config.centinel_home, 'results/testfile'))
+        path = os.path.join(client_dirs.client_dir(config.results_dir,
+                                                   self.testUsername),
+                            'testfile')
+        self.assertTrue(os.path.isfile(path))
+        os.remove(path)
         os.remove('testfile')
         ###X: Testing encoding mismatch?
 
+    def test_results_POST_is_indexed(self):
+        user = Client.query.filter_by(username=self.testUsername).first()
+        user.has_given_consent = True
+        user.country = 'IR'
+        # keep the country, the test server can't geolocate the client
+        user.is_vpn = True
+        db.session.commit()
+        headers = {'Authorization': 'Basic ' +
+                   base64.b64encode(self.testUsername + ":" +
+                                    self.testPassword)}
+        content = '{"http_request": {}}'
+        response = self.client.post('/results', headers=headers, data={
+            'result': (StringIO(content), 'indexed.json')})
+        self.assert_status(response, 201)
+        rows = result_index.find_results(country='IR',
+                                         username=self.testUsername).all()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].file_name, 'indexed.json')
+        self.assertEqual(rows[0].size, len(content))
+        self.assertEqual(rows[0].sha256, hashlib.sha256(content).hexdigest())
+        self.assertTrue(os.path.isfile(rows[0].path))
+        os.remove(rows[0].path)
+
+        result_index.set_experiment(self.testUsername, 'indexed.json',
+                                    'http_request')
+        self.assertEqual(result_index.find_results(
+            experiment='http_request').count(), 1)
+
+    def test_results_exists(self):
+        user = Client.query.filter_by(username=self.testUsername).first()
+        user.has_given_consent = True
+        db.session.commit()
+        headers = {'Authorization': 'Basic ' +
+                   base64.b64encode(self.testUsername + ":" +
+                                    self.testPassword)}
+        content = '{"dns": []}'
+        digest = hashlib.sha256(content).hexdigest()
+        response = self.client.post('/results', headers=headers, data={
+            'result': (StringIO(content), 'uploaded.json')})
+        self.assert_status(response, 201)
+
+        response = self.client.post(
+            '/results/exists', headers=headers,
+            content_type='application/json',
+            data=flask.json.dumps({'results': [
+                {'filename': 'uploaded.json', 'sha256': digest.upper()},
+                {'filename': 'other.json', 'sha256': digest}]}))
+        self.assert_200(response)
+        self.assertEqual(response.json, {'results': {'uploaded.json': True,
+                                                     'other.json': False}})
+        row = result_index.find_results(username=self.testUsername).first()
+        os.remove(row.path)
+
+    def test_client_details(self):
+        url = '/client_details'
+        response = self.open_with_auth(url, 'GET', self.testUsername,
+                                       self.testPassword)
+        self.assert_401(response)
+
+        admin = Client(username='admin', password=self.testPassword,
+                       roles=['admin'])
+        admin.country = 'US'
+        db.session.add(admin)
+        for number in range(3):
+            client = Client(username='client-%d' % (number),
+                            password=self.testPassword)
+            client.country = 'IR'
+            client.is_vpn = number == 1
+            client.last_seen = datetime(2015, 1, number + 1)
+            db.session.add(client)
+        db.session.commit()
+
+        def get(query):
+            return self.open_with_auth(url + query, 'GET', 'admin',
+                                       self.testPassword)
+
+        response = get('')
+        self.assert_200(response)
+        self.assertEqual(len(response.json['clients']), 5)
+        self.assertFalse('next_cursor' in response.json)
+
+        response = get('?country=ir&is_vpn=false&fields=username,is_vpn'
+                       '&seen_since=2015-01-01&limit=1')
+        self.assert_200(response)
+        self.assertEqual(response.json['clients'],
+                         [{'username': 'client-0', 'is_vpn': False}])
+        response = get('?country=IR&is_vpn=false&fields=username&limit=1'
+                       '&cursor=' + response.json['next_cursor'])
+        self.assertEqual(response.json, {'clients': [{'username':
+                                                      'client-2'}],
+                                         'next_cursor': None})
+
+        response = get('?seen_until=2015-01-02T12:00:00&format=csv'
+                       '&fields=username,last_seen')
+        self.assert_200(response)
+        self.assertEqual(response.data.splitlines(),
+                         ['username,last_seen',
+                          'client-0,"Thu, 01 Jan 2015 00:00:00 GMT"',
+                          'client-1,"Fri, 02 Jan 2015 00:00:00 GMT"'])
+        response = get('?is_vpn=true&fields=username,last_seen'
+                       '&format=ndjson')
+        self.assertEqual([json.loads(line) for line in
+                          response.data.splitlines()],
+                         [{'username': 'client-1',
+                           'last_seen': 'Fri, 02 Jan 2015 00:00:00 GMT'}])
+
+        for query in ['?fields=password_hash', '?is_vpn=maybe',
+                      '?seen_since=yesterday', '?limit=0', '?cursor=x',
+                      '?format=xml']:
+            self.assert_400(get(query))
+
+    def test_results_are_compressed_after_upload(self):
+        user = Client.query.filter_by(username=self.testUsername).first()
+        user.has_given_consent = True
+        db.session.commit()
+        headers = {'Authorization': 'Basic ' +
+                   base64.b64encode(self.testUsername + ":" +
+                                    self.testPassword)}
+        content = '{"dns": %s}' % (json.dumps(range(1000)))
+        tmp_dir = tempfile.mkdtemp()
+        queue = ingest.ingest_queue
+        settings = (config.compress_results, config.ingest_results)
+        ingest.ingest_queue = ingest.IngestQueue(os.path.join(tmp_dir,
+                                                              'queue'))
+        config.compress_results = config.ingest_results = True
+        try:
+            response = self.client.post('/results', headers=headers, data={
+                'result': (StringIO(content), 'compressed.json')})
+            self.assert_status(response, 201)
+            row = result_index.find_results(
+                username=self.testUsername).first()
+            # the upload doesn't wait for the compression
+            self.assertEqual(compression.detect_codec(row.path), None)
+            self.assertEqual(ingest.ingest_queue.depth()['pending'], 1)
+
+            ingest.work(ingest.ingest_queue, max_jobs=1)
+            self.assertEqual(compression.detect_codec(row.path),
+                             compression.GZIP)
+            self.assertEqual(result_files.load_result(row.path),
+                             json.loads(content))
+            os.remove(row.path)
+        finally:
+            ingest.ingest_queue = queue
+            config.compress_results, config.ingest_results = settings
+            shutil.rmtree(tmp_dir)
+
+    def test_results_are_compressed_without_ingestion(self):
+        user = Client.query.filter_by(username=self.testUsername).first()
+        user.has_given_consent = True
+        db.session.commit()
+        headers = {'Authorization': 'Basic ' +
+                   base64.b64encode(self.testUsername + ":" +
+                                    self.testPassword)}
+        content = '{"dns": %s}' % (json.dumps(range(1000)))
+        settings = (config.compress_results, config.ingest_results)
+        config.compress_results = True
+        config.ingest_results = False
+        try:
+            response = self.client.post('/results', headers=headers, data={
+                'result': (StringIO(content), 'compressed.json')})
+            self.assert_status(response, 201)
+            row = result_index.find_results(
+                username=self.testUsername).first()
+            self.assertEqual(compression.detect_codec(row.path),
+                             compression.GZIP)
+            self.assertEqual(result_files.load_result(row.path),
+                             json.loads(content))
+            os.remove(row.path)
+        finally:
+            config.compress_results, config.ingest_results = settings
+
     def test_experiments(self):
         url = '/experiments'
-        response = self.client.get(url)
+        self.check_broken_auth(url)
+        user = Client.query.filter_by(username=self.testUsername).first()
+        user.has_given_consent = True
+        db.session.commit()
+        response = self.open_with_auth(url, 'GET', self.testUsername,
+                                       self.testPassword)
         self.assert_200(response)
         #XXX: Could be expanded?
         for experiment in response.json["experiments"]:
             url = '/experiments/{0}'.format(experiment)
-            response_ = self.client.get(url)
-            self.assert_200(response)
+            response_ = self.open_with_auth(url, 'GET', self.testUsername,
+                                            self.testPassword)
+            self.assert_200(response_)
 
     def test_clients(self):
         url = '/clients'
-        #Check for broken auth ->
-        self.check_broken_auth(url)
-        #Check working auth ->
-        response = self.open_with_auth(url,'GET',self.testUsername, self.testPassword)
+        # the client list is public
+        response = self.client.get(url)
         self.assert_200(response)
-        self.assertEquals(response.json, {"clients" : [self.testUsername]})
+        self.assertTrue(isinstance(response.json["clients"], list))
+
+    def test_input_files_versioned(self):
+        user = Client.query.filter_by(username=self.testUsername).first()
+        user.has_given_consent = True
+        db.session.commit()
+        user_dir = client_dirs.client_dir(config.inputs_dir,
+                                          self.testUsername, create=True)
+        path = os.path.join(user_dir, 'hosts.txt')
+        headers = {'Authorization': 'Basic ' +
+                   base64.b64encode(self.testUsername + ":" +
+                                    self.testPassword)}
+        try:
+            with open(path, 'w') as file_p:
+                file_p.write('example.com\n')
+            response = self.client.get('/input_files', headers=headers)
+            self.assert_200(response)
+            self.assertTrue('hosts.txt' in response.json['inputs'])
+            etag = response.headers['ETag']
+
+            headers['If-None-Match'] = etag
+            response = self.client.get('/input_files', headers=headers)
+            self.assert_status(response, 304)
+            self.assertEqual(response.data, '')
+
+            with open(path, 'a') as file_p:
+                file_p.write('example.org\n')
+            response = self.client.get('/input_files', headers=headers)
+            self.assert_200(response)
+            self.assertNotEqual(response.headers['ETag'], etag)
+        finally:
+            shutil.rmtree(user_dir)
+
+    def test_result_upload_size(self):
+        user = Client.query.filter_by(username=self.testUsername).first()
+        user.has_given_consent = True
+        db.session.commit()
+        headers = {'Authorization': 'Basic ' +
+                   base64.b64encode(self.testUsername + ":" +
+                                    self.testPassword)}
+        for size in [True, -1, '10', 1.5]:
+            response = self.client.post(
+                '/results/uploads', headers=headers,
+                content_type='application/json',
+                data=flask.json.dumps({'filename': 'result.json',
+                                       'size': size}))
+            self.assert_400(response)
+
+        content = 'Hello Centinels'
+        response = self.client.post(
+            '/results/uploads', headers=headers,
+            content_type='application/json',
+            data=flask.json.dumps({'filename': 'chunked.json',
+                                   'size': len(content)}))
+        self.assert_status(response, 201)
+        url = '/results/uploads/' + response.json['upload_id']
+        response = self.client.put(url + '?offset=0', headers=headers,
+                                   data=content)
+        self.assert_200(response)
+        self.assertEqual(response.json['offset'], len(content))
+        response = self.client.post(
+            url + '/finalize', headers=headers,
+            content_type='application/json',
+            data=flask.json.dumps({'sha256':
+                                   hashlib.sha256(content).hexdigest()}))
+        self.assert_status(response, 201)
+        row = result_index.find_results(username=self.testUsername).first()
+        self.assertEqual(row.file_name, 'chunked.json')
+        with open(row.path) as file_p:
+            self.assertEqual(file_p.read(), content)
+        os.remove(row.path)
+
+    def test_clients_snapshot_is_rebuilt(self):
+        self.assert_200(self.client.get('/clients'))
+        user = Client.query.filter_by(username=self.testUsername).first()
+        user.last_seen = datetime(2015, 1, 1)
+        user.country = 'IR'
+        db.session.commit()
+        centinel.views.invalidate_client_snapshot()
+        # the snapshot is rebuilt by a background thread
+        deadline = time.time() + 10
+        while True:
+            clients = self.client.get('/clients').json['clients']
+            if [client['country'] for client in clients] == ['IR']:
+                break
+            self.assertTrue(time.time() < deadline, clients)
+            time.sleep(0.05)
+        self.assertEqual(clients[0]['last_seen'], '2015-01-01')
 
     def test_register(self):
         url = '/register'
@@ -104,11 +406,1217 @@ class MyTest(TestCase):
         response = self.client.post(url, \
             data = flask.json.dumps({'username': testUsername, 'password': testPassword}),\
             content_type='application/json')
-        self.assertEquals(response.json, {"status" : "success"})
+        self.assertEquals(response.json["status"], "success")
         self.assert_status(response,201)
         client = Client.query.filter_by(username=testUsername).first()
         self.assertEquals(client.username, testUsername)
+        self.assertEquals(client.typeable_handle,
+                          response.json["typeable_handle"])
         self.assertTrue(client.verify_password(testPassword))
 
+    def test_register_retries_taken_handle(self):
+        user = Client.query.filter_by(username=self.testUsername).first()
+        user.typeable_handle = 'taken123'
+        db.session.commit()
+        handles = iter(['taken123', 'free1234'])
+        take = handle_pool.take
+        handle_pool.take = lambda: next(handles)
+        try:
+            response = self.client.post('/register', \
+                data = flask.json.dumps({'username': str(uuid.uuid4()),
+                                         'password': 'somepassword'}),\
+                content_type='application/json')
+        finally:
+            handle_pool.take = take
+        self.assert_status(response, 201)
+        self.assertEquals(response.json['typeable_handle'], 'free1234')
+
+
+class WriteBehindTest(TestCase):
+
+    def create_app(self):
+        return app
+
+    def setUp(self):
+        db.create_all()
+        db.session.add(Client(username='client', password='password'))
+        db.session.commit()
+        # a long interval, the tests flush explicitly
+        self.buffer = write_behind.ClientInfoBuffer(3600, 100)
+
+    def tearDown(self):
+        self.buffer.stop()
+        db.session.remove()
+        db.drop_all()
+
+    def client_info(self):
+        db.session.expire_all()
+        client = Client.query.filter_by(username='client').first()
+        return client.last_ip, client.last_seen, client.country
+
+    def test_flush_writes_latest_update(self):
+        self.buffer.record('client', '10.0.0.0/24', datetime(2015, 1, 1),
+                           'IR')
+        self.buffer.record('client', '10.0.1.0/24', datetime(2015, 1, 2),
+                           'US')
+        self.buffer.flush()
+        self.assertEqual(self.client_info(),
+                         ('10.0.1.0/24', datetime(2015, 1, 2), 'US'))
+
+    def test_flush_keeps_newer_synchronous_update(self):
+        self.buffer.record('client', '10.0.0.0/24', datetime(2015, 1, 1),
+                           'IR')
+        # written synchronously after the update above was queued
+        client = Client.query.filter_by(username='client').first()
+        client.last_ip = '10.0.1.0/24'
+        client.last_seen = datetime(2015, 1, 2)
+        client.country = 'US'
+        db.session.commit()
+        self.buffer.flush()
+        self.assertEqual(self.client_info(),
+                         ('10.0.1.0/24', datetime(2015, 1, 2), 'US'))
+
+    def test_failed_flush_requeues_updates(self):
+        self.buffer.record('client', '10.0.0.0/24', datetime(2015, 1, 1),
+                           'IR')
+        self.buffer.record('other', '10.0.2.0/24', datetime(2015, 1, 1),
+                           'IR')
+        buffer = self.buffer
+
+        class BrokenEngine(object):
+            def begin(self):
+                # a newer update arrives while the flush is running
+                buffer.record('client', '10.0.1.0/24',
+                              datetime(2015, 1, 2), 'US')
+                raise IOError("database on fire")
+
+        write_behind.db = type('BrokenDB', (object,),
+                               {'engine': BrokenEngine()})()
+        try:
+            self.buffer.flush()
+        finally:
+            write_behind.db = db
+        self.assertEqual(sorted(self.buffer._pending), ['client', 'other'])
+        self.assertEqual(self.buffer._pending['client']['b_last_seen'],
+                         datetime(2015, 1, 2))
+
+        self.buffer.flush()
+        self.assertEqual(self.buffer._pending, {})
+        self.assertEqual(self.client_info(),
+                         ('10.0.1.0/24', datetime(2015, 1, 2), 'US'))
+
+
+class CredentialCacheTest(TestCase):
+
+    def create_app(self):
+        return app
+
+    def setUp(self):
+        db.create_all()
+        db.session.add(Role('admin'))
+        db.session.add(Client(username='client', password='password'))
+        db.session.commit()
+        credential_cache.clear()
+        # count the password hashes that are checked
+        self.hash_checks = []
+        self.verify = Client.verify_password
+
+        def verify(client, password):
+            self.hash_checks.append(password)
+            return self.verify(client, password)
+        Client.verify_password = verify
+
+    def tearDown(self):
+        Client.verify_password = self.verify
+        credential_cache.clear()
+        db.session.remove()
+        db.drop_all()
+
+    def test_cache_hit_skips_the_hash(self):
+        verify_password = centinel.views.verify_password
+        self.assertTrue(verify_password('client', 'password'))
+        self.assertTrue(verify_password('client', 'password'))
+        self.assertEqual(self.hash_checks, ['password'])
+
+    def test_wrong_password_is_not_cached(self):
+        verify_password = centinel.views.verify_password
+        self.assertTrue(verify_password('client', 'password'))
+        self.assertFalse(verify_password('client', 'wrong'))
+        self.assertFalse(verify_password('client', 'wrong'))
+        self.assertFalse(verify_password('nobody', 'password'))
+        self.assertEqual(self.hash_checks, ['password', 'wrong', 'wrong'])
+
+    def test_entries_expire(self):
+        cache = CredentialCache(10, ttl=0.05)
+        key = cache.digest('client', 'password')
+        cache.put(key, 'client')
+        self.assertEqual(cache.get(key), 'client')
+        time.sleep(0.1)
+        self.assertEqual(cache.get(key), None)
+
+    def test_keys_are_not_the_credentials(self):
+        cache = CredentialCache(10)
+        key = cache.digest('client', 'password')
+        self.assertFalse('password' in key)
+        self.assertNotEqual(key, cache.digest('client', 'passwore'))
+        # another process uses another key
+        self.assertNotEqual(key, CredentialCache(10).digest('client',
+                                                            'password'))
+
+    def test_password_change_invalidates(self):
+        verify_password = centinel.views.verify_password
+        self.assertTrue(verify_password('client', 'password'))
+        client = Client.query.filter_by(username='client').first()
+        client.password_hash = pwd_context.encrypt('new password')
+        db.session.commit()
+        self.assertEqual(len(credential_cache), 0)
+        self.assertFalse(verify_password('client', 'password'))
+        self.assertTrue(verify_password('client', 'new password'))
+
+    def test_role_change_invalidates(self):
+        verify_password = centinel.views.verify_password
+        self.assertTrue(verify_password('client', 'password'))
+        client = Client.query.filter_by(username='client').first()
+        client.roles.append(Role.query.filter_by(name='admin').first())
+        db.session.commit()
+        self.assertEqual(len(credential_cache), 0)
+        self.assertTrue(verify_password('client', 'password'))
+        self.assertEqual(len(self.hash_checks), 2)
+
+
+class HashIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.index_file = os.path.join(self.tmp_dir, 'index.json')
+        self.index = hash_index.HashIndex(self.index_file, 60)
+        self.path = os.path.join(self.tmp_dir, 'http_request.py')
+        self.write('print "hello"', 1000000000)
+        self.hashed = []
+        self.hash_file = hash_index.hash_file
+
+        def hash_file(path):
+            self.hashed.append(path)
+            return self.hash_file(path)
+        hash_index.hash_file = hash_file
+
+    def tearDown(self):
+        hash_index.hash_file = self.hash_file
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, content, mtime, path=None):
+        path = path or self.path
+        with open(path, 'w') as file_p:
+            file_p.write(content)
+        os.utime(path, (mtime, mtime))
+
+    def test_unchanged_file_is_not_hashed_again(self):
+        digest = self.index.digest(self.path)
+        self.assertEqual(digest, self.hash_file(self.path))
+        self.assertEqual(self.index.digest(self.path), digest)
+        self.assertEqual(len(self.hashed), 1)
+
+    def test_changed_file_is_hashed_again(self):
+        first = self.index.digest(self.path)
+        # size
+        self.write('print "hello world"', 1000000000)
+        second = self.index.digest(self.path)
+        self.assertNotEqual(second, first)
+        # modification time, same size
+        self.write('print "HELLO WORLD"', 1000000001)
+        third = self.index.digest(self.path)
+        self.assertNotEqual(third, second)
+        # inode, same size and modification time
+        new_path = os.path.join(self.tmp_dir, 'new.py')
+        self.write('print "hello WORLD"', 1000000001, new_path)
+        os.rename(new_path, self.path)
+        self.assertNotEqual(self.index.digest(self.path), third)
+        self.assertEqual(len(self.hashed), 4)
+
+    def test_index_is_persisted(self):
+        digest = self.index.digest(self.path)
+        removed = os.path.join(self.tmp_dir, 'removed.py')
+        self.write('print "bye"', 1000000000, removed)
+        self.index.digest(removed)
+        os.remove(removed)
+        self.index.save()
+        # no temporary file is left behind
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['http_request.py', 'index.json'])
+        with open(self.index_file) as file_p:
+            self.assertEqual(list(json.load(file_p)), [self.path])
+
+        reloaded = hash_index.HashIndex(self.index_file, 60)
+        self.assertEqual(reloaded.digest(self.path), digest)
+        self.assertEqual(len(self.hashed), 2)
+
+    def test_concurrent_saves(self):
+        paths = []
+        for number in range(50):
+            path = os.path.join(self.tmp_dir, '%d.py' % (number))
+            self.write('print %d' % (number), 1000000000, path)
+            paths.append(path)
+
+        def hash_and_save(path):
+            self.index.digest(path)
+            self.index.save()
+        threads = [threading.Thread(target=hash_and_save, args=(path,))
+                   for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.index.save()
+        with open(self.index_file) as file_p:
+            self.assertEqual(sorted(json.load(file_p)), sorted(paths))
+        self.assertFalse([name for name in os.listdir(self.tmp_dir)
+                          if name.endswith('.tmp')])
+
+    def test_unreadable_index_is_ignored(self):
+        with open(self.index_file, 'w') as file_p:
+            file_p.write('{"truncated')
+        self.assertEqual(self.index.digest(self.path),
+                         self.hash_file(self.path))
+
+
+class UploadsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.user_dir)
+
+    def test_chunked_upload(self):
+        content = 'Hello Centinels'
+        upload_id = uploads.start_upload(self.user_dir, 'result.json',
+                                         len(content))
+        self.assertEqual(uploads.upload_offset(self.user_dir, upload_id), 0)
+        self.assertEqual(uploads.append_chunk(self.user_dir, upload_id, 0,
+                                              StringIO(content[:5])), 5)
+        # a chunk that was already received
+        with self.assertRaises(uploads.UploadError) as raised:
+            uploads.append_chunk(self.user_dir, upload_id, 0,
+                                 StringIO(content[:5]))
+        self.assertEqual((raised.exception.status, raised.exception.offset),
+                         (409, 5))
+        # the upload is not complete yet
+        digest = hashlib.sha256(content).hexdigest()
+        with self.assertRaises(uploads.UploadError) as raised:
+            uploads.finish_upload(self.user_dir, upload_id, digest)
+        self.assertEqual(raised.exception.status, 409)
+
+        uploads.append_chunk(self.user_dir, upload_id, 5,
+                             StringIO(content[5:]))
+        with self.assertRaises(uploads.UploadError) as raised:
+            uploads.finish_upload(self.user_dir, upload_id, '0' * 64)
+        self.assertEqual(raised.exception.status, 422)
+
+        path, file_name, sha256 = uploads.finish_upload(
+            self.user_dir, upload_id, digest.upper())
+        self.assertEqual((file_name, sha256), ('result.json', digest))
+        with open(path) as file_p:
+            self.assertEqual(file_p.read(), content)
+        self.assertEqual(os.listdir(self.user_dir),
+                         [os.path.basename(path)])
+
+    def test_finished_upload_takes_no_chunks(self):
+        upload_id = uploads.start_upload(self.user_dir, 'result.json')
+        uploads.append_chunk(self.user_dir, upload_id, 0, StringIO('abc'))
+        part_path = uploads.part_path(self.user_dir, upload_id)
+        # a request that opened the upload before it was finished
+        with open(part_path, 'ab') as file_p:
+            uploads.finish_upload(self.user_dir, upload_id,
+                                  hashlib.sha256('abc').hexdigest())
+            with self.assertRaises(uploads.UploadError) as raised:
+                uploads._check_not_finished(part_path, file_p)
+            self.assertEqual(raised.exception.status, 404)
+        with self.assertRaises(uploads.UploadError) as raised:
+            uploads.append_chunk(self.user_dir, upload_id, 3,
+                                 StringIO('def'))
+        self.assertEqual(raised.exception.status, 404)
+
+    def test_too_large(self):
+        with self.assertRaises(uploads.UploadError) as raised:
+            uploads.start_upload(self.user_dir, 'result.json',
+                                 config.max_result_size + 1)
+        self.assertEqual(raised.exception.status, 413)
+
+    def test_expire_uploads(self):
+        old = uploads.start_upload(self.user_dir, 'old.json')
+        new = uploads.start_upload(self.user_dir, 'new.json')
+        long_ago = time.time() - config.upload_expiry - 60
+        for path in os.listdir(self.user_dir):
+            if old in path:
+                os.utime(os.path.join(self.user_dir, path),
+                         (long_ago, long_ago))
+        # an upload that is still receiving chunks keeps its meta file
+        os.utime(os.path.join(self.user_dir, '_upload-%s.meta' % (new)),
+                 (long_ago, long_ago))
+        uploads.append_chunk(self.user_dir, new, 0, StringIO('{"dns"'))
+        uploads.expire_uploads(self.user_dir)
+        self.assertEqual(sorted(os.listdir(self.user_dir)),
+                         ['_upload-%s.meta' % (new),
+                          '_upload-%s.part' % (new)])
+        tmp_path, file_name, _ = uploads.finish_upload(
+            self.user_dir, new, hashlib.sha256('{"dns"').hexdigest())
+        self.assertEqual(file_name, 'new.json')
+        self.assertTrue(os.path.exists(tmp_path))
+
+
+class ResultFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.user_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.user_dir)
+
+    def write(self, name, mtime):
+        path = os.path.join(self.user_dir, name)
+        with open(path, 'w') as file_p:
+            file_p.write('{}')
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def names(self, paths):
+        return [os.path.basename(path) for path in paths]
+
+    def test_pages_by_name(self):
+        for name in ['b.json', 'd.json', 'a.json', 'c.json', 'e.json']:
+            self.write(name, 1000000000)
+        # never listed
+        self.write('_upload-0123.part', 1000000000)
+        paths, cursor = result_files.select_page(self.user_dir, 'name',
+                                                 None, 2)
+        self.assertEqual(self.names(paths), ['a.json', 'b.json'])
+
+        # changes before the cursor don't shift the following pages
+        os.remove(os.path.join(self.user_dir, 'a.json'))
+        self.write('0.json', 1000000000)
+        self.write('cc.json', 1000000000)
+        seen = self.names(paths)
+        while cursor is not None:
+            paths, cursor = result_files.select_page(self.user_dir, 'name',
+                                                     cursor, 2)
+            seen.extend(self.names(paths))
+        self.assertEqual(seen, ['a.json', 'b.json', 'c.json', 'cc.json',
+                                'd.json', 'e.json'])
+
+    def test_pages_by_mtime(self):
+        # results with the same mtime are ordered by name
+        self.write('late.json', 1000000300)
+        self.write('b.json', 1000000100)
+        self.write('a.json', 1000000100)
+        self.write('early.json', 1000000000)
+        paths, cursor = result_files.select_page(self.user_dir, 'mtime',
+                                                 None, 2)
+        self.assertEqual(self.names(paths), ['early.json', 'a.json'])
+        paths, cursor = result_files.select_page(self.user_dir, 'mtime',
+                                                 cursor, 2)
+        self.assertEqual(self.names(paths), ['b.json', 'late.json'])
+        self.assertEqual(cursor, None)
+
+    def test_malformed_cursor(self):
+        self.assertRaises(ValueError, result_files.select_page,
+                          self.user_dir, 'mtime', 'yesterday', 2)
+
+
+class IPInfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lookups = []
+        self.lookup_country = centinel.views.lookup_country
+        self.lookup_asn = centinel.views.lookup_asn
+        centinel.views.ip_info_cache.clear()
+
+        def lookup_country(ip):
+            self.lookups.append(ip)
+            return 'IR'
+        centinel.views.lookup_country = lookup_country
+        centinel.views.lookup_asn = lambda ip: ('1234', 'AS1234 Test')
+
+    def tearDown(self):
+        centinel.views.lookup_country = self.lookup_country
+        centinel.views.lookup_asn = self.lookup_asn
+        centinel.views.ip_info_cache.clear()
+
+    def test_aggregate_ip(self):
+        aggregate_ip = centinel.views.aggregate_ip
+        self.assertEqual(aggregate_ip('10.1.2.3'), '10.1.2.0')
+        self.assertEqual(aggregate_ip('10.1.2.0/24'), '10.1.2.0')
+        self.assertEqual(aggregate_ip('2001:db8:1:2::1'), '2001:db8:1::')
+        self.assertEqual(aggregate_ip('::ffff:10.1.2.3'), '10.1.2.0')
+        # the same /24 always gets the same key
+        self.assertEqual(aggregate_ip('010.001.002.003'), '10.1.2.0')
+        for ip in ['999.1.1.1', '10.1.256.1', '10.1.2.999', '10.1.2.3/99',
+                   'example.com', '']:
+            self.assertRaises(ValueError, aggregate_ip, ip)
+
+    def test_lookups_are_cached_per_aggregate(self):
+        self.assertEqual(centinel.views.lookup_ip_info('10.1.2.3'),
+                         ('IR', '1234', 'AS1234 Test'))
+        self.assertEqual(centinel.views.get_country_from_ip('10.1.2.200'),
+                         'IR')
+        # the databases are queried with the first address of the /24
+        self.assertEqual(self.lookups, ['10.1.2.0'])
+
+    def test_invalid_ip(self):
+        for ip in ['999.1.1.1', '10.1.2.999', '10.1.2.3/99']:
+            self.assertEqual(centinel.views.lookup_ip_info(ip),
+                             ('--', None, None))
+        self.assertEqual(self.lookups, [])
+
+
+class SchedulerTest(TestCase):
+
+    def create_app(self):
+        return app
+
+    def setUp(self):
+        db.create_all()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.state_file = config.scheduler_state_file
+        config.scheduler_state_file = os.path.join(self.tmp_dir, 'state')
+        self.active = []
+        for number in range(5):
+            username = 'active-%d' % (number)
+            client = Client(username=username, password='password')
+            client.country = 'IR'
+            client.last_seen = datetime.now()
+            db.session.add(client)
+            self.active.append(username)
+        inactive = Client(username='inactive', password='password')
+        inactive.country = 'IR'
+        inactive.last_seen = datetime(2015, 1, 1)
+        elsewhere = Client(username='elsewhere', password='password')
+        elsewhere.country = 'US'
+        elsewhere.last_seen = datetime.now()
+        db.session.add(inactive)
+        db.session.add(elsewhere)
+        db.session.commit()
+
+    def tearDown(self):
+        config.scheduler_state_file = self.state_file
+        shutil.rmtree(self.tmp_dir)
+        db.session.remove()
+        db.drop_all()
+
+    def test_find_clients(self):
+        self.assertEqual(scheduler.find_clients('IR', None), self.active)
+        self.assertEqual(scheduler.find_clients('IR', 2), self.active[:2])
+
+    def test_find_clients_random(self):
+        clients = scheduler.find_clients('IR', 3, 'random')
+        self.assertEqual(len(set(clients)), 3)
+        self.assertTrue(set(clients) <= set(self.active))
+
+    def test_find_clients_round_robin(self):
+        picked = [scheduler.find_clients('IR', 2, 'round-robin')
+                  for _ in range(3)]
+        # wraps around to the first clients
+        self.assertEqual(picked, [self.active[:2], self.active[2:4],
+                                  [self.active[4], self.active[0]]])
+        # each country has its own position
+        self.assertEqual(scheduler.find_clients('US', 1, 'round-robin'),
+                         ['elsewhere'])
+        self.assertEqual(scheduler.find_clients('IR', 1, 'round-robin'),
+                         [self.active[1]])
+        # no temporary file is left behind
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)),
+                         ['state', 'state.lock'])
+
+    def test_client_schedule_precedence(self):
+        db.session.add(Schedule('global', '', 'http_request', 600))
+        db.session.add(Schedule('global', '', 'dns', 600))
+        db.session.add(Schedule('global', '', 'ping', 600))
+        db.session.add(Schedule('country', 'IR', 'http_request', 300))
+        db.session.add(Schedule('country', 'IR', 'dns', 300))
+        db.session.add(Schedule('country', 'US', 'ping', 60))
+        db.session.add(Schedule('client', 'active-0', 'http_request', 60))
+        db.session.add(Schedule('client', 'active-1', 'dns', 60))
+        db.session.commit()
+        freqs = get_client_schedule('IR', 'active-0')
+        self.assertEqual(dict((exp, info['frequency']) for exp, info
+                              in freqs.items()),
+                         {'http_request': 60, 'dns': 300, 'ping': 600})
+
+    def write_schedule(self, directory, freqs):
+        client_dirs.makedirs(directory)
+        with open(os.path.join(directory, 'scheduler.info'), 'w') as file_p:
+            json.dump(freqs, file_p)
+
+    def test_migrate_schedules(self):
+        experiments_dir = config.experiments_dir
+        config.experiments_dir = os.path.join(self.tmp_dir, 'experiments')
+        try:
+            base = config.experiments_dir
+            self.write_schedule(os.path.join(base, 'global'),
+                                {'dns': {'frequency': 600}})
+            self.write_schedule(os.path.join(base, 'IR'),
+                                {'dns': {'frequency': 300}})
+            self.write_schedule(client_dirs.client_dir(base, 'active-0',
+                                                       depth=0),
+                                {'dns': {'frequency': 60}})
+            self.write_schedule(client_dirs.client_dir(base, 'active-1',
+                                                       depth=2),
+                                {'ping': {'frequency': 60,
+                                          'last_run': 10}})
+            # a shard directory is not a country
+            shard = client_dirs.shard_parts('active-1', 1)[0]
+            self.write_schedule(os.path.join(base, shard),
+                                {'dns': {'frequency': 1}})
+            db.session.add(Schedule('country', 'IR', 'dns', 120))
+            db.session.commit()
+
+            scheduler.migrate_schedules()
+            rows = sorted((row.scope, row.scope_key, row.experiment,
+                           row.frequency, row.last_run)
+                          for row in Schedule.query)
+            self.assertEqual(rows, [
+                ('client', 'active-0', 'dns', 60, 0),
+                ('client', 'active-1', 'ping', 60, 10),
+                ('country', 'IR', 'dns', 120, 0),
+                ('global', '', 'dns', 600, 0)])
+            migrated = os.path.join(client_dirs.client_dir(
+                base, 'active-1', depth=2), '.scheduler.info.migrated')
+            self.assertTrue(os.path.isfile(migrated))
+            self.assertTrue(os.path.isfile(os.path.join(
+                base, shard, 'scheduler.info')))
+        finally:
+            config.experiments_dir = experiments_dir
+
+
+class ASInfoTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rand = random.Random(1234)
+        self.prefixes = []
+        for _ in range(500):
+            bits = rand.randint(8, 30)
+            addr = rand.randint(0, 2 ** 32 - 1) >> (32 - bits) << (32 - bits)
+            # cluster the prefixes so that many of them overlap
+            addr = (addr & 0x00ffffff) | (rand.choice([10, 11, 12]) << 24)
+            pref = str(IPNetwork((addr, bits)).cidr)
+            self.prefixes.append((pref, rand.randint(1, 20)))
+        # a duplicate prefix with a different AS: the first one wins
+        self.prefixes.append((self.prefixes[0][0], 999))
+        self.prefixes.append(('2001:db8::/32', 30))
+        self.prefixes.append(('2001:db8:1::/48', 31))
+
+        self.pref_file = os.path.join(self.tmp_dir, 'prefixes')
+        with open(self.pref_file, 'w') as file_p:
+            for pref, asn in self.prefixes:
+                file_p.write("%s\t%d\n" % (pref, asn))
+        self.owner_file = os.path.join(self.tmp_dir, 'owners')
+        with open(self.owner_file, 'w') as file_p:
+            file_p.write("1\tTest AS\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def naive_ip_to_asn(self, ip_address):
+        result = None
+        for pref, asn in self.prefixes:
+            net = IPNetwork(pref)
+            if IPAddress(ip_address) in net:
+                if result is None or net.prefixlen > result[0]:
+                    result = (net.prefixlen, asn)
+        if result is None:
+            return 0
+        return result[1]
+
+    def test_ip_to_asn_matches_naive_scan(self):
+        as_info = ASInfo(self.pref_file, self.owner_file)
+        rand = random.Random(5678)
+        addresses = set()
+        for pref, _ in self.prefixes[:200]:
+            net = IPNetwork(pref)
+            # the edges of each prefix are the interesting cases
+            for value in (net.first - 1, net.first, net.last, net.last + 1):
+                addresses.add(str(IPAddress(value, net.version)))
+        for _ in range(500):
+            addresses.add(str(IPAddress(rand.randint(9 << 24, 13 << 24))))
+        addresses.update(['2001:db8::1', '2001:db8:1::1', '2001:db9::1'])
+        for address in addresses:
+            self.assertEqual(as_info.ip_to_asn(address),
+                             self.naive_ip_to_asn(address), address)
+
+    def test_cache_is_bounded(self):
+        as_info = ASInfo(self.pref_file, self.owner_file, cache_size=2)
+        for address in ['11.0.0.1', '11.0.1.1', '11.0.2.1', '11.0.2.1']:
+            as_info.ip_to_asn(address)
+        stats = as_info.cache_stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_cache_is_keyed_on_aggregate(self):
+        # no prefix is more specific than a /24, so lookups are cached
+        # per /24
+        pref_file = os.path.join(self.tmp_dir, 'aggregate-prefixes')
+        with open(pref_file, 'w') as file_p:
+            file_p.write("10.0.0.0/8\t1\n10.1.0.0/16\t2\n"
+                         "10.1.2.0/24\t3\n")
+        as_info = ASInfo(pref_file, self.owner_file, cache_size=10)
+        self.assertEqual(as_info.ip_to_asn('10.1.2.1'), 3)
+        self.assertEqual(as_info.ip_to_asn('10.1.2.200'), 3)
+        self.assertEqual(as_info.ip_to_asn('10.1.3.1'), 2)
+        stats = as_info.cache_stats()
+        self.assertEqual(stats['size'], 2)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_asn_to_owner(self):
+        as_info = ASInfo(self.pref_file, self.owner_file)
+        self.assertEqual(as_info.asn_to_owner(1), "Test AS")
+        self.assertRaises(Exception, as_info.asn_to_owner, 0)
+
+
+class ListRepositoryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in for the URL list repository. Serves the files in the
+    class' files dictionary with an ETag, and answers conditional
+    requests for unchanged files with a 304"""
+
+    files = {}
+    requests = []
+
+    def do_GET(self):
+        content = self.files.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        etag = '"%s"' % (hash(content))
+        if self.headers.get('If-None-Match') == etag:
+            self.requests.append((self.path, 304))
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.requests.append((self.path, 200))
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class ListGrabberTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        ListRepositoryHandler.files = {
+            '/lists/': ('<a href="IR.csv">IR</a> <a href="global.csv">'
+                        'global</a> <a href="missing.csv">missing</a>'),
+            '/lists/IR.csv': 'url,category\nexample.com,NEWS\n',
+            '/lists/global.csv': 'url,category\nexample.org,SRCH\n'}
+        ListRepositoryHandler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                ListRepositoryHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%d/lists/' % (self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output)
+
+    def test_downloads_lists(self):
+        results, fetched = list_grabber.grab_lists(self.url, self.output,
+                                                   workers=2)
+        self.assertEqual(fetched, 60)
+        self.assertTrue(results[self.url + 'IR.csv'])
+        self.assertTrue(results[self.url + 'global.csv'])
+        self.assertEqual(results[self.url + 'missing.csv'], None)
+        with open(os.path.join(self.output, 'IR', 'country_list.csv')) as f:
+            self.assertEqual(f.read(), 'url,category\nexample.com,NEWS\n')
+        with open(os.path.join(self.output, 'global', 'global.csv')) as f:
+            self.assertEqual(f.read(), 'url,category\nexample.org,SRCH\n')
+
+    def test_skips_unchanged_lists(self):
+        list_grabber.grab_lists(self.url, self.output, workers=2)
+        ListRepositoryHandler.files['/lists/IR.csv'] = 'url\nexample.net\n'
+        ListRepositoryHandler.requests = []
+        results, fetched = list_grabber.grab_lists(self.url, self.output,
+                                                   workers=2)
+        # only the list that changed is downloaded again
+        self.assertEqual(fetched, 16)
+        self.assertTrue(results[self.url + 'IR.csv'])
+        self.assertFalse(results[self.url + 'global.csv'])
+        self.assertIn(('/lists/global.csv', 304),
+                      ListRepositoryHandler.requests)
+        with open(os.path.join(self.output, 'IR', 'country_list.csv')) as f:
+            self.assertEqual(f.read(), 'url\nexample.net\n')
+
+    def test_identical_content_leaves_file_untouched(self):
+        list_grabber.grab_lists(self.url, self.output, workers=2)
+        path = os.path.join(self.output, 'IR', 'country_list.csv')
+        os.utime(path, (0, 0))
+        # without the state file, the lists are downloaded again
+        os.remove(os.path.join(self.output, list_grabber.STATE_FILE))
+        results, fetched = list_grabber.grab_lists(self.url, self.output,
+                                                   workers=2)
+        self.assertFalse(results[self.url + 'IR.csv'])
+        self.assertEqual(fetched, 60)
+        self.assertEqual(os.path.getmtime(path), 0)
+        self.assertEqual(sorted(os.listdir(os.path.dirname(path))),
+                         ['country_list.csv'])
+
+
+class ConsentTemplateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'consent.html')
+        with open(self.path, 'w') as file_p:
+            file_p.write('<p>replace-with-human-readable-username-value</p>'
+                         '<input value="replace-with-username-value">'
+                         '<a href="replace-this-with-freedom-house">\xc3\xa9'
+                         '</a>')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_render(self):
+        page = consent.render_page(self.path, {
+            consent.USERNAME_FIELD: 'dXNlcg==',
+            consent.READABLE_USERNAME_FIELD: u'us\xe9r'})
+        self.assertEqual(page, '<p>us\xc3\xa9r</p><input value="dXNlcg==">'
+                         '<a href="replace-this-with-freedom-house">\xc3\xa9'
+                         '</a>')
+
+    def test_reloads_changed_page(self):
+        template = consent.get_template(self.path)
+        self.assertIs(consent.get_template(self.path), template)
+        with open(self.path, 'w') as file_p:
+            file_p.write('replace-this-with-freedom-house')
+        page = consent.render_page(self.path, {
+            consent.FREEDOM_HOUSE_FIELD: 'static/freedom_house_IR.html'})
+        self.assertEqual(page, 'static/freedom_house_IR.html')
+
+
+class FreedomHouseHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in for the Freedom House site. Serves the pages in the
+    class' pages dictionary and counts the requests"""
+
+    pages = {}
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        content = self.pages.get(self.path)
+        if content is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class FreedomHouseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        FreedomHouseHandler.pages = {
+            '/report/Iran': ('<p>Report</p><img src="http://fh.org/a.png">'
+                             '<a href="http://fh.org/">home</a>'
+                             '<SCRIPT type="text/javascript">track()'
+                             '</script><form action="/search"><input '
+                             'name="q"></form><p>End</p>')}
+        FreedomHouseHandler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                                FreedomHouseHandler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        self.url = 'http://127.0.0.1:%d/report/' % (self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output)
+
+    def test_strip_bad_content(self):
+        page = freedom_house.strip_bad_content(
+            '<script src="x.js">\n</script ><a  href = "x">a</a>'
+            '<form>\n<a href="y">b</a></form><img src="z">')
+        self.assertEqual(page, '<a  >a</a><img >')
+
+    def test_refresh_pages(self):
+        results = freedom_house.refresh_pages(self.output, ttl=3600,
+                                              countries=['IR', 'CN'],
+                                              url_base=self.url)
+        self.assertEqual(results, {'IR': True, 'CN': None})
+        path = os.path.join(self.output, 'freedom_house_IR.html')
+        with open(path) as file_p:
+            self.assertEqual(file_p.read(), '<p>Report</p><img ><a >home</a>'
+                             '<p>End</p>')
+        self.assertEqual(freedom_house.cached_page('IR', self.output),
+                         'freedom_house_IR.html')
+        self.assertEqual(freedom_house.cached_page('CN', self.output), None)
+        self.assertEqual(sorted(os.listdir(self.output)),
+                         ['freedom_house_IR.html'])
+
+        # recent copies are not fetched again, failed ones are retried
+        FreedomHouseHandler.requests = []
+        results = freedom_house.refresh_pages(self.output, ttl=3600,
+                                              countries=['IR', 'CN'],
+                                              url_base=self.url)
+        self.assertEqual(results, {'IR': False, 'CN': None})
+        self.assertEqual(FreedomHouseHandler.requests, ['/report/china'])
+
+        os.utime(path, (0, 0))
+        results = freedom_house.refresh_pages(self.output, ttl=3600,
+                                              countries=['IR'],
+                                              url_base=self.url)
+        self.assertEqual(results, {'IR': True})
+
+    def test_is_page_name(self):
+        self.assertTrue(freedom_house.is_page_name('freedom_house_IR.html'))
+        self.assertFalse(freedom_house.is_page_name('freedom_house_XX.html'))
+        self.assertFalse(freedom_house.is_page_name('informed_consent.html'))
+
+
+class ClientDirsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_client_dir(self):
+        username = 'c0a8e3a6-1f53-4d8b-9a7c-2f4d3b6e8a10'
+        self.assertEqual(client_dirs.client_dir(self.base_dir, username,
+                                                depth=0),
+                         os.path.join(self.base_dir, username))
+        path = client_dirs.client_dir(self.base_dir, username, create=True,
+                                      depth=2)
+        parts = os.path.relpath(path, self.base_dir).split(os.sep)
+        self.assertEqual(parts[2], username)
+        self.assertEqual([len(part) for part in parts[:2]], [2, 2])
+        self.assertTrue(os.path.isdir(path))
+        # creating it again is fine
+        client_dirs.client_dir(self.base_dir, username, create=True, depth=2)
+
+    def test_existing_client_dirs(self):
+        self.assertEqual(client_dirs.existing_client_dirs(self.base_dir,
+                                                          'client-a'), [])
+        old = client_dirs.client_dir(self.base_dir, 'client-a', True, 0)
+        new = client_dirs.client_dir(self.base_dir, 'client-a', True, 3)
+        depth = config.client_dir_shard_depth
+        config.client_dir_shard_depth = 3
+        try:
+            self.assertEqual(client_dirs.existing_client_dirs(
+                self.base_dir, 'client-a'), [new, old])
+        finally:
+            config.client_dir_shard_depth = depth
+
+    def test_migrate(self):
+        usernames = ['client-a', 'client-b', 'global']
+        for username in usernames:
+            path = client_dirs.client_dir(self.base_dir, username, True, 0)
+            with open(os.path.join(path, 'result.json'), 'w') as file_p:
+                file_p.write(username)
+        # client-b already uploaded a result in the new layout
+        path = client_dirs.client_dir(self.base_dir, 'client-b', True, 2)
+        with open(os.path.join(path, 'new.json'), 'w') as file_p:
+            file_p.write('new')
+
+        moved = client_dirs.migrate([self.base_dir], usernames, depth=2)
+        self.assertEqual(moved, 2)
+        for username in ['client-a', 'client-b']:
+            path = client_dirs.client_dir(self.base_dir, username, depth=2)
+            with open(os.path.join(path, 'result.json')) as file_p:
+                self.assertEqual(file_p.read(), username)
+            self.assertFalse(os.path.exists(
+                os.path.join(self.base_dir, username)))
+        self.assertEqual(sorted(os.listdir(path)), ['new.json',
+                                                    'result.json'])
+        self.assertTrue(os.path.isdir(os.path.join(self.base_dir, 'global')))
+
+        # and back
+        self.assertEqual(client_dirs.migrate([self.base_dir], usernames,
+                                             depth=0), 2)
+        self.assertTrue(os.path.isfile(
+            os.path.join(self.base_dir, 'client-a', 'result.json')))
+
+
+class IngestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue = ingest.IngestQueue(os.path.join(self.tmp_dir, 'queue'),
+                                        max_attempts=2, retry_delay=0)
+        # the other processors need the database
+        self.processors = ingest.PROCESSORS
+        ingest.PROCESSORS = [ingest.validate_result]
+
+    def tearDown(self):
+        ingest.PROCESSORS = self.processors
+        shutil.rmtree(self.tmp_dir)
+
+    def write_result(self, name, content, compress=False):
+        path = os.path.join(self.tmp_dir, name)
+        opener = gzip.open if compress else open
+        with opener(path, 'wb') as file_p:
+            file_p.write(content)
+        return path
+
+    def test_processes_results(self):
+        path = self.write_result('http.json', '{"meta": {"exp_name": '
+                                 '"http_request", "start_time": 1}, '
+                                 '"http_request": {}}', compress=True)
+        self.queue.enqueue('client', 'http.json', path)
+        path = self.write_result('dns.json', '{"dns": []}')
+        self.queue.enqueue('client', 'dns.json', path)
+        path = self.write_result('broken.json', '{"dns": ')
+        self.queue.enqueue('client', 'broken.json', path)
+
+        self.assertEqual(ingest.work(self.queue, max_jobs=10), 3)
+        depth = self.queue.depth()
+        self.assertEqual((depth['done'], depth['dead'], depth['pending']),
+                         (2, 1, 0))
+        dead = self.queue.dead_letters()
+        self.assertEqual(dead[0]['file_name'], 'broken.json')
+        # invalid results are not retried
+        self.assertEqual(dead[0]['attempts'], 1)
+        metas = [json.loads(row[0]) for row in
+                 self.queue._connection().execute(
+                     "SELECT meta FROM jobs WHERE state = 'done' ORDER BY id")]
+        self.assertEqual(metas[0]['experiment'], 'http_request')
+        self.assertEqual(metas[0]['start_time'], 1)
+        self.assertEqual(metas[1]['experiment'], 'dns')
+
+    def test_retries_failed_jobs(self):
+        path = self.write_result('dns.json', '{"dns": []}')
+        self.queue.enqueue('client', 'dns.json', path)
+        calls = []
+
+        def flaky(job):
+            calls.append(job['attempts'])
+            raise IOError("disk on fire")
+
+        processors = ingest.PROCESSORS
+        ingest.PROCESSORS = [flaky]
+        try:
+            ingest.work(self.queue, max_jobs=10)
+        finally:
+            ingest.PROCESSORS = processors
+        self.assertEqual(calls, [1, 2])
+        self.assertEqual(self.queue.depth()['dead'], 1)
+
+        self.assertEqual(self.queue.retry_dead(), 1)
+        self.assertEqual(ingest.work(self.queue, max_jobs=10), 1)
+        self.assertEqual(self.queue.depth()['done'], 1)
+
+    def test_expired_lease_is_claimed_again(self):
+        self.queue.lease = -1
+        self.queue.enqueue('client', 'dns.json', 'missing')
+        first = self.queue.claim()
+        second = self.queue.claim()
+        self.assertEqual(first['id'], second['id'])
+        self.assertEqual(second['attempts'], 2)
+        # a job that never finishes isn't retried forever
+        self.queue.max_attempts = 3
+        self.assertEqual(self.queue.claim()['attempts'], 3)
+        self.assertEqual(self.queue.claim(), None)
+        self.assertEqual(self.queue.depth()['dead'], 1)
+        self.assertEqual(self.queue.dead_letters()[0]['error'],
+                         "Lease expired on attempt 3")
+
+
+class CompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.content = '{"http_request": %s}' % (json.dumps(
+            [{"url": "http://example.com/%d" % (num),
+              "headers": {"Server": "nginx"}} for num in range(1000)]))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, name, content):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as file_p:
+            file_p.write(content)
+        return path
+
+    def read_file(self, path):
+        with compression.open_file(path) as file_p:
+            return file_p.read()
+
+    def test_compress_file(self):
+        path = self.write_file('result.json', self.content)
+        os.utime(path, (1000, 1000))
+        self.assertEqual(compression.compress_file(path), compression.GZIP)
+        self.assertEqual(compression.detect_codec(path), compression.GZIP)
+        self.assertTrue(os.path.getsize(path) < len(self.content) / 4)
+        self.assertEqual(os.path.getmtime(path), 1000)
+        self.assertEqual(self.read_file(path), self.content)
+        self.assertEqual(os.listdir(self.tmp_dir), ['result.json'])
+        # compressed files are left alone
+        self.assertEqual(compression.compress_file(path), None)
+
+    def test_large_files_use_lzma(self):
+        if compression.lzma is None:
+            self.skipTest("lzma is not available")
+        path = self.write_file('result.json', self.content)
+        min_size = config.compress_lzma_min_size
+        config.compress_lzma_min_size = 1024
+        try:
+            self.assertEqual(compression.compress_file(path), compression.XZ)
+        finally:
+            config.compress_lzma_min_size = min_size
+        self.assertEqual(self.read_file(path), self.content)
+
+    def test_uncompressed_files_are_read_as_is(self):
+        path = self.write_file('result.json', self.content)
+        self.assertEqual(compression.detect_codec(path), None)
+        self.assertEqual(self.read_file(path), self.content)
+
+    def test_linked_files_are_not_compressed(self):
+        path = self.write_file('result.json', self.content)
+        digest = hashlib.sha256(self.content).hexdigest()
+        dest = os.path.join(self.tmp_dir, 'linked.json')
+        blob = blobstore.add_and_link(path, digest, dest,
+                                      os.path.join(self.tmp_dir, 'blobs'))
+        self.assertEqual(compression.compress_file(dest), None)
+        with open(blob, 'rb') as file_p:
+            self.assertEqual(hashlib.sha256(file_p.read()).hexdigest(),
+                             digest)
+        self.assertTrue(os.path.samefile(blob, dest))
+
+    def test_compress_backlog(self):
+        paths = [self.write_file('%d.json' % (num), self.content)
+                 for num in range(5)]
+        gzip_path = self.write_file('gzipped.json', '')
+        with gzip.open(gzip_path, 'wb') as file_p:
+            file_p.write(self.content)
+        paths.append(gzip_path)
+        self.assertEqual(compression.compress_backlog(paths, workers=2),
+                         (5, 0))
+        for path in paths:
+            self.assertEqual(self.read_file(path), self.content)
+
+
+class BlobStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store_dir = os.path.join(self.tmp_dir, 'blobs')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add(self, name, content):
+        path = os.path.join(self.tmp_dir, name + '.tmp')
+        with open(path, 'wb') as file_p:
+            file_p.write(content)
+        digest = hashlib.sha256(content).hexdigest()
+        dest = os.path.join(self.tmp_dir, name)
+        blobstore.add_and_link(path, digest, dest, self.store_dir)
+        self.assertFalse(os.path.exists(path))
+        return dest
+
+    def test_identical_files_are_stored_once(self):
+        first = self.add('first.json', '{"dns": []}')
+        second = self.add('second.json', '{"dns": []}')
+        third = self.add('third.json', '{"http_request": []}')
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertFalse(os.path.samefile(first, third))
+        self.assertEqual(os.stat(first).st_nlink, 3)
+
+        os.remove(third)
+        # recent blobs may be about to be linked
+        self.assertEqual(blobstore.collect_garbage(self.store_dir, 3600), 0)
+        self.assertEqual(blobstore.collect_garbage(self.store_dir), 1)
+        with open(second) as file_p:
+            self.assertEqual(file_p.read(), '{"dns": []}')
+
+    def test_reused_result_blob_is_not_collected(self):
+        first = self.add('first.json', '{"dns": []}')
+        os.remove(first)
+        # the only link left is the blob's own
+        blob = blobstore.blob_path(hashlib.sha256('{"dns": []}').hexdigest(),
+                                   self.store_dir)
+        long_ago = time.time() - 7200
+        os.utime(blob, (long_ago, long_ago))
+        second = self.add('second.json', '{"dns": []}')
+        self.assertTrue(os.path.samefile(blob, second))
+        self.assertEqual(blobstore.collect_garbage(self.store_dir, 3600), 0)
+
+    def test_reuse_keeps_the_mtime_of_other_results(self):
+        first = self.add('first.json', '{"dns": []}')
+        long_ago = int(time.time()) - 7200
+        os.utime(first, (long_ago, long_ago))
+        # another client uploads the same result
+        second = self.add('second.json', '{"dns": []}')
+        self.assertTrue(os.path.samefile(first, second))
+        self.assertEqual(os.path.getmtime(first), long_ago)
+
+    def test_collected_blob_is_replaced(self):
+        digest = hashlib.sha256('{"dns": []}').hexdigest()
+        blob = blobstore.blob_path(digest, self.store_dir)
+        link = blobstore.link
+
+        collected = []
+
+        def collect_then_link(path, dest):
+            # the blob is garbage collected right before it is linked
+            if not collected:
+                collected.append(blob)
+                os.remove(blob)
+            return link(path, dest)
+        self.add('first.json', '{"dns": []}')
+        os.remove(os.path.join(self.tmp_dir, 'first.json'))
+        blobstore.link = collect_then_link
+        try:
+            second = self.add('second.json', '{"dns": []}')
+        finally:
+            blobstore.link = link
+        with open(second) as file_p:
+            self.assertEqual(file_p.read(), '{"dns": []}')
+        self.assertTrue(os.path.samefile(blob, second))
+
+    def test_reused_blob_is_not_collected(self):
+        blob_dir = config.blob_dir
+        config.blob_dir = self.store_dir
+        try:
+            _, blob = blobstore.store_stream(StringIO('print "hello"'))
+            linked = os.path.join(self.tmp_dir, 'hello.py')
+            blobstore.link(blob, linked)
+            long_ago = int(time.time()) - 2 * scheduler.BLOB_MIN_AGE
+            os.utime(blob, (long_ago, long_ago))
+            # e.g. another scheduler run that is about to link it
+            _, reused = blobstore.store_stream(StringIO('print "hello"'))
+            self.assertEqual(reused, blob)
+            # the files linked to it keep their modification time
+            self.assertEqual(os.path.getmtime(linked), long_ago)
+            os.remove(linked)
+            self.assertEqual(blobstore.collect_garbage(
+                min_age=scheduler.BLOB_MIN_AGE), 0)
+            self.assertTrue(os.path.exists(blob))
+            # the lease runs out
+            lease = os.path.join(os.path.dirname(blob),
+                                 blobstore.LEASE_PREFIX +
+                                 os.path.basename(blob))
+            os.utime(lease, (long_ago, long_ago))
+            self.assertEqual(blobstore.collect_garbage(
+                min_age=scheduler.BLOB_MIN_AGE), 1)
+            self.assertEqual(os.listdir(os.path.dirname(blob)), [])
+        finally:
+            config.blob_dir = blob_dir
+
+
 if __name__ == '__main__':
     unittest.main()